@@ -0,0 +1,16 @@
+class AIServiceBaseException(Exception):
+    """AI 服務相關異常的基類"""
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(self.message)
+
+class AIServiceError(AIServiceBaseException):
+    """當 AI Gateway 請求失敗（非 2xx 狀態碼、逾時、連線錯誤或回應格式異常）時拋出"""
+    def __init__(self, message: str, status: int = None):
+        self.status = status
+        super().__init__(message)
+    
+    @property
+    def is_transient(self) -> bool:
+        """逾時、連線錯誤、限流（429）與伺服器錯誤（5xx）重試可能成功，其他 4xx 則不會"""
+        return self.status is None or self.status == 429 or self.status >= 500
@@ -0,0 +1,17 @@
+class UploadBaseException(Exception):
+    """上傳相關異常的基類"""
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(self.message)
+
+class UnsupportedUploadTypeError(UploadBaseException):
+    """當上傳的檔案類型不受支援時拋出"""
+    pass
+
+class InvalidUploadError(UploadBaseException):
+    """當上傳的物件不屬於該用戶、超過大小上限或內容不符時拋出"""
+    pass
+
+class UploadNotFoundError(UploadBaseException):
+    """當完成上傳時在 R2 中找不到物件時拋出"""
+    pass
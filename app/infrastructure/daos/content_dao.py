@@ -1,6 +1,8 @@
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from typing import TypeVar, Generic, Type, List, Optional, Any, Dict, Union
 from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from app.infrastructure.daos.mongodb_base import MongodbBaseDAO, ensure_initialized
 from app.infrastructure.models.base_models import BaseModel
@@ -17,18 +19,87 @@ class ContentDAO(MongodbBaseDAO, Generic[T]):
         self.database_name = "Content"  # 默认数据库名称
 
     @ensure_initialized
-    async def insert_one(self, document_data: T):
-        """插入单个文档"""
-        result = await self.collection.insert_one(document_data.model_dump())
+    async def insert_one(self, document_data: T, document_id: ObjectId = None):
+        """插入单个文档，可指定预先生成的 _id"""
+        doc_dict = document_data.model_dump()
+        if document_id is not None:
+            doc_dict["_id"] = document_id
+        result = await self.collection.insert_one(doc_dict)
         return result.inserted_id
     
     @ensure_initialized
-    async def insert_many(self, documents: List[T]):
-        """批量插入多个文档"""
+    async def insert_many(self, documents: List[T], document_ids: List[ObjectId] = None, ordered: bool = True):
+        """批量插入多个文档，可指定预先生成的 _id（与 documents 一一对应）"""
         docs_dicts = [doc.model_dump() for doc in documents]
-        result = await self.collection.insert_many(docs_dicts)
+        if document_ids is not None:
+            for doc_dict, document_id in zip(docs_dicts, document_ids):
+                doc_dict["_id"] = document_id
+        result = await self.collection.insert_many(docs_dicts, ordered=ordered)
         return result.inserted_ids
     
+    @ensure_initialized
+    async def upsert_many(self, keys: List[Dict], documents: List[T], document_ids: List[ObjectId] = None):
+        """按 keys 中的条件逐一 upsert：不存在时插入对应的文档（可指定预先生成的 _id），已存在时不作修改
+        
+        重复执行不会产生重复文档；并发写入同一键时，唯一索引冲突的一方视为已由另一方写入
+        """
+        operations = []
+        for index, (key, document) in enumerate(zip(keys, documents)):
+            doc_dict = document.model_dump()
+            if document_ids is not None:
+                doc_dict["_id"] = document_ids[index]
+            operations.append(UpdateOne(key, {"$setOnInsert": doc_dict}, upsert=True))
+        if not operations:
+            return
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors") or any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+    
+    @ensure_initialized
+    async def ensure_content_hash_index(self):
+        """content_hash 唯一索引（只对有 content_hash 且未删除的文档生效，已删除的内容可以重新上传）"""
+        partial_filter = {"content_hash": {"$type": "string"}, "metadata.is_deleted": False}
+        # 旧版索引不排除已删除的文档，过滤条件不同时需先删除
+        existing = (await self.collection.index_information()).get("content_hash_1")
+        if existing and existing.get("partialFilterExpression") != partial_filter:
+            await self.collection.drop_index("content_hash_1")
+        await self.collection.create_index("content_hash", unique=True, partialFilterExpression=partial_filter)
+    
+    @ensure_initialized
+    async def ensure_upload_key_index(self):
+        """upload_key 唯一索引（只对浏览器直传的文档生效），同一上传只会创建一条记录"""
+        await self.collection.create_index(
+            "upload_key", unique=True,
+            partialFilterExpression={"upload_key": {"$type": "string"}}
+        )
+    
+    @ensure_initialized
+    async def find_by_upload_keys(self, upload_keys: List[str]):
+        """根据浏览器直传的物件键查找文档"""
+        if not upload_keys:
+            return []
+        return await self.collection.find({"upload_key": {"$in": upload_keys}}).to_list(length=None)
+    
+    @ensure_initialized
+    async def find_by_content_hashes(self, content_hashes: List[str]):
+        """根据内容哈希查找未删除的文档"""
+        if not content_hashes:
+            return []
+        return await self.collection.find({"content_hash": {"$in": content_hashes},
+                                           "metadata.is_deleted": {"$ne": True}}).to_list(length=None)
+    
+    @ensure_initialized
+    async def add_authorized_users(self, document_ids: List[ObjectId], user_ids: List[ObjectId]):
+        """为文档追加授权用户"""
+        result = await self.collection.update_many(
+            {"_id": {"$in": document_ids}},
+            {"$addToSet": {"authorized_users": {"$each": user_ids}},
+             "$set": {"metadata.updated_timestamp": datetime.now(timezone.utc)}}
+        )
+        return result.modified_count
+    
     @ensure_initialized
     async def update_content_description(self, document_id: str, description: Any):
         """更新文档的描述"""
@@ -49,12 +120,173 @@ class ContentDAO(MongodbBaseDAO, Generic[T]):
         )
         return result.modified_count
     
+    async def update_processing_result(self, document_id: ObjectId, description: Any):
+        """以一次写入保存描述、标记为已处理并释放租约（经写入缓衝与其他内容的结果合并为批量写入）"""
+        now = datetime.now(timezone.utc)
+        await self.submit_write(UpdateOne(
+            {"_id": ObjectId(document_id)},
+            {"$set": {"description": description.model_dump(),
+                      "metadata.is_processed": True,
+                      "metadata.processed_timestamp": now,
+                      "metadata.updated_timestamp": now,
+                      "processing.lease_owner": None,
+                      "processing.lease_expires_at": None}}
+        ))
+    
     @ensure_initialized
     async def find_unprocessed_documents(self):
         """查找未处理的文档"""
         result = await self.collection.find({"metadata.is_processed": False}).to_list(length=None)
         return result
     
+    @ensure_initialized
+    async def ensure_processing_indexes(self):
+        """按处理状态与创建时间领取待处理文档，并快速列出死信文档"""
+        await self.collection.create_index([("metadata.is_processed", ASCENDING), ("metadata.created_timestamp", ASCENDING)])
+        await self.collection.create_index("processing.dead_lettered", partialFilterExpression={"processing.dead_lettered": True})
+    
+    def _claimable_query(self, now: datetime) -> Dict:
+        """未处理、未删除、未进入死信，没有有效租约（未领取或处理进程中断），且已到重试时间的文档"""
+        return {"metadata.is_processed": False,
+                "metadata.is_deleted": {"$ne": True},
+                "processing.dead_lettered": {"$ne": True},
+                "$and": [{"$or": [{"processing.lease_expires_at": None},
+                                  {"processing.lease_expires_at": {"$lt": now}}]},
+                         {"$or": [{"processing.next_attempt_at": None},
+                                  {"processing.next_attempt_at": {"$lte": now}}]}]}
+    
+    def _lease_update(self, owner: str, lease_seconds: int, now: datetime) -> Dict:
+        return {"$set": {"processing.lease_owner": owner,
+                         "processing.lease_expires_at": now + timedelta(seconds=lease_seconds),
+                         "processing.heartbeat_at": now},
+                "$inc": {"processing.attempts": 1}}
+    
+    @ensure_initialized
+    async def claim_unprocessed_document(self, owner: str, lease_seconds: int, projection: Dict = None, created_after: datetime = None):
+        """原子地领取最早创建的一个待处理文档；指定 created_after 时只领取该时间之后创建的文档"""
+        now = datetime.now(timezone.utc)
+        query = self._claimable_query(now)
+        if created_after is not None:
+            query["metadata.created_timestamp"] = {"$gte": created_after}
+        return await self.collection.find_one_and_update(
+            query,
+            self._lease_update(owner, lease_seconds, now),
+            projection=projection,
+            sort=[("metadata.created_timestamp", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+    
+    @ensure_initialized
+    async def claim_document(self, document_id: ObjectId, owner: str, lease_seconds: int, projection: Dict = None):
+        """原子地领取指定的待处理文档，已被其他进程领取或已处理时返回 None"""
+        now = datetime.now(timezone.utc)
+        return await self.collection.find_one_and_update(
+            {"_id": document_id, **self._claimable_query(now)},
+            self._lease_update(owner, lease_seconds, now),
+            projection=projection,
+            return_document=ReturnDocument.AFTER
+        )
+    
+    @ensure_initialized
+    async def find_unprocessed_ids(self, limit: int = 100, after: Dict = None) -> List[Dict]:
+        """按 (创建时间, _id) 分页读取可领取文档的 _id 与创建时间，after 为上一页的最后一个文档
+        
+        每页都是独立的查询，不会在处理缓慢时因游标闲置超时（CursorNotFound）而中断
+        """
+        query = self._claimable_query(datetime.now(timezone.utc))
+        if after is not None:
+            created_timestamp = (after.get("metadata") or {}).get("created_timestamp")
+            if created_timestamp is None:
+                # 没有创建时间的旧文档排在最前
+                later = [{"metadata.created_timestamp": {"$type": "date"}},
+                         {"metadata.created_timestamp": None, "_id": {"$gt": after["_id"]}}]
+            else:
+                later = [{"metadata.created_timestamp": {"$gt": created_timestamp}},
+                         {"metadata.created_timestamp": created_timestamp, "_id": {"$gt": after["_id"]}}]
+            query = {"$and": [query, {"$or": later}]}
+        cursor = self.collection.find(query, projection={"_id": 1, "metadata.created_timestamp": 1})
+        cursor = cursor.sort([("metadata.created_timestamp", ASCENDING), ("_id", ASCENDING)]).limit(limit)
+        return await cursor.to_list(length=limit)
+    
+    @ensure_initialized
+    async def count_unprocessed_documents(self):
+        """统计可领取的待处理文档数量"""
+        return await self.collection.count_documents(self._claimable_query(datetime.now(timezone.utc)))
+    
+    async def watch_inserted_ids(self, resume_after: Dict = None):
+        """监听新插入的文档，逐个产生 (文档 _id, resume token)
+        
+        需要 MongoDB 副本集（Change Stream）；指定 resume_after 时从该位置之后继续，此方法会持续运行直到被取消
+        """
+        await self.ensure_initialized()
+        pipeline = [{"$match": {"operationType": "insert"}},
+                    {"$project": {"operationType": 1, "documentKey": 1}}]
+        async with self.collection.watch(pipeline, resume_after=resume_after) as stream:
+            async for change in stream:
+                yield change["documentKey"]["_id"], stream.resume_token
+    
+    @ensure_initialized
+    async def extend_processing_lease(self, document_id: ObjectId, owner: str, lease_seconds: int):
+        """续约处理租约（心跳）"""
+        now = datetime.now(timezone.utc)
+        result = await self.collection.update_one(
+            {"_id": document_id, "processing.lease_owner": owner},
+            {"$set": {"processing.lease_expires_at": now + timedelta(seconds=lease_seconds),
+                      "processing.heartbeat_at": now}}
+        )
+        return result.modified_count
+    
+    @ensure_initialized
+    async def release_processing_lease(self, document_id: ObjectId, owner: str):
+        """释放处理租约"""
+        result = await self.collection.update_one(
+            {"_id": document_id, "processing.lease_owner": owner},
+            {"$set": {"processing.lease_owner": None, "processing.lease_expires_at": None}}
+        )
+        return result.modified_count
+    
+    @ensure_initialized
+    async def record_processing_failure(self, document_id: ObjectId, owner: str, error_type: str, error_class: str, error_message: str,
+                                        next_attempt_at: Optional[datetime], dead_lettered: bool):
+        """记录处理失败并释放租约：未进入死信的文档在 next_attempt_at 之后才会被重新领取"""
+        now = datetime.now(timezone.utc)
+        result = await self.collection.update_one(
+            {"_id": document_id, "processing.lease_owner": owner},
+            {"$set": {"processing.lease_owner": None,
+                      "processing.lease_expires_at": None,
+                      "processing.next_attempt_at": next_attempt_at,
+                      "processing.dead_lettered": dead_lettered,
+                      "processing.error_type": error_type,
+                      "processing.error_class": error_class,
+                      "processing.last_error": error_message[:2000],
+                      "processing.failed_timestamp": now}}
+        )
+        return result.modified_count
+    
+    @ensure_initialized
+    async def find_dead_lettered_documents(self, limit: int = 50, skip: int = 0, projection: Dict = None):
+        """查找进入死信的文档（最近失败的在前）"""
+        cursor = self.collection.find({"processing.dead_lettered": True}, projection=projection)
+        return await cursor.sort([("processing.failed_timestamp", -1)]).skip(skip).limit(limit).to_list(length=None)
+    
+    @ensure_initialized
+    async def count_dead_lettered_documents(self):
+        return await self.collection.count_documents({"processing.dead_lettered": True})
+    
+    @ensure_initialized
+    async def requeue_dead_lettered_documents(self, document_ids: List[ObjectId] = None):
+        """将死信文档放回待处理队列并重置尝试次数；document_ids 为 None 时放回全部"""
+        query = {"processing.dead_lettered": True}
+        if document_ids is not None:
+            query["_id"] = {"$in": document_ids}
+        result = await self.collection.update_many(
+            query,
+            {"$set": {"processing.dead_lettered": False,
+                      "processing.attempts": 0,
+                      "processing.next_attempt_at": None}}
+        )
+        return result.modified_count
+    
     @ensure_initialized
     async def find_documents_by_user_id(self, user_id: str):
         """根据用户 ID 查找文档"""
@@ -38,4 +38,25 @@ class FileDAO(ContentDAO[FileModel]):
             {"_id": ObjectId(document_id)},
             {"$set": {"child_texts": text_ids}}
         )
+        return result.modified_count
+    
+    @ensure_initialized
+    async def remove_child_texts(self, document_id: ObjectId, text_ids: List[ObjectId]):
+        """从文件关联的文本ID列表中移除指定文本"""
+        result = await self.collection.update_one(
+            {"_id": ObjectId(document_id)},
+            {"$pull": {"child_texts": {"$in": text_ids}}}
+        )
+        return result.modified_count
+    
+    @ensure_initialized
+    async def checkpoint_text_extraction(self, document_id: ObjectId, text_ids: List[ObjectId], completed_pages: int, total_pages: int):
+        """追加已完成页面的文本ID（已存在的不重复追加）并记录检查点（已完成的页数），全部完成时标记 is_completed"""
+        result = await self.collection.update_one(
+            {"_id": ObjectId(document_id)},
+            {"$addToSet": {"child_texts": {"$each": text_ids}},
+             "$set": {"text_extraction": {"completed_pages": completed_pages,
+                                          "total_pages": total_pages,
+                                          "is_completed": completed_pages >= total_pages}}}
+        )
         return result.modified_count
\ No newline at end of file
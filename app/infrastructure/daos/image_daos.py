@@ -18,6 +18,18 @@ class ImageDAO(ContentDAO[ImageModel]):
         )
         return result.modified_count
     
+    @ensure_initialized
+    async def update_derived_fields(self, image_id: ObjectId, perceptual_hash: int, model_input_url: str, thumbnail_url: str, file_url: str = None):
+        """补写处理时才生成的感知哈希与派生图像URL（浏览器直传的图像），file_url 为去除EXIF后的原图URL"""
+        fields = {"perceptual_hash": perceptual_hash, "model_input_url": model_input_url, "thumbnail_url": thumbnail_url}
+        if file_url:
+            fields["file_url"] = file_url
+        result = await self.collection.update_one(
+            {"_id": ObjectId(image_id)},
+            {"$set": fields}
+        )
+        return result.modified_count
+    
     @ensure_initialized
     async def update_ocr_text(self, image_id: str, ocr_text: str):
         """更新图片OCR文本"""
@@ -67,4 +79,15 @@ class ImageDAO(ContentDAO[ImageModel]):
             return images
         except Exception as e:
             logging.error(f"按标签查找图片时出错: {str(e)}")
-            return []
\ No newline at end of file
+            return []
+    
+    @ensure_initialized
+    async def find_processed_perceptual_hashes(self, user_id: ObjectId):
+        """查找用户可见、已处理且有感知哈希的图像（只返回 _id 与 perceptual_hash）"""
+        query = {
+            "authorized_users": user_id,
+            "perceptual_hash": {"$ne": None},
+            "metadata.is_processed": True,
+            "metadata.is_deleted": {"$ne": True}
+        }
+        return await self.collection.find(query, projection={"_id": 1, "perceptual_hash": 1}).to_list(length=None)
@@ -0,0 +1,114 @@
+from datetime import datetime, timezone, timedelta
+from typing import List
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+
+from app.infrastructure.daos.mongodb_base import MongodbBaseDAO, ensure_initialized
+from app.infrastructure.models.ingest_job_models import IngestJobModel
+
+class IngestJobDAO(MongodbBaseDAO):
+    def __init__(self):
+        super().__init__()
+        self.database_name = "Content"
+        self.collection_name = "IngestJobs"
+
+    @ensure_initialized
+    async def ensure_indexes(self, completed_ttl_seconds: int = 7 * 24 * 3600):
+        """建立索引：按状态与创建时间领取任务，已完成任务按TTL自动清理"""
+        await self.collection.create_index([("status", ASCENDING), ("created_timestamp", ASCENDING)])
+        await self.collection.create_index([("status", ASCENDING), ("lease_expires_at", ASCENDING)])
+        await self.collection.create_index("finished_timestamp", expireAfterSeconds=completed_ttl_seconds)
+
+    @ensure_initialized
+    async def insert_many(self, jobs: List[IngestJobModel]):
+        """批量插入任务"""
+        result = await self.collection.insert_many([job.model_dump() for job in jobs])
+        return result.inserted_ids
+
+    @ensure_initialized
+    async def claim_next_job(self, owner: str, lease_seconds: int):
+        """
+        原子地领取下一个任务：待处理的任务，或租约已过期的运行中任务（进程中断后遗留）
+        """
+        now = datetime.now(timezone.utc)
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "pending"},
+                {"status": "running", "lease_expires_at": {"$lt": now}}
+            ]},
+            {"$set": {"status": "running",
+                      "lease_owner": owner,
+                      "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                      "updated_timestamp": now},
+             "$inc": {"attempts": 1}},
+            sort=[("created_timestamp", ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    @ensure_initialized
+    async def extend_lease(self, job_id: ObjectId, owner: str, lease_seconds: int):
+        """续约任务租约"""
+        now = datetime.now(timezone.utc)
+        result = await self.collection.update_one(
+            {"_id": job_id, "status": "running", "lease_owner": owner},
+            {"$set": {"lease_expires_at": now + timedelta(seconds=lease_seconds),
+                      "updated_timestamp": now}}
+        )
+        return result.modified_count
+
+    @ensure_initialized
+    async def mark_completed(self, job_id: ObjectId, owner: str):
+        """标记任务完成"""
+        now = datetime.now(timezone.utc)
+        result = await self.collection.update_one(
+            {"_id": job_id, "lease_owner": owner},
+            {"$set": {"status": "completed",
+                      "lease_owner": None,
+                      "lease_expires_at": None,
+                      "updated_timestamp": now,
+                      "finished_timestamp": now}}
+        )
+        return result.modified_count
+
+    @ensure_initialized
+    async def mark_failed(self, job_id: ObjectId, owner: str, error: str, retry: bool):
+        """标记任务失败，retry为True时放回待处理队列"""
+        now = datetime.now(timezone.utc)
+        update = {"status": "pending" if retry else "failed",
+                  "last_error": error,
+                  "lease_owner": None,
+                  "lease_expires_at": None,
+                  "updated_timestamp": now}
+        result = await self.collection.update_one(
+            {"_id": job_id, "lease_owner": owner},
+            {"$set": update}
+        )
+        return result.modified_count
+
+    @ensure_initialized
+    async def release_jobs(self, owner: str):
+        """将该 owner 运行中的任务放回待处理队列（进程正常停止时使用），不计入尝试次数"""
+        now = datetime.now(timezone.utc)
+        result = await self.collection.update_many(
+            {"status": "running", "lease_owner": owner},
+            {"$set": {"status": "pending",
+                      "lease_owner": None,
+                      "lease_expires_at": None,
+                      "updated_timestamp": now},
+             "$inc": {"attempts": -1}}
+        )
+        return result.modified_count
+
+    @ensure_initialized
+    async def count_by_status(self):
+        """统计各状态的任务数量"""
+        pipeline = [{"$group": {"_id": "$status", "count": {"$sum": 1}}}]
+        results = await self.collection.aggregate(pipeline).to_list(length=None)
+        return {item["_id"]: item["count"] for item in results}
+
+    @ensure_initialized
+    async def count_expired_leases(self):
+        """统计租约已过期的运行中任务（进程中断时仍在处理的任务）"""
+        return await self.collection.count_documents(
+            {"status": "running", "lease_expires_at": {"$lt": datetime.now(timezone.utc)}}
+        )
@@ -0,0 +1,42 @@
+from datetime import datetime, timezone
+from typing import List
+from pymongo.errors import BulkWriteError
+
+from app.infrastructure.daos.mongodb_base import MongodbBaseDAO, ensure_initialized
+
+class LineWebhookEventDAO(MongodbBaseDAO):
+    def __init__(self):
+        super().__init__()
+        self.database_name = "Content"
+        self.collection_name = "LineWebhookEvents"
+
+    @ensure_initialized
+    async def ensure_indexes(self, ttl_seconds: int = 3 * 24 * 3600):
+        """建立索引：事件键唯一，过期后自动清理"""
+        await self.collection.create_index("event_key", unique=True)
+        await self.collection.create_index("created_timestamp", expireAfterSeconds=ttl_seconds)
+
+    @ensure_initialized
+    async def claim_events(self, event_keys: List[str]) -> List[str]:
+        """
+        登记事件键，返回首次出现（登记成功）的事件键，已登记过的视为重复投递
+        """
+        if not event_keys:
+            return []
+        now = datetime.now(timezone.utc)
+        documents = [{"event_key": event_key, "created_timestamp": now} for event_key in event_keys]
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+            return list(event_keys)
+        except BulkWriteError as e:
+            duplicate_indexes = {error["index"] for error in e.details.get("writeErrors", []) if error.get("code") == 11000}
+            other_errors = [error for error in e.details.get("writeErrors", []) if error.get("code") != 11000]
+            if other_errors:
+                raise
+            return [event_key for i, event_key in enumerate(event_keys) if i not in duplicate_indexes]
+
+    @ensure_initialized
+    async def release_events(self, event_keys: List[str]):
+        """撤销事件键的登记（任务未能入队时使用，以便 LINE 重新投递）"""
+        result = await self.collection.delete_many({"event_key": {"$in": event_keys}})
+        return result.deleted_count
@@ -1,9 +1,12 @@
+import os
 import functools
 import asyncio
 import logging
 
 from bson import ObjectId
+from pymongo.errors import BulkWriteError, OperationFailure
 from app.infrastructure.db.mongodb import MongodbClient
+from app.utils.batch_utils import MicroBatcher
 
 def ensure_initialized(func):
     """裝飾器：確保DAO已初始化後再執行方法"""
@@ -58,6 +61,42 @@ class MongodbBaseDAO:
                         logging.error(f"Failed to initialize {self.__class__.__name__}: {str(e)}")
                         raise
     
+    async def submit_write(self, operation):
+        """將寫入操作（UpdateOne 等）加入緩衝，與其他並發提交的操作合併為一次 bulk_write(ordered=False)
+        
+        等待所在批次寫入完成後返回；只有該操作失敗時才拋出對應的錯誤，不影響同批的其他操作。
+        批次在 MONGODB_BULK_WINDOW 秒後或累積 MONGODB_BULK_BATCH_SIZE 個操作時寫入
+        """
+        await self.ensure_initialized()
+        # DAO 為單例，__init__ 會被重複呼叫，緩衝不在 __init__ 中建立
+        batcher = getattr(self, "_write_batcher", None)
+        if batcher is None:
+            batcher = self._write_batcher = MicroBatcher(
+                self._flush_writes,
+                window=float(os.getenv("MONGODB_BULK_WINDOW", 0.2)),
+                max_batch_size=int(os.getenv("MONGODB_BULK_BATCH_SIZE", 500))
+            )
+        return await batcher.submit(operation)
+    
+    async def flush_writes(self):
+        """立即寫入所有緩衝中的操作"""
+        batcher = getattr(self, "_write_batcher", None)
+        if batcher:
+            await batcher.flush_all()
+    
+    async def _flush_writes(self, key, operations: list) -> list:
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+            return [None] * len(operations)
+        except BulkWriteError as e:
+            # 依 index 將錯誤對應回各操作，其餘操作已寫入
+            results = [None] * len(operations)
+            for error in e.details.get("writeErrors", []):
+                results[error["index"]] = OperationFailure(error.get("errmsg", ""), code=error.get("code"), details=error)
+            if e.details.get("writeConcernErrors"):
+                results = [result or e for result in results]
+            return results
+    
     def convert_objectid_to_str(self, data):
         """將文檔中的ObjectId轉換為字符串"""
         if isinstance(data, dict):
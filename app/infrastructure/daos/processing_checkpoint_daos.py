@@ -0,0 +1,29 @@
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from app.infrastructure.daos.mongodb_base import MongodbBaseDAO, ensure_initialized
+
+class ProcessingCheckpointDAO(MongodbBaseDAO):
+    """记录内容处理的检查点（如各集合 Change Stream 的 resume token），进程重启后从该位置继续"""
+    def __init__(self):
+        super().__init__()
+        self.database_name = "Content"
+        self.collection_name = "ProcessingCheckpoints"
+
+    @ensure_initialized
+    async def get_resume_token(self, name: str) -> Optional[Dict]:
+        document = await self.collection.find_one({"_id": name}, projection={"resume_token": 1})
+        return document.get("resume_token") if document else None
+
+    @ensure_initialized
+    async def save_resume_token(self, name: str, resume_token: Dict):
+        await self.collection.update_one(
+            {"_id": name},
+            {"$set": {"resume_token": resume_token, "updated_timestamp": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    @ensure_initialized
+    async def clear_resume_token(self, name: str):
+        """resume token 已失效（超出 oplog 范围）时清除，改为从当前位置开始监听"""
+        await self.collection.delete_one({"_id": name})
@@ -1,13 +1,44 @@
+from pymongo import ASCENDING
 from app.infrastructure.daos.content_dao import ContentDAO, ensure_initialized
 from app.infrastructure.models.text_models import TextModel, TextDescriptionModel
 from bson import ObjectId
-from typing import List
+from typing import Dict, List
 
 class TextDAO(ContentDAO[TextModel]):
     def __init__(self):
         super().__init__(model_class=TextModel)
         self.collection_name = "Texts"
     
+    @ensure_initialized
+    async def ensure_page_index(self):
+        """文件页面文本以 (parent_file, file_page_num) 唯一（只对文件提取的文本生效），重复处理不会产生重复页面"""
+        await self.collection.create_index(
+            [("parent_file", ASCENDING), ("file_page_num", ASCENDING)], unique=True,
+            partialFilterExpression={"parent_file": {"$type": "objectId"}}
+        )
+    
+    @ensure_initialized
+    async def find_duplicate_page_texts(self) -> List[Dict]:
+        """查找 (parent_file, file_page_num) 重复的页面文本（旧的处理流程重复提取页面时产生），
+        返回各组的文件ID与页码（_id）及按创建先后排列的页面（pages: _id、child_urls）"""
+        pipeline = [
+            {"$match": {"parent_file": {"$type": "objectId"}}},
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": {"parent_file": "$parent_file", "file_page_num": "$file_page_num"},
+                        "pages": {"$push": {"_id": "$_id", "child_urls": "$child_urls"}},
+                        "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ]
+        return await self.collection.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+    
+    @ensure_initialized
+    async def find_page_texts(self, file_id: ObjectId, page_nums: List[int]):
+        """查找文件中指定页码的页面文本"""
+        return await self.find(
+            {"parent_file": file_id, "file_page_num": {"$in": page_nums}},
+            projection={"_id": 1, "child_urls": 1, "file_page_num": 1}
+        )
+    
     @ensure_initialized
     async def update_child_urls(self, text_id: str, url_ids: List[ObjectId]):
         """更新文本关联的 URL IDs"""
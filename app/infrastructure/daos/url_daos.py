@@ -1,3 +1,4 @@
+from pymongo import ASCENDING
 from app.infrastructure.daos.content_dao import ContentDAO, ensure_initialized
 from app.infrastructure.models.url_models import UrlModel
 from bson import ObjectId
@@ -8,6 +9,14 @@ class UrlDAO(ContentDAO[UrlModel]):
         super().__init__(model_class=UrlModel)
         self.collection_name = "Urls"
     
+    @ensure_initialized
+    async def ensure_page_index(self):
+        """按来源文件与页码查找文件中只有URL的页面所创建的URL"""
+        await self.collection.create_index(
+            [("parent_file", ASCENDING), ("file_page_num", ASCENDING)],
+            partialFilterExpression={"parent_file": {"$type": "objectId"}}
+        )
+    
     @ensure_initialized
     async def update_url_preview(self, url_id: str, title: str, thumbnail_url: str, 
                                 description_summary: str, summary_vector: List[float], 
@@ -1,16 +1,42 @@
 from app.infrastructure.daos.mongodb_base import MongodbBaseDAO, ensure_initialized
 from app.infrastructure.models.user_models import UserContentMetadataModel
 from bson import ObjectId
+from pymongo import UpdateOne
+from cachetools import TTLCache
+import logging
+import os
 
 class UserDAO(MongodbBaseDAO):
+    # Line Group ID → 成员用户ID列表，成员变动时（DAO写入或Change Stream）失效
+    _line_group_member_cache = TTLCache(maxsize=int(os.getenv("LINE_GROUP_CACHE_SIZE", 5000)), 
+                                        ttl=int(os.getenv("LINE_GROUP_CACHE_TTL", 3600)))
+    
     def __init__(self):
         super().__init__()
         self.database_name = "Account"
         self.collection_name = "Users"
 
+    @classmethod
+    def invalidate_line_group_cache(cls, line_group_ids: list[str] = None):
+        """使群组成员缓存失效，不指定群组时清空全部"""
+        if line_group_ids is None:
+            cls._line_group_member_cache.clear()
+            return
+        for line_group_id in line_group_ids:
+            cls._line_group_member_cache.pop(line_group_id, None)
+
+    @ensure_initialized
+    async def ensure_line_id_index(self):
+        """external_ids.line_id 唯一索引（只对有 line_id 的用户生效），同一 LINE 用户只会注册一次"""
+        await self.collection.create_index(
+            "external_ids.line_id", unique=True,
+            partialFilterExpression={"external_ids.line_id": {"$type": "string"}},
+        )
+    
     @ensure_initialized
     async def create_user(self, user_data: dict):
         result = await self.collection.insert_one(user_data)
+        self.invalidate_line_group_cache(user_data.get("line_group_ids", []))
         return result.inserted_id
     
     @ensure_initialized
@@ -31,11 +57,58 @@ class UserDAO(MongodbBaseDAO):
     @ensure_initialized
     async def find_users_by_line_group_id(self, line_group_id: str, only_id: bool = False):
         if only_id:
-            # 使用 distinct 方法只获取 _id 字段
-            return await self.collection.distinct("_id", {"line_group_ids": line_group_id})
+            # 优先使用缓存的成员列表
+            member_ids = self._line_group_member_cache.get(line_group_id)
+            if member_ids is None:
+                # 使用 distinct 方法只获取 _id 字段
+                member_ids = await self.collection.distinct("_id", {"line_group_ids": line_group_id})
+                self._line_group_member_cache[line_group_id] = member_ids
+            return list(member_ids)
         else:
             # 原有逻辑，返回完整文档
             return await self.collection.find({"line_group_ids": line_group_id}).to_list(length=None)
+    
+    @ensure_initialized
+    async def add_line_group_id(self, user_id: ObjectId, line_group_id: str):
+        """将用户加入 Line 群组"""
+        result = await self.collection.update_one(
+            {"_id": ObjectId(user_id)},
+            {"$addToSet": {"line_group_ids": line_group_id}}
+        )
+        self.invalidate_line_group_cache([line_group_id])
+        return result.modified_count
+    
+    @ensure_initialized
+    async def remove_line_group_id(self, user_id: ObjectId, line_group_id: str):
+        """将用户移出 Line 群组"""
+        result = await self.collection.update_one(
+            {"_id": ObjectId(user_id)},
+            {"$pull": {"line_group_ids": line_group_id}}
+        )
+        self.invalidate_line_group_cache([line_group_id])
+        return result.modified_count
+    
+    @ensure_initialized
+    async def watch_line_group_changes(self):
+        """监听 Users 集合中 line_group_ids 的变动（包括其他进程或手动修改），并使缓存失效
+        
+        需要 MongoDB 副本集（Change Stream），此方法会持续运行直到被取消
+        """
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        async with self.collection.watch(pipeline) as stream:
+            logging.info("开始监听 Line 群组成员变动")
+            async for change in stream:
+                operation_type = change["operationType"]
+                if operation_type == "update":
+                    description = change.get("updateDescription", {})
+                    changed_fields = list(description.get("updatedFields", {}).keys()) + description.get("removedFields", [])
+                    if not any(field.split(".")[0] == "line_group_ids" for field in changed_fields):
+                        continue
+                elif operation_type == "insert":
+                    self.invalidate_line_group_cache(change.get("fullDocument", {}).get("line_group_ids", []))
+                    continue
+                # 无法得知变动前所属的群组，直接清空缓存（成员变动很少发生）
+                self.invalidate_line_group_cache()
 
 class UserContentMetaDAO(MongodbBaseDAO):
     def __init__(self):
@@ -67,8 +140,24 @@ class UserContentMetaDAO(MongodbBaseDAO):
         return result.inserted_ids  
     
     @ensure_initialized
+    async def upsert_many(self, user_content_meta_data: list[UserContentMetadataModel]):
+        """写入用户内容元数据，同一用户、同一内容已存在时不重复写入"""
+        operations = [
+            UpdateOne({"user_id": meta.user_id, "content_id": meta.content_id, "content_type": meta.content_type},
+                      {"$setOnInsert": meta.model_dump()}, upsert=True)
+            for meta in user_content_meta_data
+        ]
+        if operations:
+            await self.collection.bulk_write(operations, ordered=False)
+    
+    @ensure_initialized
+    async def delete_by_content_ids(self, content_ids: list[ObjectId]):
+        result = await self.collection.delete_many({"content_id": {"$in": content_ids}})
+        return result.deleted_count
+    
     async def update_content_labels(self, user_id: ObjectId, content_id: ObjectId, content_type: str, label_ids: list[ObjectId]):
-        return await self.collection.update_one(
+        """更新用户内容的标签（经写入缓衝与其他用户、其他内容的更新合并为批量写入）"""
+        await self.submit_write(UpdateOne(
             {"user_id": user_id, "content_id": content_id, "content_type": content_type},
             {"$set": {"labels": label_ids}}
-        )
\ No newline at end of file
+        ))
\ No newline at end of file
@@ -1,26 +1,98 @@
-import os, tempfile, shutil
+import os, io, tempfile, hashlib, uuid, asyncio, functools, threading
 import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, BinaryIO, Optional
 from dotenv import load_dotenv
 from datetime import datetime, timezone
 from app.utils.logging_utils import logger
+from app.infrastructure.db.r2_transfer import R2TransferManager
+from app.infrastructure.db.r2_cache import R2ObjectCache
 
 load_dotenv()
 
+class FetchedObject:
+    """open_stream 取得的物件內容：小檔案在記憶體中（data），超過閾值的大檔案暫存於磁碟（path）"""
+    def __init__(self, data: memoryview = None, path: str = None):
+        self.data = data
+        self.path = path
+
+    def open(self) -> BinaryIO:
+        """以檔案物件讀取內容"""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, "rb")
+
+    def read(self) -> bytes:
+        """讀取全部內容"""
+        with self.open() as f:
+            return f.read()
+
 class R2Storage:
+    """R2 物件儲存（S3 相容）
+
+    進程內所有實例共用同一個 boto3 client（自帶連線池）與一個有上限的執行緒池，
+    同步的 boto3 呼叫都在執行緒池中執行，不會阻塞事件循環。
+    """
+    # 進程內共用的 client 與執行緒池
+    _client = None
+    _executor: Optional[ThreadPoolExecutor] = None
+    _client_lock = threading.Lock()
+    # 進程內共用的本地磁碟快取
+    _object_cache: Optional[R2ObjectCache] = None
+
     def __init__(self):
         self.access_key = os.getenv("R2_ACCESS_KEY")
         self.secret_key = os.getenv("R2_SECRET_KEY")
         self.endpoint_url = os.getenv("R2_ENDPOINT")
         self.bucket = os.getenv("R2_BUCKET", "chartmind-images")  # 从环境变量获取bucket名称
         self.public_base_url = os.getenv("R2_PUBLIC_URL", "https://r2-image-worker.a86305394.workers.dev")  # 从环境变量获取CDN URL
-        
-        # 初始化 S3 client
-        self.s3 = boto3.client(
-            's3',
-            aws_access_key_id=self.access_key,
-            aws_secret_access_key=self.secret_key,
-            endpoint_url=self.endpoint_url
-        )
+        # 內容定址的物件內容不會改變，可長期快取
+        self.immutable_cache_control = "public, max-age=31536000, immutable"
+    
+    @property
+    def s3(self):
+        return self.get_client()
+    
+    @classmethod
+    def get_client(cls):
+        """獲取共用的 S3 client，如果未初始化則先建立（boto3 client 可跨執行緒共用）"""
+        if cls._client is None:
+            with cls._client_lock:
+                if cls._client is None:
+                    max_concurrency = int(os.getenv("R2_MAX_CONCURRENCY", 16))
+                    cls._client = boto3.client(
+                        's3',
+                        aws_access_key_id=os.getenv("R2_ACCESS_KEY"),
+                        aws_secret_access_key=os.getenv("R2_SECRET_KEY"),
+                        endpoint_url=os.getenv("R2_ENDPOINT"),
+                        config=Config(
+                            max_pool_connections=int(os.getenv("R2_MAX_POOL_CONNECTIONS", max_concurrency * 2)),
+                            retries={"max_attempts": 3, "mode": "standard"},
+                            tcp_keepalive=True,
+                        )
+                    )
+                    cls._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="r2")
+                    logger.info(f"R2 client created, max concurrency: {max_concurrency}")
+        return cls._client
+    
+    @classmethod
+    def close_client(cls):
+        """關閉共用的執行緒池與 client"""
+        with cls._client_lock:
+            if cls._executor is not None:
+                cls._executor.shutdown(wait=True)
+            if cls._client is not None:
+                cls._client.close()
+            cls._client = None
+            cls._executor = None
+    
+    async def _run(self, func, *args, **kwargs):
+        """在共用的執行緒池中執行同步的 boto3 呼叫"""
+        self.get_client()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
     
     async def upload(self, local_path: str, user_id: str) -> str:
         """
@@ -40,14 +112,137 @@ class R2Storage:
 
         logger.info(f"[log] Uploading {local_path} to R2 as {object_key}...")
         # 上傳
-        self.s3.upload_file(local_path, self.bucket, object_key)
+        await self._run(self.s3.upload_file, local_path, self.bucket, object_key)
 
         # 回傳可用連結
         return {
-            "url": f"{self.public_base_url}/{object_key}",
+            "url": self.public_url(object_key),
             "object_key": object_key
         }
     
+    async def upload_stream(self, chunks: AsyncIterator[bytes], user_id: str, filename: str, content_type: str = None,
+                            part_size: int = None, content_addressed: bool = False) -> dict:
+        """
+        以串流方式上傳到 R2 儲存桶，不經過本地檔案，並在上傳過程中計算 SHA-256
+        
+        小於一個分段的內容直接 put_object；超過時交由 R2TransferManager 分段並行上傳。
+        content_addressed 為 True 時，物件鍵由內容雜湊決定（content/{sha256}.{ext}），
+        相同內容只保存一份，並設定 immutable 的長期快取標頭。
+        
+        Args:
+            chunks: 檔案內容的異步迭代器
+            user_id: 用戶ID
+            filename: 檔名
+            content_type: MIME 類型
+            part_size: 分段大小（R2 要求除最後一段外不小於 5MB），默認取 R2_PART_SIZE
+            content_addressed: 是否使用內容定址的物件鍵
+            
+        Returns:
+            dict: 包含公開URL、object_key、檔案大小、content_hash，以及本次是否新建了物件（created）
+        """
+        part_size = part_size or int(os.getenv("R2_PART_SIZE", 8 * 1024 * 1024))
+        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+        if content_addressed:
+            # 雜湊要在讀完內容後才知道，大檔案先上傳到暫存鍵，完成後再複製到雜湊鍵
+            object_key = f"staging/{uuid.uuid4().hex}/{filename}"
+        else:
+            object_key = f"{user_id}/{today}/{filename}"
+        extra_args = {"ContentType": content_type} if content_type else {}
+
+        logger.info(f"[log] Streaming upload to R2 as {object_key}...")
+        hasher = hashlib.sha256()
+        buffer = bytearray()
+        chunks = aiter(chunks)
+        # 先讀取第一個分段，內容不足一個分段時直接 put_object
+        async for chunk in chunks:
+            hasher.update(chunk)
+            buffer.extend(chunk)
+            if len(buffer) >= part_size:
+                break
+
+        created = True
+        if len(buffer) < part_size:
+            file_size = len(buffer)
+            content_hash = hasher.hexdigest()
+            # 小檔案直接上傳；內容定址時雜湊已知，直接寫入雜湊鍵
+            if content_addressed:
+                object_key = self._content_key(content_hash, filename)
+                created = not await self._object_exists(object_key)
+                extra_args["CacheControl"] = self.immutable_cache_control
+            if created:
+                await self._run(self.s3.put_object, Bucket=self.bucket, Key=object_key, Body=bytes(buffer), **extra_args)
+        else:
+            # 大檔案以分段並行上傳
+            transfer_manager = R2TransferManager(self, part_size=part_size)
+            file_size = await transfer_manager.upload_multipart(bytes(buffer), chunks, object_key, extra_args, hasher)
+            content_hash = hasher.hexdigest()
+            if content_addressed:
+                staging_key = object_key
+                object_key = self._content_key(content_hash, filename)
+                created = await self._promote_staging_object(staging_key, object_key, content_type)
+
+        return {
+            "url": self.public_url(object_key),
+            "object_key": object_key,
+            "file_size": file_size,
+            "content_hash": content_hash,
+            "created": created
+        }
+
+    def generate_upload_url(self, object_key: str, content_type: str = None, expires_in: int = None) -> str:
+        """
+        產生預簽名的 PUT URL，讓瀏覽器直接上傳到 R2，檔案內容不經過 API 伺服器
+        
+        Args:
+            object_key: 物件鍵
+            content_type: MIME 類型（會納入簽名，上傳時必須帶相同的 Content-Type）
+            expires_in: 有效秒數，默認取 R2_PRESIGN_EXPIRES
+            
+        Returns:
+            str: 預簽名 URL
+        """
+        params = {"Bucket": self.bucket, "Key": object_key}
+        if content_type:
+            params["ContentType"] = content_type
+        # 簽名只在本地計算，不發出網路請求
+        return self.s3.generate_presigned_url("put_object", Params=params,
+                                              ExpiresIn=expires_in or int(os.getenv("R2_PRESIGN_EXPIRES", 900)))
+
+    async def get_object_info(self, object_key: str) -> Optional[dict]:
+        """讀取物件資訊（ContentLength、ContentType 等），物件不存在時返回 None"""
+        try:
+            return await self._run(self.s3.head_object, Bucket=self.bucket, Key=object_key)
+        except self.s3.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def public_url(self, object_key: str) -> str:
+        return f"{self.public_base_url}/{object_key}"
+
+    def _content_key(self, content_hash: str, filename: str) -> str:
+        """內容定址的物件鍵，保留副檔名以便 CDN 判斷類型"""
+        ext = os.path.splitext(filename)[1].lower()
+        return f"content/{content_hash}{ext}"
+
+    async def _object_exists(self, object_key: str) -> bool:
+        return await self.get_object_info(object_key) is not None
+
+    async def _promote_staging_object(self, staging_key: str, object_key: str, content_type: str = None) -> bool:
+        """將暫存物件複製到內容定址的鍵（已存在則略過），並刪除暫存物件；返回是否新建了物件"""
+        try:
+            if await self._object_exists(object_key):
+                return False
+            extra_args = {"ContentType": content_type} if content_type else {}
+            await self._run(self.s3.copy_object, Bucket=self.bucket, Key=object_key, CopySource={"Bucket": self.bucket, "Key": staging_key},
+                                MetadataDirective="REPLACE", CacheControl=self.immutable_cache_control, **extra_args)
+            return True
+        finally:
+            try:
+                await self._run(self.s3.delete_object, Bucket=self.bucket, Key=staging_key)
+            except Exception as e:
+                logger.error(f"[error] 刪除 R2 暫存物件 {staging_key} 時發生錯誤: {str(e)}")
+
     async def delete(self, object_key: str) -> bool:
         """
         從 R2 儲存桶中刪除指定的檔案
@@ -61,7 +256,7 @@ class R2Storage:
         try:
             logger.info(f"[log] 正在從 R2 刪除檔案: {object_key}...")
             # 刪除檔案
-            self.s3.delete_object(Bucket=self.bucket, Key=object_key)
+            await self._run(self.s3.delete_object, Bucket=self.bucket, Key=object_key)
             
             logger.info(f"[log] 成功從 R2 刪除檔案: {object_key}")
             return True
@@ -69,32 +264,131 @@ class R2Storage:
             logger.error(f"[error] 從 R2 刪除檔案時發生錯誤: {str(e)}")
             return False
     
+    def object_key_from_url(self, url: str) -> str:
+        """從公開 URL 中提取物件鍵"""
+        return url.replace(f"{self.public_base_url}/", "")
+
+    async def fetch_bytes(self, url: str) -> memoryview:
+        """
+        將物件整個讀入記憶體（優先讀取本地快取，否則分段並行下載並校驗內容後寫入快取）
+        
+        Args:
+            url: 檔案的完整 URL
+        
+        Returns:
+            memoryview: 檔案內容
+        """
+        async with self.open_stream(url, spill_threshold=float("inf")) as fetched_object:
+            return fetched_object.data
+
+    @asynccontextmanager
+    async def open_stream(self, url: str, spill_threshold: int = None) -> AsyncIterator[FetchedObject]:
+        """
+        開啟物件內容：不超過 spill_threshold 的物件讀入記憶體，超過時才使用磁碟上的檔案
+        
+        物件會寫入本地磁碟快取（R2ObjectCache），同一節點重複處理時不再下載；
+        快取停用或物件大於快取上限時，大檔案暫存到臨時檔，離開時自動刪除。
+        
+        Args:
+            url: 檔案的完整 URL
+            spill_threshold: 使用磁碟檔案的大小閾值（位元組），默認取 R2_SPILL_THRESHOLD（64MB）
+        
+        Yields:
+            FetchedObject: data（記憶體中的內容）或 path（磁碟上的檔案路徑）其一
+        """
+        spill_threshold = spill_threshold or int(os.getenv("R2_SPILL_THRESHOLD", 64 * 1024 * 1024))
+        object_key = self.object_key_from_url(url)
+        
+        data, head = None, None
+        # 同一物件只下載一次，其他協程等待後直接讀取快取
+        async with self.object_cache.key_lock(object_key):
+            cached_path = self.object_cache.get_path(object_key)
+            if cached_path is None:
+                transfer_manager = R2TransferManager(self)
+                head = await transfer_manager.head(object_key)
+                file_size = head["ContentLength"]
+                cacheable = self.object_cache.enabled and file_size <= self.object_cache.max_bytes
+                
+                if file_size <= spill_threshold:
+                    logger.info(f"[log] 正在從 R2 讀取檔案: {object_key}")
+                    data = await transfer_manager.download_to_buffer(object_key, head=head)
+                    if cacheable:
+                        await self._run(self.object_cache.put_bytes, object_key, data)
+                elif cacheable:
+                    # 大檔案直接下載到快取目錄
+                    part_path = self.object_cache.reserve_path(object_key)
+                    try:
+                        await transfer_manager.download_to_file(object_key, part_path, head=head)
+                        cached_path = self.object_cache.commit(object_key, part_path)
+                    finally:
+                        if os.path.exists(part_path):
+                            os.remove(part_path)
+        
+        if data is not None:
+            yield FetchedObject(data=data)
+            return
+        
+        if cached_path is None:
+            # 無法快取的大檔案暫存到臨時檔
+            async with self._open_temp_file(transfer_manager, object_key, head) as temp_file_path:
+                yield FetchedObject(path=temp_file_path)
+            return
+        
+        # 讀取快取中的檔案
+        if os.path.getsize(cached_path) <= spill_threshold:
+            data = await self._run(self._read_file, cached_path)
+            yield FetchedObject(data=memoryview(data))
+        else:
+            yield FetchedObject(path=cached_path)
+
+    @property
+    def object_cache(self) -> R2ObjectCache:
+        if R2Storage._object_cache is None:
+            R2Storage._object_cache = R2ObjectCache()
+        return R2Storage._object_cache
+
+    @staticmethod
+    def _read_file(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    @asynccontextmanager
+    async def _open_temp_file(self, transfer_manager: R2TransferManager, object_key: str, head: dict):
+        """下載到臨時檔（只建立單一檔案，不建立目錄），離開時刪除"""
+        fd, temp_file_path = tempfile.mkstemp(suffix=os.path.splitext(object_key)[1])
+        os.close(fd)
+        try:
+            logger.info(f"[log] 檔案 {object_key} 暫存到 {temp_file_path}")
+            await transfer_manager.download_to_file(object_key, temp_file_path, head=head)
+            yield temp_file_path
+        finally:
+            if os.path.exists(temp_file_path):
+                os.remove(temp_file_path)
+
     async def download_to_temp(self, url: str) -> str:
         """
-        從 R2 下載檔案到臨時目錄
+        從 R2 下載檔案到臨時檔案
         
         Args:
             url: 要下載的檔案的完整 URL
         
         Returns:
-            str: 臨時檔案的路徑，使用後需手動刪除
+            str: 臨時檔案的路徑，使用後需手動刪除（優先使用 fetch_bytes / open_stream）
         """
-        # 從 URL 中提取物件鍵
-        object_key = url.replace(f"{self.public_base_url}/", "")
+        object_key = self.object_key_from_url(url)
         
-        # 下載檔案到臨時目錄
-        temp_dir = tempfile.mkdtemp()
-        temp_file_path = os.path.join(temp_dir, os.path.basename(object_key))
+        # 只建立單一臨時檔案，刪除檔案即可完全清理
+        fd, temp_file_path = tempfile.mkstemp(suffix=os.path.splitext(object_key)[1])
+        os.close(fd)
         
         try:
-            # 使用 boto3 下載檔案
             logger.info(f"[log] 正在從 R2 下載檔案: {object_key} 到 {temp_file_path}")
-            self.s3.download_file(self.bucket, object_key, temp_file_path)
+            # 分段並行下載並校驗內容
+            await R2TransferManager(self).download_to_file(object_key, temp_file_path)
             logger.info(f"[log] 成功從 R2 下載檔案到: {temp_file_path}")
         except Exception as e:
             logger.error(f"[error] 從 R2 下載檔案時發生錯誤: {str(e)}")
-            # 清理臨時目錄
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            os.remove(temp_file_path)
             raise
             
         return temp_file_path
@@ -0,0 +1,116 @@
+import os, time, hashlib, tempfile, asyncio, threading, weakref
+from collections import OrderedDict
+from typing import Optional
+from app.utils.logging_utils import logger
+
+class R2ObjectCache:
+    """R2 物件的本地磁碟快取（LRU，以總位元組數為上限）
+
+    進程內所有處理階段共用；快取檔名由物件鍵的雜湊決定，R2 上的物件寫入後不會再修改，
+    因此重複處理同一檔案或圖片時不需要再次下載。
+    """
+    _entries: "OrderedDict[str, int]" = OrderedDict()  # 檔名 -> 大小，依最近使用排序
+    _total_bytes = 0
+    _loaded = False
+    _lock = threading.Lock()
+    _key_locks = weakref.WeakValueDictionary()  # 無人使用時自動釋放
+    _stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __init__(self, cache_dir: str = None, max_bytes: int = None):
+        self.cache_dir = cache_dir or os.getenv("R2_CACHE_DIR", os.path.join(tempfile.gettempdir(), "chartmind-r2-cache"))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("R2_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        return {**cls._stats, "entries": len(cls._entries), "total_bytes": cls._total_bytes}
+
+    def _load(self):
+        """啟動時掃描快取目錄，依最後使用時間重建 LRU 順序"""
+        with self._lock:
+            if R2ObjectCache._loaded:
+                return
+            files = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                if name.endswith(".part"):
+                    # 中斷時未寫完的檔案（其他進程可能正在寫入，只清理過期的）
+                    if time.time() - stat.st_mtime > 3600:
+                        os.remove(path)
+                    continue
+                files.append((stat.st_mtime, name, stat.st_size))
+            for _, name, size in sorted(files):
+                R2ObjectCache._entries[name] = size
+                R2ObjectCache._total_bytes += size
+            R2ObjectCache._loaded = True
+        self._evict()
+
+    def _file_name(self, object_key: str) -> str:
+        return hashlib.sha256(object_key.encode("utf-8")).hexdigest() + os.path.splitext(object_key)[1].lower()
+
+    def key_lock(self, object_key: str) -> asyncio.Lock:
+        """同一物件的下載只進行一次，其他協程等待後直接讀取快取"""
+        lock = self._key_locks.get(object_key)
+        if lock is None:
+            lock = self._key_locks[object_key] = asyncio.Lock()
+        return lock
+
+    def get_path(self, object_key: str) -> Optional[str]:
+        """返回已快取物件的路徑並標記為最近使用，未快取時返回 None"""
+        if not self.enabled:
+            return None
+        name = self._file_name(object_key)
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+            if name not in self._entries or not os.path.exists(path):
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(name)
+            self._stats["hits"] += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return path
+
+    def reserve_path(self, object_key: str) -> str:
+        """返回寫入中的暫存路徑，寫完後呼叫 commit"""
+        return os.path.join(self.cache_dir, self._file_name(object_key) + f".{os.getpid()}.part")
+
+    def commit(self, object_key: str, part_path: str) -> str:
+        """將寫完的暫存檔加入快取，並淘汰最久未使用的檔案"""
+        name = self._file_name(object_key)
+        path = os.path.join(self.cache_dir, name)
+        size = os.path.getsize(part_path)
+        os.replace(part_path, path)
+        with self._lock:
+            R2ObjectCache._total_bytes += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+        self._evict()
+        return path
+
+    def put_bytes(self, object_key: str, data) -> str:
+        """將記憶體中的內容寫入快取"""
+        part_path = self.reserve_path(object_key)
+        with open(part_path, "wb") as f:
+            f.write(data)
+        return self.commit(object_key, part_path)
+
+    def _evict(self):
+        with self._lock:
+            while R2ObjectCache._total_bytes > self.max_bytes and len(self._entries) > 1:
+                name, size = self._entries.popitem(last=False)
+                R2ObjectCache._total_bytes -= size
+                self._stats["evictions"] += 1
+                try:
+                    # 正在讀取的檔案在 Linux 上刪除後仍可讀完
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError as e:
+                    logger.warning(f"[warning] 刪除快取檔案 {name} 失敗: {str(e)}")
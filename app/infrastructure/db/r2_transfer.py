@@ -0,0 +1,227 @@
+import os, re, base64, hashlib, asyncio
+from typing import AsyncIterator, Dict, Optional
+from app.utils.logging_utils import logger
+
+class R2TransferManager:
+    """R2 分段並行傳輸引擎
+
+    - 上傳：按 part_size 切分串流，最多 max_parallel_parts 個分段同時上傳，記憶體佔用約為 part_size * (max_parallel_parts + 1)
+    - 下載：以 Range 請求並行下載各分段，直接寫入檔案或記憶體緩衝區的對應位置
+    - 每個分段獨立重試，已完成的分段不需重傳；分段以 MD5 校驗，下載完成後以內容雜湊（或 ETag）校驗整個檔案
+    """
+
+    def __init__(self, storage, part_size: int = None, max_parallel_parts: int = None, max_part_attempts: int = 3):
+        """
+        Args:
+            storage: R2Storage 實例，提供共用的 client、執行緒池與 bucket
+            part_size: 分段大小（R2 要求除最後一段外不小於 5MB）
+            max_parallel_parts: 同時傳輸的分段數
+            max_part_attempts: 單個分段的最大嘗試次數
+        """
+        self.storage = storage
+        self.part_size = part_size or int(os.getenv("R2_PART_SIZE", 8 * 1024 * 1024))
+        self.max_parallel_parts = max_parallel_parts or int(os.getenv("R2_MAX_PARALLEL_PARTS", 4))
+        self.max_part_attempts = max_part_attempts
+
+    async def _retry(self, description: str, func, *args, **kwargs):
+        """在執行緒池中執行，失敗時以指數退避重試"""
+        for attempt in range(1, self.max_part_attempts + 1):
+            try:
+                return await self.storage._run(func, *args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_part_attempts:
+                    raise
+                logger.warning(f"[warning] R2 {description} 失敗（第 {attempt} 次）: {str(e)}，稍後重試")
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+    async def upload_multipart(self, first_part: bytes, chunks: AsyncIterator[bytes], object_key: str,
+                               extra_args: Dict = None, hasher=None) -> int:
+        """
+        以 multipart upload 並行上傳串流
+
+        Args:
+            first_part: 已讀取的第一段內容
+            chunks: 剩餘內容的異步迭代器
+            object_key: 物件鍵
+            extra_args: create_multipart_upload 的額外參數（ContentType 等）
+            hasher: 讀取剩餘內容時一併更新的 hashlib 物件
+
+        Returns:
+            int: 檔案大小
+        """
+        s3 = self.storage.s3
+        bucket = self.storage.bucket
+        upload_id = (await self.storage._run(s3.create_multipart_upload, Bucket=bucket, Key=object_key, **(extra_args or {})))["UploadId"]
+        etags: Dict[int, str] = {}
+        in_flight = set()
+        file_size = 0
+        try:
+            part_number = 0
+            async for part in self._iter_parts(first_part, chunks, hasher):
+                part_number += 1
+                file_size += len(part)
+                # 控制同時上傳的分段數，同時及早發現失敗的分段
+                while len(in_flight) >= self.max_parallel_parts:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+                in_flight.add(asyncio.create_task(self._upload_part(object_key, upload_id, part_number, part, etags)))
+            if in_flight:
+                await asyncio.gather(*in_flight)
+                in_flight = set()
+
+            parts = [{"PartNumber": number, "ETag": etags[number]} for number in sorted(etags)]
+            await self._retry("完成分段上傳", s3.complete_multipart_upload, Bucket=bucket, Key=object_key, UploadId=upload_id,
+                              MultipartUpload={"Parts": parts})
+            return file_size
+        except BaseException:
+            for task in in_flight:
+                task.cancel()
+            try:
+                await self.storage._run(s3.abort_multipart_upload, Bucket=bucket, Key=object_key, UploadId=upload_id)
+            except Exception as e:
+                logger.error(f"[error] 中止 R2 分段上傳時發生錯誤: {str(e)}")
+            raise
+
+    async def _iter_parts(self, first_part: bytes, chunks: AsyncIterator[bytes], hasher=None):
+        buffer = bytearray(first_part)
+        async for chunk in chunks:
+            if hasher is not None:
+                hasher.update(chunk)
+            buffer.extend(chunk)
+            while len(buffer) >= self.part_size:
+                yield bytes(buffer[:self.part_size])
+                del buffer[:self.part_size]
+        if buffer:
+            yield bytes(buffer)
+
+    async def _upload_part(self, object_key: str, upload_id: str, part_number: int, body: bytes, etags: Dict[int, str]):
+        etags[part_number] = await self._retry(f"上傳分段 {part_number}", self._upload_part_sync, object_key, upload_id, part_number, body)
+
+    def _upload_part_sync(self, object_key: str, upload_id: str, part_number: int, body: bytes) -> str:
+        """上傳單個分段並校驗 MD5（在執行緒池中執行）"""
+        digest = hashlib.md5(body).digest()
+        response = self.storage.s3.upload_part(Bucket=self.storage.bucket, Key=object_key, UploadId=upload_id, PartNumber=part_number,
+                                               Body=body, ContentMD5=base64.b64encode(digest).decode())
+        etag = response["ETag"]
+        if len(etag.strip('"')) == 32 and etag.strip('"') != digest.hex():
+            raise ValueError(f"分段 {part_number} 校驗失敗: ETag {etag}")
+        return etag
+
+    async def head(self, object_key: str) -> Dict:
+        """讀取物件資訊（大小、ETag）"""
+        return await self._retry("讀取物件資訊", self.storage.s3.head_object, Bucket=self.storage.bucket, Key=object_key)
+
+    async def download_to_file(self, object_key: str, file_path: str, head: Dict = None) -> int:
+        """
+        並行下載物件到本地檔案，並校驗內容
+
+        Returns:
+            int: 檔案大小
+        """
+        head = head or await self.head(object_key)
+        file_size = head["ContentLength"]
+
+        # 預先建立完整大小的檔案，各分段寫入對應位置
+        with open(file_path, "wb") as f:
+            f.truncate(file_size)
+
+        def _write(start: int, body: bytes):
+            with open(file_path, "r+b") as f:
+                f.seek(start)
+                f.write(body)
+
+        await self._download_ranges(object_key, file_size, _write)
+
+        def _read_blocks():
+            with open(file_path, "rb") as f:
+                yield from iter(lambda: f.read(1024 * 1024), b"")
+
+        await self.storage._run(self._verify, object_key, file_size, head.get("ETag", ""), _read_blocks)
+        return file_size
+
+    async def download_to_buffer(self, object_key: str, head: Dict = None) -> memoryview:
+        """並行下載物件到記憶體，並校驗內容"""
+        head = head or await self.head(object_key)
+        file_size = head["ContentLength"]
+        buffer = memoryview(bytearray(file_size))
+
+        def _write(start: int, body: bytes):
+            buffer[start:start + len(body)] = body
+
+        await self._download_ranges(object_key, file_size, _write)
+
+        def _read_blocks():
+            for start in range(0, file_size, 1024 * 1024):
+                yield buffer[start:start + 1024 * 1024]
+
+        await self.storage._run(self._verify, object_key, file_size, head.get("ETag", ""), _read_blocks)
+        return buffer
+
+    async def _download_ranges(self, object_key: str, file_size: int, write):
+        """以 Range 請求並行下載各分段，交由 write(start, body) 寫入"""
+        ranges = [(start, min(start + self.part_size, file_size) - 1) for start in range(0, file_size, self.part_size)]
+        semaphore = asyncio.Semaphore(self.max_parallel_parts)
+
+        async def _download_range(start: int, end: int):
+            async with semaphore:
+                await self._retry(f"下載分段 {start}-{end}", self._download_range_sync, object_key, start, end, write)
+
+        await asyncio.gather(*(_download_range(start, end) for start, end in ranges))
+
+    def _download_range_sync(self, object_key: str, start: int, end: int, write):
+        """下載單個分段並寫入（在執行緒池中執行）"""
+        response = self.storage.s3.get_object(Bucket=self.storage.bucket, Key=object_key, Range=f"bytes={start}-{end}")
+        body = response["Body"].read()
+        if len(body) != end - start + 1:
+            raise ValueError(f"分段 {start}-{end} 長度不符: {len(body)}")
+        write(start, body)
+
+    def _verify(self, object_key: str, file_size: int, etag: str, read_blocks):
+        """校驗下載的內容：內容定址的物件比對 SHA-256，其他物件盡可能比對 ETag"""
+        expected_sha256 = self._sha256_from_key(object_key)
+        etag = etag.strip('"')
+        if expected_sha256:
+            if self._digest(read_blocks(), hashlib.sha256) != expected_sha256:
+                raise ValueError(f"檔案 {object_key} SHA-256 校驗失敗")
+            return
+        if re.fullmatch(r"[0-9a-f]{32}", etag):
+            if self._digest(read_blocks(), hashlib.md5) != etag:
+                raise ValueError(f"檔案 {object_key} MD5 校驗失敗")
+            return
+        match = re.fullmatch(r"([0-9a-f]{32})-(\d+)", etag)
+        # 分段上傳的 ETag 為各分段 MD5 的 MD5，無法得知上傳時的分段大小，只能以本設定的分段大小嘗試校驗
+        if match and -(-file_size // self.part_size) == int(match.group(2)):
+            part_digests = self._part_digests(read_blocks(), self.part_size)
+            if hashlib.md5(b"".join(part_digests)).hexdigest() != match.group(1):
+                logger.warning(f"[warning] 檔案 {object_key} 分段 ETag 不符（可能以不同分段大小上傳），略過校驗")
+
+    @staticmethod
+    def _sha256_from_key(object_key: str) -> Optional[str]:
+        match = re.fullmatch(r"content/([0-9a-f]{64})(\.\w+)?", object_key)
+        return match.group(1) if match else None
+
+    @staticmethod
+    def _digest(blocks, hash_factory) -> str:
+        hasher = hash_factory()
+        for block in blocks:
+            hasher.update(block)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def _part_digests(blocks, part_size: int) -> list:
+        digests = []
+        hasher, size = hashlib.md5(), 0
+        for block in blocks:
+            block = memoryview(block)
+            while block:
+                take = min(part_size - size, len(block))
+                hasher.update(block[:take])
+                size += take
+                block = block[take:]
+                if size == part_size:
+                    digests.append(hasher.digest())
+                    hasher, size = hashlib.md5(), 0
+        if size:
+            digests.append(hasher.digest())
+        return digests
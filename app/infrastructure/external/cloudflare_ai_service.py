@@ -1,10 +1,19 @@
 import os
 import json
 import base64
+import asyncio
 import aiohttp
+from app.utils.batch_utils import MicroBatcher
+from app.exceptions.ai_exceptions import AIServiceError
 from app.utils.logging_utils import logger
 
 class CloudflareAIService:
+    # 進程內所有實例共用的請求並發上限（各類內容的分析與向量化共用同一個 AI Gateway 額度）
+    _request_semaphore = None
+    _stats = {"in_flight": 0, "waiting": 0, "requests": 0, "embedding_requests": 0, "embedding_texts": 0}
+    # 合併並發的 get_embedding 呼叫（依模型分批），以一次請求取得多段文字的向量
+    _embedding_batcher = None
+
     def __init__(self, 
                  model="gpt-4o-mini", 
                  embedding_model="text-embedding-3-large"):
@@ -13,6 +22,7 @@ class CloudflareAIService:
         self.api_token = os.environ.get("OPENAI_API_TOKEN")
         self.model = model
         self.embedding_model = embedding_model
+        self.timeout = aiohttp.ClientTimeout(total=float(os.getenv("CLOUDFLARE_AI_TIMEOUT", 120)))
         # 添加一個共享的 ClientSession 以提高效率
         self.session = None
 
@@ -32,8 +42,31 @@ class CloudflareAIService:
 
     async def _make_api_request(self, url: str, payload: dict) -> dict:
         """
-        向 Cloudflare AI Gateway 發送通用 API 請求
+        向 Cloudflare AI Gateway 發送通用 API 請求（受進程內共用的並發上限 CLOUDFLARE_AI_MAX_CONCURRENCY 約束）
         """
+        if CloudflareAIService._request_semaphore is None:
+            CloudflareAIService._request_semaphore = asyncio.Semaphore(int(os.getenv("CLOUDFLARE_AI_MAX_CONCURRENCY", 10)))
+        
+        self._stats["waiting"] += 1
+        try:
+            await self._request_semaphore.acquire()
+        finally:
+            self._stats["waiting"] -= 1
+        self._stats["in_flight"] += 1
+        self._stats["requests"] += 1
+        try:
+            return await self._send_api_request(url, payload)
+        finally:
+            self._stats["in_flight"] -= 1
+            self._request_semaphore.release()
+
+    @classmethod
+    def get_stats(cls) -> dict:
+        """AI Gateway 請求的並發狀態"""
+        return dict(cls._stats)
+
+    async def _send_api_request(self, url: str, payload: dict) -> dict:
+        """送出請求並返回 JSON 回應；非 2xx、逾時（CLOUDFLARE_AI_TIMEOUT 秒）或連線錯誤時拋出 AIServiceError"""
         headers = {
             "Authorization": f"Bearer {self.api_token}",
             "Content-Type": "application/json"
@@ -45,69 +78,132 @@ class CloudflareAIService:
             should_close = not self.session
             
             try:
-                async with session_to_use.post(url, headers=headers, json=payload) as response:
+                async with session_to_use.post(url, headers=headers, json=payload, timeout=self.timeout) as response:
                     response_text = await response.text()
-                    if response.status == 200:
-                        return await response.json()
-                    else:
+                    if not 200 <= response.status < 300:
                         logger.error(f"Cloudflare AI Gateway 返回錯誤: 狀態碼 {response.status}, URL: {url}, 回應: {response_text}")
-                        return {"error": f"API 請求失敗，狀態碼: {response.status}", "details": response_text}
+                        raise AIServiceError(f"API 請求失敗，狀態碼: {response.status}, 回應: {response_text[:500]}", 
+                                             status=response.status)
+                    return json.loads(response_text)
             finally:
                 # 如果是臨時創建的會話，則關閉它
                 if should_close:
                     await session_to_use.close()
-        except Exception as e:
-            logger.error(f"API 請求發生錯誤: {str(e)}, URL: {url}")
-            return {"error": f"API 請求異常: {str(e)}"}
+        except (asyncio.TimeoutError, aiohttp.ClientError, json.JSONDecodeError) as e:
+            logger.error(f"API 請求發生錯誤: {type(e).__name__} {str(e)}, URL: {url}")
+            raise AIServiceError(f"API 請求異常: {type(e).__name__} {str(e)}") from e
 
     async def _fetch_image_data(self, image_url: str) -> str:
         """
-        下載圖片並轉換為 base64 編碼
+        下載圖片並轉換為 base64 編碼，下載失敗時拋出 aiohttp.ClientError 或 asyncio.TimeoutError
         """
+        # 使用共享會話或創建臨時會話
+        session_to_use = self.session or aiohttp.ClientSession()
+        should_close = not self.session
+        
         try:
-            # 使用共享會話或創建臨時會話
-            session_to_use = self.session or aiohttp.ClientSession()
-            should_close = not self.session
-            
-            try:
-                async with session_to_use.get(image_url) as img_response:
-                    if img_response.status != 200:
-                        logger.error(f"圖片載入失敗: {img_response.status}")
-                        return ""
-                    image_data = await img_response.read()
-                    return base64.b64encode(image_data).decode('utf-8')
-            finally:
-                # 如果是臨時創建的會話，則關閉它
-                if should_close:
-                    await session_to_use.close()
-        except Exception as e:
-            logger.error(f"下載圖片時發生錯誤: {str(e)}")
-            return ""
+            async with session_to_use.get(image_url, timeout=self.timeout) as img_response:
+                if img_response.status >= 400:
+                    logger.error(f"圖片載入失敗: {img_response.status}")
+                img_response.raise_for_status()
+                image_data = await img_response.read()
+                return base64.b64encode(image_data).decode('utf-8')
+        finally:
+            # 如果是臨時創建的會話，則關閉它
+            if should_close:
+                await session_to_use.close()
+
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        """估計文字的 token 數（中文約每字一個 token，以字元數作為上限估計）"""
+        return max(len(text), 1)
+
+    @classmethod
+    def _get_embedding_batcher(cls) -> MicroBatcher:
+        if cls._embedding_batcher is None:
+            cls._embedding_batcher = MicroBatcher(
+                cls._flush_embeddings,
+                window=float(os.getenv("CLOUDFLARE_EMBEDDING_WINDOW", 0.01)),
+                max_batch_size=int(os.getenv("CLOUDFLARE_EMBEDDING_BATCH_SIZE", 64)),
+                max_batch_weight=int(os.getenv("CLOUDFLARE_EMBEDDING_MAX_TOKENS", 100000)),
+                weight_func=cls._estimate_tokens
+            )
+        return cls._embedding_batcher
 
-    async def get_embedding(self, text: str) -> list:
+    @classmethod
+    async def _flush_embeddings(cls, embedding_model: str, texts: list) -> list:
+        return await cls(embedding_model=embedding_model)._request_embeddings(texts)
+
+    async def get_embedding(self, text: str, window: float = None) -> list:
         """
         使用 Cloudflare AI Gateway 取得向量表示
+        
+        短時間內並發的呼叫會合併為一次請求（CLOUDFLARE_EMBEDDING_WINDOW 秒內，
+        最多 CLOUDFLARE_EMBEDDING_BATCH_SIZE 段、估計 CLOUDFLARE_EMBEDDING_MAX_TOKENS 個 token）
+        
+        Args:
+            window: 最多等待與其他呼叫合併的秒數，預設為 CLOUDFLARE_EMBEDDING_WINDOW；
+                    背景處理可使用較長的窗口，以合併處理時間分散的內容
+        """
+        if not text:
+            return []
+        return await self._get_embedding_batcher().submit(text, key=self.embedding_model, window=window)
+
+    async def get_embeddings(self, texts: list) -> list:
+        """
+        批量取得多段文字的向量，返回與 texts 等長的列表（空字串為空列表），任一請求失敗時拋出 AIServiceError
+        
+        依 CLOUDFLARE_EMBEDDING_BATCH_SIZE 與 CLOUDFLARE_EMBEDDING_MAX_TOKENS 分為多個請求並發送出
+        """
+        max_batch_size = int(os.getenv("CLOUDFLARE_EMBEDDING_BATCH_SIZE", 64))
+        max_tokens = int(os.getenv("CLOUDFLARE_EMBEDDING_MAX_TOKENS", 100000))
+        
+        chunks, chunk, chunk_tokens = [], [], 0
+        for text in texts:
+            tokens = self._estimate_tokens(text)
+            if chunk and (len(chunk) >= max_batch_size or chunk_tokens + tokens > max_tokens):
+                chunks.append(chunk)
+                chunk, chunk_tokens = [], 0
+            chunk.append(text)
+            chunk_tokens += tokens
+        if chunk:
+            chunks.append(chunk)
+        
+        results = await asyncio.gather(*(self._request_embeddings(chunk) for chunk in chunks))
+        return [embedding for chunk_result in results for embedding in chunk_result]
+
+    async def _request_embeddings(self, texts: list) -> list:
+        """以一次請求取得多段文字的向量，依回應中的 index 對應回各段文字；請求失敗時拋出 AIServiceError
+        
+        經由批次合併時，例外會傳給同一批次中的每個呼叫者
         """
+        embeddings = [[] for _ in texts]
+        # 空字串會使整個請求失敗，不送出
+        indexes = [i for i, text in enumerate(texts) if text]
+        if not indexes:
+            return embeddings
+        
         # 修正 URL 格式，根據 Cloudflare Workers AI 文檔
         url = f"{self.api_endpoint}/v1/embeddings"
         
         payload = {
             "model": self.embedding_model,
-            "input": text
+            "input": [texts[i] for i in indexes]
         }
         
+        self._stats["embedding_requests"] += 1
+        self._stats["embedding_texts"] += len(indexes)
         result = await self._make_api_request(url, payload)
         
-        if "error" in result:
-            logger.error(f"獲取嵌入向量失敗: {result}")
-            return []
-        
         # 根據 Cloudflare Workers AI 的回應格式調整
-        if "data" in result and len(result["data"]) > 0:
-            return result["data"][0].get("embedding", [])
+        data = result.get("data") or []
+        if len(data) != len(indexes):
+            logger.warning(f"嵌入向量回應格式異常: 預期 {len(indexes)} 個，回應 {len(data)} 個")
+            raise AIServiceError(f"嵌入向量回應格式異常: 預期 {len(indexes)} 個，回應 {len(data)} 個")
         
-        logger.warning(f"嵌入向量回應格式異常: {result}")
-        return []
+        for position, item in enumerate(data):
+            embeddings[indexes[item.get("index", position)]] = item.get("embedding", [])
+        return embeddings
     
     async def _prepare_chat_completion_payload(self, messages: list, max_tokens: int = 1000, json_response: bool = False) -> dict:
         """
@@ -142,6 +238,9 @@ class CloudflareAIService:
             
         Returns:
             dict: 處理後的結果，如果 json_response=True 則返回解析後的 JSON，否則返回文本內容
+            
+        Raises:
+            AIServiceError: 回應中沒有內容或內容不是有效的 JSON（模型輸出不穩定，重試可能成功）
         """
         try:
             if "choices" in result and len(result["choices"]) > 0:
@@ -151,12 +250,12 @@ class CloudflareAIService:
                     return json.loads(content)
                 else:
                     return content
-            
-            logger.error(f"Cloudflare AI Gateway 返回格式異常: {result}")
-            return {}
         except Exception as e:
             logger.error(f"處理 API 回應時發生錯誤: {str(e)}, 回應: {result}")
-            return {}
+            raise AIServiceError(f"處理 API 回應時發生錯誤: {type(e).__name__} {str(e)}") from e
+        
+        logger.error(f"Cloudflare AI Gateway 返回格式異常: {result}")
+        raise AIServiceError("Cloudflare AI Gateway 返回格式異常: 回應中沒有 choices")
     
     async def analyze_text(self, text: str, prompt: str, max_tokens: int = 1000, json_response: bool = False) -> dict:
         """
@@ -185,7 +284,8 @@ class CloudflareAIService:
         result = await self._make_api_request(url, payload)
         return await self._process_chat_completion_response(result, json_response)
 
-    async def analyze_image(self, image_url: str, prompt: str = None, max_tokens: int = 1000, json_response: bool = False) -> dict:
+    async def analyze_image(self, image_url: str = None, prompt: str = None, max_tokens: int = 1000, json_response: bool = False,
+                            image_bytes: bytes = None, mime_type: str = "image/jpeg") -> dict:
         """
         使用 Cloudflare AI Gateway 分析圖片
         
@@ -193,15 +293,18 @@ class CloudflareAIService:
             image_url: 圖片的 URL
             prompt: 指導模型如何分析圖片的提示，如果為 None 則使用默認提示
             max_tokens: 回應的最大 token 數
+            image_bytes: 圖片內容，提供時不再下載 image_url
+            mime_type: 圖片的 MIME 類型
             
         Returns:
             dict: 模型分析的結果，包含 summary、labels、title
         """
 
-        # 下載圖片並轉換為 base64
-        image_base64 = await self._fetch_image_data(image_url)
-        if not image_base64:
-            return {}
+        # 下載圖片並轉換為 base64（已有圖片內容時直接編碼）
+        if image_bytes is not None:
+            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+        else:
+            image_base64 = await self._fetch_image_data(image_url)
 
         url = f"{self.api_endpoint}/v1/chat/completions"
         messages = [
@@ -209,7 +312,7 @@ class CloudflareAIService:
                 "role": "user",
                 "content": [
                     {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}}
+                    {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_base64}"}}
                 ]
             }
         ]
@@ -0,0 +1,105 @@
+import os
+import time
+import aiohttp
+from contextlib import asynccontextmanager
+from typing import Optional, AsyncIterator
+from app.utils.logging_utils import logger
+
+class LineMessagingService:
+    """LINE Messaging API 異步客戶端
+
+    所有實例共用同一個 aiohttp 連線池（keep-alive），避免在事件循環中呼叫同步的 LineBotApi。
+    """
+    api_base_url = "https://api.line.me"
+    data_api_base_url = "https://api-data.line.me"
+
+    # 進程內共用的 ClientSession
+    _session: Optional[aiohttp.ClientSession] = None
+
+    def __init__(self, channel_access_token: str = None, content_timeout: float = None, reply_timeout: float = None):
+        """
+        初始化 LINE Messaging 客戶端
+
+        Args:
+            channel_access_token: LINE Channel Access Token，默認從環境變數獲取
+            content_timeout: 下載訊息內容的總超時秒數
+            reply_timeout: 回覆訊息的總超時秒數
+        """
+        self.channel_access_token = channel_access_token or os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
+        if not self.channel_access_token:
+            raise ValueError("請設定 LINE_CHANNEL_ACCESS_TOKEN 環境變數")
+
+        content_timeout = content_timeout or float(os.getenv("LINE_CONTENT_TIMEOUT", 60))
+        reply_timeout = reply_timeout or float(os.getenv("LINE_REPLY_TIMEOUT", 10))
+        self.content_timeout = aiohttp.ClientTimeout(total=content_timeout, sock_connect=5, sock_read=20)
+        self.reply_timeout = aiohttp.ClientTimeout(total=reply_timeout, sock_connect=5)
+
+    @classmethod
+    async def get_session(cls) -> aiohttp.ClientSession:
+        """獲取共用的 ClientSession，如果未初始化則先建立"""
+        if cls._session is None or cls._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=int(os.getenv("LINE_MAX_CONNECTIONS", 100)),
+                keepalive_timeout=float(os.getenv("LINE_KEEPALIVE_TIMEOUT", 30)),
+            )
+            cls._session = aiohttp.ClientSession(connector=connector)
+            logger.info("LINE Messaging session created")
+        return cls._session
+
+    @classmethod
+    async def close_session(cls):
+        """關閉共用的 ClientSession"""
+        if cls._session and not cls._session.closed:
+            await cls._session.close()
+            logger.info("LINE Messaging session closed")
+        cls._session = None
+
+    def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.channel_access_token}"}
+
+    @asynccontextmanager
+    async def open_message_content(self, message_id: str) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        開啟訊息內容的下載串流
+
+        Args:
+            message_id: Line消息ID
+
+        Yields:
+            aiohttp.ClientResponse: 可透過 content_type 取得類型，並透過 content.iter_chunked() 逐塊讀取
+        """
+        url = f"{self.data_api_base_url}/v2/bot/message/{message_id}/content"
+        session = await self.get_session()
+        start_time = time.perf_counter()
+        async with session.get(url, headers=self._headers(), timeout=self.content_timeout) as response:
+            response.raise_for_status()
+            yield response
+        logger.debug(f"LINE 下載訊息內容 {message_id} 耗時: {time.perf_counter() - start_time:.3f}s")
+
+    async def iter_message_content(self, message_id: str, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        """逐塊讀取訊息內容"""
+        async with self.open_message_content(message_id) as response:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+
+    async def reply_text(self, reply_token: str, text: str):
+        """
+        以文字訊息回覆用戶
+
+        Args:
+            reply_token: 回复令牌
+            text: 回覆內容
+        """
+        url = f"{self.api_base_url}/v2/bot/message/reply"
+        payload = {
+            "replyToken": reply_token,
+            "messages": [{"type": "text", "text": text}]
+        }
+        session = await self.get_session()
+        start_time = time.perf_counter()
+        async with session.post(url, headers=self._headers(), json=payload, timeout=self.reply_timeout) as response:
+            if response.status != 200:
+                response_text = await response.text()
+                logger.error(f"LINE 回覆訊息失敗: 狀態碼 {response.status}, 回應: {response_text}")
+                response.raise_for_status()
+        logger.debug(f"LINE 回覆訊息耗時: {time.perf_counter() - start_time:.3f}s")
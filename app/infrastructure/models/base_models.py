@@ -2,7 +2,7 @@ from pydantic import BaseModel
 from datetime import datetime, timezone
 from typing import Optional, List
 from bson import ObjectId
-from pydantic import field_validator
+from pydantic import Field, field_validator
 
 # 所有模型繼承自BaseModel，並使用field_validator來驗證ObjectId
 # model=before，表示验证器会在 Pydantic 对字段进行任何类型转换之前运行。这对于 ObjectId 验证特别有用
@@ -32,8 +32,9 @@ class MetadataModel(BaseModel):
     is_deleted: bool = False
     is_processed: bool = False
     # Timestamp
-    created_timestamp: datetime = datetime.now(timezone.utc)
-    updated_timestamp: datetime = datetime.now(timezone.utc)
+    # 以 default_factory 在建立时取当前时间（直接给默认值只会在载入模块时计算一次）
+    created_timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     processed_timestamp: Optional[datetime] = None
     
     # Upload Source
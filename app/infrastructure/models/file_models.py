@@ -17,6 +17,8 @@ class FileModel(BaseModel):
     file_url: str = ''
     file_type: str
     file_size: int
+    content_hash: Optional[str] = None  # 文件内容的 SHA-256，用于去重
+    upload_key: Optional[str] = None  # 浏览器直传的物件键，重复完成同一上传时返回已创建的记录
     
     description: FileDescriptionModel = FileDescriptionModel()
     metadata: MetadataModel = MetadataModel()
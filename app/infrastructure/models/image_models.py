@@ -20,6 +20,11 @@ class ImageModel(BaseModel):
     file_url: str
     file_type: str
     file_size: int
+    content_hash: Optional[str] = None  # 文件内容的 SHA-256，用于去重
+    upload_key: Optional[str] = None  # 浏览器直传的物件键，重复完成同一上传时返回已创建的记录
+    perceptual_hash: Optional[int] = None  # 64位 dHash，用于查找近似重复的图像
+    model_input_url: str = ''  # 去除EXIF、限制最长边的版本，供OCR与视觉模型使用
+    thumbnail_url: str = ''  # WebP 缩略图，供列表展示
     
     description: ImageDescriptionModel = ImageDescriptionModel()
     metadata: MetadataModel = MetadataModel()
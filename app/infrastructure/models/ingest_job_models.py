@@ -0,0 +1,22 @@
+from pydantic import BaseModel, Field
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+
+class IngestJobModel(BaseModel):
+    job_type: str
+    payload: Dict[str, Any] = {}
+    # Status: pending / running / completed / failed
+    status: str = "pending"
+    attempts: int = 0
+    last_error: str = ''
+    # Lease
+    lease_owner: Optional[str] = None
+    lease_expires_at: Optional[datetime] = None
+    # Timestamp
+    created_timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    finished_timestamp: Optional[datetime] = None
+
+    model_config = {
+        "arbitrary_types_allowed": True
+    }
@@ -15,6 +15,9 @@ class UrlModel(BaseModel):
     metadata: MetadataModel = MetadataModel()
     # Link
     parent_text: Optional[ObjectId] = None
+    # 来自文件中只有URL的页面（没有页面文本）
+    parent_file: Optional[ObjectId] = None
+    file_page_num: Optional[int] = None
     
     model_config = {
         "arbitrary_types_allowed": True,
@@ -1,17 +1,21 @@
 import os
 from fastapi import Request, APIRouter
-from linebot import WebhookHandler
+from linebot import WebhookParser
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, ImageMessage, TextMessage, FileMessage
-from app.service.linebot_service import handle_text_message, handle_image_message, handle_file_message
-import asyncio
+from app.service.linebot_service import handle_text_message, handle_image_message, handle_file_message, line_event_deduplicator
+from app.service.ingest_queue_service import ingest_queue
+from app.service.user_service import LineUserResolver
 
 router = APIRouter()
 
-handler = WebhookHandler(os.getenv("LINE_CHANNEL_SECRET"))
+parser = WebhookParser(os.getenv("LINE_CHANNEL_SECRET"))
 
-# 獲取事件循環
-loop = asyncio.get_event_loop()
+# 註冊上傳任務的處理函數，由任務隊列的 worker 執行
+# reply token 只能使用一次，重試時不再回覆
+ingest_queue.register_handler("line_image", handle_image_message, single_use_fields=("reply_token",))
+ingest_queue.register_handler("line_text", handle_text_message, single_use_fields=("reply_token",))
+ingest_queue.register_handler("line_file", handle_file_message, single_use_fields=("reply_token",))
 
 @router.post("/callback")
 async def line_webhook(request: Request):
@@ -19,44 +23,69 @@ async def line_webhook(request: Request):
     body = await request.body()
 
     try:
-        handler.handle(body.decode("utf-8"), signature)
+        events = parser.parse(body.decode("utf-8"), signature)
     except InvalidSignatureError:
         return {"message": "Invalid signature."}
 
+    # 只將事件寫入任務隊列，立即回應 LINE，實際處理由 worker 完成
+    keyed_jobs = []
+    for event in events:
+        job = _build_ingest_job(event)
+        if job:
+            keyed_jobs.append((line_event_deduplicator.get_event_key(event), job))
+    # 過濾 LINE 重送的事件，避免重複下載、上傳與分析
+    keyed_jobs = await line_event_deduplicator.filter_new(keyed_jobs)
+    try:
+        await ingest_queue.enqueue_many([job for _, job in keyed_jobs])
+    except Exception:
+        # 入隊失敗時撤銷登記，LINE 重送後仍可處理
+        await line_event_deduplicator.release([event_key for event_key, _ in keyed_jobs])
+        raise
+
     return {"message": "OK"}
 
-# 處理圖片訊息
-@handler.add(MessageEvent, message=ImageMessage)
-def _handle_image_message(event):
-    # 从event中提取图片内容和reply_token
-    message_id = event.message.id
-    reply_token = event.reply_token
-    line_id = event.source.user_id
-    line_group_id = event.source.group_id if hasattr(event.source, 'group_id') else '' #若是官方帳號，則不會有group_id
-    
-    # 使用已定義的事件循環運行異步函數
-    loop.create_task(handle_image_message(message_id, line_id, reply_token, line_group_id))
-
-# 處理文字訊息
-@handler.add(MessageEvent, message=TextMessage)
-def _handle_text_message(event):
-    # 从event中提取文本内容和reply_token
-    text = event.message.text
-    reply_token = event.reply_token
-    line_id = event.source.user_id
-    line_group_id = event.source.group_id if hasattr(event.source, 'group_id') else '' #若是官方帳號，則不會有group_id
-    # 使用已定義的事件循環運行異步函數
-    loop.create_task(handle_text_message(text, line_id, reply_token, line_group_id))
-
-# 處理檔案訊息
-@handler.add(MessageEvent, message=FileMessage)
-def _handle_file_message(event):
-    # 從event中提取檔案內容和reply_token
-    message_id = event.message.id
+@router.get("/ingest/metrics")
+async def get_ingest_metrics():
+    metrics = await ingest_queue.get_metrics()
+    metrics["line_user_cache"] = LineUserResolver.get_stats()
+    metrics["line_duplicate_events"] = line_event_deduplicator.duplicate_count
+    return metrics
+
+def _build_ingest_job(event):
+    """將 LINE 事件轉換為上傳任務 (job_type, payload)，不支持的事件返回 None"""
+    if not isinstance(event, MessageEvent):
+        return None
+
     reply_token = event.reply_token
     line_id = event.source.user_id
     line_group_id = event.source.group_id if hasattr(event.source, 'group_id') else '' #若是官方帳號，則不會有group_id
-    file_name = event.message.file_name
-    
-    # 使用已定義的事件循環運行異步函數
-    loop.create_task(handle_file_message(message_id, line_id, reply_token, file_name, line_group_id))
+
+    # 處理圖片訊息
+    if isinstance(event.message, ImageMessage):
+        return ("line_image", {
+            "message_id": event.message.id,
+            "line_id": line_id,
+            "reply_token": reply_token,
+            "line_group_id": line_group_id,
+        })
+
+    # 處理文字訊息
+    if isinstance(event.message, TextMessage):
+        return ("line_text", {
+            "text": event.message.text,
+            "line_id": line_id,
+            "reply_token": reply_token,
+            "line_group_id": line_group_id,
+        })
+
+    # 處理檔案訊息
+    if isinstance(event.message, FileMessage):
+        return ("line_file", {
+            "message_id": event.message.id,
+            "line_id": line_id,
+            "reply_token": reply_token,
+            "file_name": event.message.file_name,
+            "line_group_id": line_group_id,
+        })
+
+    return None
@@ -0,0 +1,37 @@
+from typing import Optional
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from bson.errors import InvalidId
+from app.service.application_service import ContentProcessingAdminService
+from app.utils.format_utils import convert_objectid_to_str
+from app.utils.logging_utils import logger
+
+router = APIRouter()
+
+class RequeueDeadLettersRequest(BaseModel):
+    content_type: str
+    content_ids: Optional[list[str]] = None
+
+@router.get("/dead_letters")
+async def list_dead_letters(content_type: str, limit: int = 50, skip: int = 0):
+    """列出多次處理失敗、已停止重試的內容及其最後一次錯誤"""
+    try:
+        result = await ContentProcessingAdminService().list_dead_letters(content_type, limit, skip)
+        return convert_objectid_to_str(result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"查詢死信內容時發生錯誤: {str(e)}")
+        raise HTTPException(status_code=500, detail="服务器错误，请稍后重试")
+
+@router.post("/dead_letters/requeue")
+async def requeue_dead_letters(request: RequeueDeadLettersRequest):
+    """將死信內容放回待處理佇列（未指定 content_ids 時放回該類型的全部死信）"""
+    try:
+        requeued = await ContentProcessingAdminService().requeue_dead_letters(request.content_type, request.content_ids)
+        return {"requeued": requeued}
+    except (ValueError, InvalidId) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"重新排隊死信內容時發生錯誤: {str(e)}")
+        raise HTTPException(status_code=500, detail="服务器错误，请稍后重试")
@@ -0,0 +1,42 @@
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from app.service.application_service import UserContentUploadService
+from app.exceptions.upload_exceptions import UnsupportedUploadTypeError, InvalidUploadError, UploadNotFoundError
+from app.utils.format_utils import convert_objectid_to_str
+from app.utils.logging_utils import logger
+
+router = APIRouter()
+
+class DirectUploadRequest(BaseModel):
+    user_id: str
+    file_name: str
+
+class DirectUploadCompleteRequest(BaseModel):
+    user_id: str
+    object_key: str
+    file_name: str
+
+@router.post("/presign")
+async def create_direct_upload(request: DirectUploadRequest):
+    """取得預簽名的 PUT URL，瀏覽器以該 URL 直接上傳到 R2（需帶相同的 Content-Type）"""
+    try:
+        return UserContentUploadService().create_direct_upload(request.user_id, request.file_name)
+    except UnsupportedUploadTypeError as e:
+        raise HTTPException(status_code=400, detail=e.message)
+    except Exception as e:
+        logger.error(f"產生上傳 URL 時發生錯誤: {str(e)}")
+        raise HTTPException(status_code=500, detail="服务器错误，请稍后重试")
+
+@router.post("/complete")
+async def complete_direct_upload(request: DirectUploadCompleteRequest):
+    """瀏覽器上傳完成後建立內容記錄"""
+    try:
+        result = await UserContentUploadService().complete_direct_upload(request.user_id, request.object_key, request.file_name)
+        return convert_objectid_to_str(result)
+    except (UnsupportedUploadTypeError, InvalidUploadError) as e:
+        raise HTTPException(status_code=400, detail=e.message)
+    except UploadNotFoundError as e:
+        raise HTTPException(status_code=404, detail=e.message)
+    except Exception as e:
+        logger.error(f"完成上傳時發生錯誤: {str(e)}")
+        raise HTTPException(status_code=500, detail="服务器错误，请稍后重试")
@@ -1,8 +1,10 @@
 # app/api/api_v1.py
 from fastapi import APIRouter
-from app.interfaces.api import auth, linebot, main
+from app.interfaces.api import auth, linebot, main, upload, processing
 
 api_router = APIRouter()
 api_router.include_router(auth.router, prefix="/auth", tags=["Auth"])
 api_router.include_router(main.router, prefix="/main", tags=["Main"])
 api_router.include_router(linebot.router, prefix="/linebot", tags=["LINE Bot"])
+api_router.include_router(upload.router, prefix="/upload", tags=["Upload"])
+api_router.include_router(processing.router, prefix="/processing", tags=["Processing"])
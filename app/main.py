@@ -3,14 +3,44 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.interfaces.api_v1 import api_router
 from app.infrastructure.db.mongodb import MongodbClient
+from app.infrastructure.db.r2 import R2Storage
+from app.infrastructure.daos.image_daos import ImageDAO
+from app.infrastructure.daos.file_daos import FileDAO
+from app.infrastructure.external.line_messaging_service import LineMessagingService
+from app.service.ingest_queue_service import ingest_queue
+from app.service.user_service import UserManagementService
+from app.service.linebot_service import line_image_batcher, line_event_deduplicator
+import asyncio
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # 启动时连接数据库
     await MongodbClient.connect_client()
+    # 建立 LINE 事件去重集合的索引
+    await line_event_deduplicator.ensure_indexes()
+    # 建立用户 line_id 的唯一索引（避免并发注册同一 LINE 用户）
+    await UserManagementService().ensure_user_indexes()
+    # 建立图像与文件的内容哈希唯一索引（用于去重）
+    await ImageDAO().ensure_content_hash_index()
+    await FileDAO().ensure_content_hash_index()
+    # 浏览器直传的物件键唯一索引（重复完成同一上传时返回已创建的记录）
+    await ImageDAO().ensure_upload_key_index()
+    await FileDAO().ensure_upload_key_index()
+    # 启动上传任务队列的 worker
+    await ingest_queue.start()
+    # 监听群组成员变动，使群组成员缓存失效
+    line_group_watcher = asyncio.create_task(UserManagementService().watch_line_group_membership())
     yield
+    # 关闭时先写入等待中的图片批次，再停止上传任务队列
+    await line_image_batcher.flush_all()
+    await ingest_queue.stop()
+    line_group_watcher.cancel()
     # 关闭时断开数据库连接
     await MongodbClient.close_client()
+    # 关闭 LINE API 连接池
+    await LineMessagingService.close_session()
+    # 关闭 R2 连接池与线程池
+    R2Storage.close_client()
 
 app = FastAPI(title="ChartMind", lifespan=lifespan)
 app.include_router(api_router, prefix="/api")
@@ -8,8 +8,24 @@ from app.service.url_services import UrlService
 
 from app.service.user_service import UserManagementService
 from app.service.user_service import UserContentMetaService
+from app.infrastructure.db.r2 import R2Storage
+from app.exceptions.upload_exceptions import UnsupportedUploadTypeError, InvalidUploadError, UploadNotFoundError
 from app.utils.logging_utils import logger
 from bson import ObjectId
+from typing import AsyncIterator
+import os
+import re
+import uuid
+
+# 瀏覽器直傳支援的檔案類型：副檔名 -> (內容類型, MIME)
+DIRECT_UPLOAD_TYPES = {
+    "jpg": ("image", "image/jpeg"),
+    "jpeg": ("image", "image/jpeg"),
+    "png": ("image", "image/png"),
+    "gif": ("image", "image/gif"),
+    "webp": ("image", "image/webp"),
+    "pdf": ("file", "application/pdf"),
+}
 
 class UserContentUploadService:
     """用户内容上传服务，处理与用户内容相关的应用层逻辑"""
@@ -49,7 +65,7 @@ class UserContentUploadService:
         logger.info(f"text_id: {text_id}, url_ids: {url_ids}")
         
 
-    async def upload_image(self, file_path: str, user_id: str, upload_source: str, line_group_id: str = ''):
+    async def upload_image(self, file_stream: AsyncIterator[bytes], file_name: str, user_id: str, upload_source: str, line_group_id: str = '', content_type: str = None):
         """上传图像到R2存储并将元数据保存到数据库"""
         authorized_users = await self._get_content_authorized_users(user_id, upload_source, line_group_id)
         upload_metadata={
@@ -57,13 +73,39 @@ class UserContentUploadService:
             "line_group_id": line_group_id
         }
         await self.image_service.create_content(
-            file_path=file_path, 
+            file_stream=file_stream, 
+            file_name=file_name,
             uploader_id=ObjectId(user_id), 
             authorized_users=authorized_users, 
+            upload_metadata=upload_metadata,
+            content_type=content_type
+        )
+
+    async def upload_image_object(self, file_stream: AsyncIterator[bytes], file_name: str, user_id: str, content_type: str = None):
+        """只上传图像文件到R2存储，数据库记录由 create_images 批量创建"""
+        return await self.image_service.upload_object(
+            file_stream=file_stream,
+            file_name=file_name,
+            uploader_id=ObjectId(user_id),
+            content_type=content_type
+        )
+
+    async def create_images(self, upload_results: list[dict], user_id: str, upload_source: str, line_group_id: str = ''):
+        """为已上传到R2的多个图像批量创建数据库记录"""
+        authorized_users = await self._get_content_authorized_users(user_id, upload_source, line_group_id)
+        upload_metadata={
+            "upload_source": upload_source,
+            "line_group_id": line_group_id
+        }
+        return await self.image_service.create_contents(
+            upload_results=upload_results,
+            uploader_id=ObjectId(user_id),
+            authorized_users=authorized_users,
             upload_metadata=upload_metadata
         )
 
-    async def upload_file(self, file_type: str, file_name: str, file_path: str, user_id: str, upload_source: str, line_group_id: str = ''):
+    async def upload_file(self, file_type: str, file_name: str, file_stream: AsyncIterator[bytes], user_id: str, upload_source: str, line_group_id: str = '', 
+                          storage_name: str = None, content_type: str = None):
         """上传文件到R2存储并将元数据保存到数据库"""
         if file_type != "pdf":
             raise ValueError(f"不支持的文件类型: {file_type}")
@@ -77,11 +119,93 @@ class UserContentUploadService:
         await self.file_service.create_content(
             file_type=file_type,
             file_name=file_name,
-            file_path=file_path,
+            file_stream=file_stream,
             uploader_id=ObjectId(user_id), 
             authorized_users=authorized_users, 
+            upload_metadata=upload_metadata,
+            storage_name=storage_name,
+            content_type=content_type
+        )
+
+    def _direct_upload_prefix(self, user_id: str) -> str:
+        return f"direct/{user_id}/"
+
+    def create_direct_upload(self, user_id: str, file_name: str) -> dict:
+        """为浏览器直传生成预签名的 PUT URL，文件内容不经过 API 服务器"""
+        file_ext = os.path.splitext(file_name)[1].lower().lstrip('.')
+        if file_ext not in DIRECT_UPLOAD_TYPES:
+            raise UnsupportedUploadTypeError(f"不支持的文件类型: {file_ext}")
+        _, mime_type = DIRECT_UPLOAD_TYPES[file_ext]
+        
+        # 物件键包含用户ID，完成上传时据此确认物件属于该用户
+        safe_name = re.sub(r"[^\w.-]", "_", os.path.basename(file_name))
+        object_key = f"{self._direct_upload_prefix(str(ObjectId(user_id)))}{uuid.uuid4().hex}/{safe_name}"
+        r2_storage = R2Storage()
+        return {
+            "upload_url": r2_storage.generate_upload_url(object_key, mime_type),
+            "object_key": object_key,
+            "content_type": mime_type,
+        }
+
+    async def complete_direct_upload(self, user_id: str, object_key: str, file_name: str, upload_source: str = "web", line_group_id: str = ''):
+        """浏览器直传完成后，读取物件信息（不下载内容）并创建图像/文件记录与User Content Metadata"""
+        if not object_key.startswith(self._direct_upload_prefix(str(ObjectId(user_id)))) or ".." in object_key:
+            raise InvalidUploadError("上传的物件不属于该用户")
+        file_ext = os.path.splitext(object_key)[1].lower().lstrip('.')
+        if file_ext not in DIRECT_UPLOAD_TYPES:
+            raise UnsupportedUploadTypeError(f"不支持的文件类型: {file_ext}")
+        content_type, _ = DIRECT_UPLOAD_TYPES[file_ext]
+        service = self.image_service if content_type == "image" else self.file_service
+        
+        # 重复提交（客户端重试）时返回已创建的记录
+        existing = await service.find_contents_by_upload_keys([object_key])
+        if object_key in existing:
+            return {"content_type": content_type, "content_id": existing[object_key]["_id"]}
+        
+        r2_storage = R2Storage()
+        object_info = await r2_storage.get_object_info(object_key)
+        if object_info is None:
+            raise UploadNotFoundError(f"R2 中找不到物件: {object_key}")
+        file_size = object_info["ContentLength"]
+        max_bytes = int(os.getenv("DIRECT_UPLOAD_MAX_BYTES", 50 * 1024 * 1024))
+        if file_size > max_bytes:
+            await r2_storage.delete(object_key)
+            raise InvalidUploadError(f"文件大小 {file_size} 超过上限 {max_bytes}")
+        
+        # 直传的文件未经服务器读取，没有内容哈希，不参与内容去重
+        upload_result = {
+            "url": r2_storage.public_url(object_key),
+            "object_key": object_key,
+            "file_size": file_size,
+            "content_hash": None,
+            "upload_key": object_key,
+            "created": True,
+            "file_name": file_name,
+        }
+        authorized_users = await self._get_content_authorized_users(user_id, upload_source, line_group_id)
+        upload_metadata = {
+            "upload_source": upload_source,
+            "line_group_id": line_group_id
+        }
+        
+        if content_type == "image":
+            image_ids = await self.image_service.create_contents(
+                upload_results=[upload_result],
+                uploader_id=ObjectId(user_id),
+                authorized_users=authorized_users,
+                upload_metadata=upload_metadata
+            )
+            return {"content_type": "image", "content_id": image_ids[0]}
+        
+        file_id = await self.file_service.create_uploaded_content(
+            upload_result=upload_result,
+            file_name=file_name,
+            file_type=file_ext,
+            uploader_id=ObjectId(user_id),
+            authorized_users=authorized_users,
             upload_metadata=upload_metadata
         )
+        return {"content_type": "file", "content_id": file_id}
 
 class UserContentRetrievalService:
     """用户材料检索服务，处理与用户材料相关的应用层逻辑"""
@@ -142,7 +266,47 @@ class UserContentRetrievalService:
         return await self._filter_content_by_criteria(user_id, "file", labels, query_text, limit)
     
     async def get_user_images(self, user_id: ObjectId, labels: list[ObjectId] = [], query_text: str = '', limit: int = 10):
-        return await self._filter_content_by_criteria(user_id, "image", labels, query_text, limit)
+        images = await self._filter_content_by_criteria(user_id, "image", labels, query_text, limit)
+        # 列表展示使用缩略图，原图地址保留在 original_url
+        for image in images:
+            if image.get("thumbnail_url"):
+                image["original_url"] = image["file_url"]
+                image["file_url"] = image["thumbnail_url"]
+        return images
     
     async def get_user_urls(self, user_id: ObjectId, labels: list[ObjectId] = [], query_text: str = '', limit: int = 10):
-        return await self._filter_content_by_criteria(user_id, "url", labels, query_text, limit)
\ No newline at end of file
+        return await self._filter_content_by_criteria(user_id, "url", labels, query_text, limit)
+
+
+class ContentProcessingAdminService:
+    """内容处理的运维操作：查看与重新排队进入死信的内容"""
+
+    def __init__(self):
+        self.service_map = {
+            "text": TextService(),
+            "file": FileService(),
+            "image": ImageService(),
+            "url": UrlService()
+        }
+    
+    def _get_service(self, content_type: str):
+        service = self.service_map.get(content_type)
+        if not service:
+            raise ValueError(f"不支持的内容类型: {content_type}")
+        return service
+    
+    async def list_dead_letters(self, content_type: str, limit: int = 50, skip: int = 0) -> dict:
+        service = self._get_service(content_type)
+        return {
+            "total": await service.count_dead_lettered_contents(),
+            "items": await service.find_dead_lettered_contents(limit, skip),
+        }
+    
+    async def requeue_dead_letters(self, content_type: str, content_ids: list[str] = None) -> int:
+        """将死信内容放回待处理队列，content_ids 为 None 时放回该类型的全部死信"""
+        service = self._get_service(content_type)
+        if content_ids is not None:
+            content_ids = [ObjectId(content_id) for content_id in content_ids]
+        requeued = await service.requeue_dead_lettered_contents(content_ids)
+        logger.info(f"已将 {requeued} 个{content_type}死信内容重新排队")
+        return requeued
@@ -1,17 +1,29 @@
 from abc import ABC, abstractmethod
 from typing import List, Dict, Any, Optional, Union
+from datetime import datetime, timezone, timedelta
 from bson import ObjectId
+import os
+import time
+import uuid
+import random
+import socket
 import asyncio
+import aiohttp
+from pymongo.errors import PyMongoError
 from app.utils.logging_utils import logger
 from app.infrastructure.external.cloudflare_ai_service import CloudflareAIService
+from app.exceptions.ai_exceptions import AIServiceError
 from app.service.label_service import LabelApplicationService
 from app.infrastructure.db.r2 import R2Storage
 from app.service.user_service import UserContentMetaService
 from app.utils.format_utils import count_words
+from app.utils.pipeline_utils import Stage, StagePipeline, ProcessingSlot, ProcessingSlots
 
 # 内容处理基类
 class ContentService(ABC):
     """所有内容类型（文件、图片、文本、URL）的抽象基类"""
+    # 处理内容时需要读取的字段（子类补充各自描述阶段所需的字段），避免载入完整文档
+    processing_fields = ["authorized_users", "uploader", "metadata", "processing"]
     
     def __init__(self):
         self.content_type = None # 子类需要重写
@@ -20,6 +32,14 @@ class ContentService(ABC):
         self.label_application_service = LabelApplicationService()
         self.r2_storage = R2Storage()    
         self.user_content_meta_service = UserContentMetaService()
+        # 处理失败的重试策略
+        self.max_processing_attempts = int(os.getenv("PROCESSING_MAX_ATTEMPTS", 5))
+        self.max_permanent_attempts = int(os.getenv("PROCESSING_MAX_PERMANENT_ATTEMPTS", 2))
+        self.retry_base_delay = int(os.getenv("PROCESSING_RETRY_DELAY", 60))
+        self.retry_max_delay = int(os.getenv("PROCESSING_RETRY_MAX_DELAY", 6 * 3600))
+        # 处理积压内容时，向量化最多等待合并的秒数与等待合并的内容数上限
+        self.backfill_embedding_window = float(os.getenv("PROCESSING_BACKFILL_EMBEDDING_WINDOW", 5))
+        self.max_embedding_waiting = int(os.getenv("PROCESSING_MAX_EMBEDDING_WAITING", 64))
         
     @abstractmethod
     async def create_content(self, **kwargs) -> ObjectId:
@@ -34,6 +54,49 @@ class ContentService(ABC):
         """删除内容"""
         return await self.content_dao.delete_many(content_ids)
     
+    async def find_contents_by_hash(self, content_hashes: list[str]) -> Dict[str, Dict]:
+        """根据内容哈希查找已存在的内容，返回 {content_hash: content}"""
+        # 直传的文件没有内容哈希，不参与去重
+        contents = await self.content_dao.find_by_content_hashes([content_hash for content_hash in content_hashes if content_hash])
+        return {content["content_hash"]: content for content in contents}
+    
+    async def find_contents_by_upload_keys(self, upload_keys: list[str]) -> Dict[str, Dict]:
+        """根据浏览器直传的物件键查找已创建的内容，返回 {upload_key: content}"""
+        contents = await self.content_dao.find_by_upload_keys([upload_key for upload_key in upload_keys if upload_key])
+        return {content["upload_key"]: content for content in contents}
+    
+    async def share_existing_contents(self, contents: List[Dict], authorized_users: list[ObjectId]) -> List[ObjectId]:
+        """复用已存在的相同内容：只为尚未授权的用户追加 authorized_users 与 User Content Metadata，
+        若内容已处理完成，则只为新用户匹配标签，不重新分析"""
+        # 按新增用户分组，每组一次写入
+        contents_by_new_users = {}
+        for content in contents:
+            new_users = tuple(user_id for user_id in authorized_users if user_id not in content.get("authorized_users", []))
+            if new_users:
+                contents_by_new_users.setdefault(new_users, []).append(content)
+        
+        for new_users, group in contents_by_new_users.items():
+            new_users = list(new_users)
+            content_ids = [content["_id"] for content in group]
+            await self.content_dao.add_authorized_users(content_ids, new_users)
+            await self.user_content_meta_service.create_content_meta(
+                content_type=self.content_type,
+                content_ids=content_ids,
+                user_ids=new_users
+            )
+            for content in group:
+                content["authorized_users"] = content.get("authorized_users", []) + new_users
+                if content.get("metadata", {}).get("is_processed"):
+                    await self.update_content_labels({**content, "authorized_users": new_users})
+            logger.info(f"复用已存在的{self.content_type}: {content_ids}，新增授权用户: {new_users}")
+        
+        return [content["_id"] for content in contents]
+    
+    async def _discard_duplicate_object(self, upload_result: Dict[str, Any], existing_content: Dict):
+        """本次新建的R2文件与已存在记录引用的不同（如扩展名不同）时删除，避免孤立文件"""
+        if upload_result.get("created") and existing_content.get("file_url") != upload_result["url"]:
+            await self.r2_storage.delete(upload_result["object_key"])
+    
     async def find_content_by_ids(self, content_ids: list[ObjectId]) -> List[Dict]:
         """查找内容"""
         return await self.content_dao.find(query={"_id": {"$in": content_ids}}, 
@@ -44,6 +107,115 @@ class ContentService(ABC):
         """查找未处理的内容"""
         return await self.content_dao.find_unprocessed_documents()
     
+    @property
+    def processing_projection(self) -> Dict[str, int]:
+        return {field: 1 for field in ContentService.processing_fields + self.processing_fields}
+    
+    async def claim_next_content(self, owner: str, lease_seconds: int, created_after: datetime = None) -> Union[Dict, None]:
+        """以租约方式领取一个未处理的内容（只读取处理所需的字段），没有可领取的内容时返回 None"""
+        return await self.content_dao.claim_unprocessed_document(owner, lease_seconds, projection=self.processing_projection,
+                                                                 created_after=created_after)
+    
+    async def ensure_processing_indexes(self):
+        """建立领取与处理内容所需的索引（子类可补充各自的索引）"""
+        await self.content_dao.ensure_processing_indexes()
+    
+    async def claim_content(self, content_id: ObjectId, owner: str, lease_seconds: int) -> Union[Dict, None]:
+        """以租约方式领取指定的内容，已被领取、已处理或尚未到重试时间时返回 None"""
+        return await self.content_dao.claim_document(content_id, owner, lease_seconds, projection=self.processing_projection)
+    
+    async def extend_processing_lease(self, content_id: ObjectId, owner: str, lease_seconds: int) -> bool:
+        """续约处理租约"""
+        return await self.content_dao.extend_processing_lease(content_id, owner, lease_seconds)
+    
+    async def release_processing_lease(self, content_id: ObjectId, owner: str) -> bool:
+        """释放处理租约"""
+        return await self.content_dao.release_processing_lease(content_id, owner)
+    
+    @staticmethod
+    def classify_processing_error(error: BaseException) -> str:
+        """区分可重试的暂时性错误（网络、超时、数据库连接）与重试也不会成功的永久性错误（文件损坏、格式不符）"""
+        if isinstance(error, AIServiceError):
+            return "transient" if error.is_transient else "permanent"
+        if isinstance(error, aiohttp.ClientResponseError) and 400 <= error.status < 500 and error.status != 429:
+            # 例如图片链接已失效（404），重试也不会成功
+            return "permanent"
+        if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError, aiohttp.ClientError, PyMongoError)):
+            return "transient"
+        if isinstance(error, (ValueError, TypeError, KeyError, IndexError, UnicodeError, NotImplementedError)):
+            return "permanent"
+        # 未知错误按暂时性错误处理，仍受最大尝试次数限制
+        return "transient"
+    
+    def get_retry_delay(self, attempts: int) -> float:
+        """第 attempts 次失败后的等待秒数：指数退避，带随机抖动，避免大量失败的内容同时重试"""
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** max(attempts - 1, 0))
+        return delay * random.uniform(0.8, 1.2)
+    
+    async def record_processing_failure(self, content: Dict, owner: str, error: BaseException) -> bool:
+        """记录处理失败：超过尝试次数（永久性错误更少）时进入死信，否则按指数退避安排下次尝试；返回是否进入死信"""
+        content_id = content["_id"]
+        attempts = content.get("processing", {}).get("attempts", 1)
+        error_class = self.classify_processing_error(error)
+        max_attempts = self.max_permanent_attempts if error_class == "permanent" else self.max_processing_attempts
+        dead_lettered = attempts >= max_attempts
+        next_attempt_at = None
+        if not dead_lettered:
+            next_attempt_at = datetime.now(timezone.utc) + timedelta(seconds=self.get_retry_delay(attempts))
+        
+        await self.content_dao.record_processing_failure(content_id, owner, type(error).__name__, error_class, str(error),
+                                                         next_attempt_at, dead_lettered)
+        if dead_lettered:
+            logger.error(f"{self.content_type} {content_id} 第 {attempts} 次处理失败（{error_class}），已移入死信: {error}")
+        else:
+            logger.warning(f"{self.content_type} {content_id} 第 {attempts} 次处理失败（{error_class}），"
+                           f"{next_attempt_at.isoformat()} 后重试: {error}")
+        return dead_lettered
+    
+    async def process_claimed_content(self, content: Dict, owner: str, lease_seconds: int) -> Union[ObjectId, None]:
+        """处理已领取的内容：处理期间定期续约，租约随处理结果一并释放；失败时记录错误并按重试策略安排下次尝试"""
+        content_id = content["_id"]
+        
+        # 之前的尝试都因进程中断而没有记录结果（如处理时进程崩溃），不再继续尝试
+        if content.get("processing", {}).get("attempts", 1) > self.max_processing_attempts:
+            await self.record_processing_failure(content, owner, RuntimeError("超过最大尝试次数（处理进程多次中断）"))
+            return None
+        
+        async def _heartbeat():
+            while True:
+                await asyncio.sleep(lease_seconds / 3)
+                try:
+                    await self.extend_processing_lease(content_id, owner, lease_seconds)
+                except Exception as e:
+                    logger.warning(f"续约{self.content_type} {content_id} 时出错: {e}")
+        
+        heartbeat = asyncio.create_task(_heartbeat())
+        try:
+            result = await self._run_content_pipeline(content)
+        except Exception as e:
+            try:
+                await self.record_processing_failure(content, owner, e)
+            except Exception as record_error:
+                # 租约到期后仍会被重新领取
+                logger.error(f"记录{self.content_type} {content_id} 的处理失败时出错: {record_error}")
+            return None
+        finally:
+            heartbeat.cancel()
+        # 租约已随处理结果一并释放
+        return result
+    
+    async def find_dead_lettered_contents(self, limit: int = 50, skip: int = 0) -> List[Dict]:
+        """列出进入死信的内容（只返回处理状态与定位内容所需的字段）"""
+        projection = {"processing": 1, "metadata": 1, "uploader": 1, "file_url": 1, "url": 1, "title": 1, "file_type": 1}
+        return await self.content_dao.find_dead_lettered_documents(limit, skip, projection=projection)
+    
+    async def count_dead_lettered_contents(self) -> int:
+        return await self.content_dao.count_dead_lettered_documents()
+    
+    async def requeue_dead_lettered_contents(self, content_ids: List[ObjectId] = None) -> int:
+        """将死信内容放回待处理队列，content_ids 为 None 时放回全部"""
+        return await self.content_dao.requeue_dead_lettered_documents(content_ids)
+    
     async def update_content_description(self, content_id: ObjectId, description: Any) -> bool:
         """更新内容描述"""
         return await self.content_dao.update_content_description(content_id, description)
@@ -51,15 +223,20 @@ class ContentService(ABC):
     async def update_is_processed(self, content_id: ObjectId, is_processed: bool) -> bool:
         """更新处理状态"""
         return await self.content_dao.update_is_processed(content_id, is_processed)
+    
+    async def save_processing_result(self, content: Dict, description: Any):
+        """保存描述并标记为已处理（一次写入，与并发处理的其他内容合并为批量写入）"""
+        await self.content_dao.update_processing_result(content["_id"], description)
 
     @abstractmethod
     async def get_content_description(self, content: Dict, language: str = "zh-TW") -> Any:
         """生成内容描述信息，由子类实现，返回對應的 DescriptionModel"""
         pass
 
-    async def get_content_analysis(self, text: str=None, image_url: str=None, language: str = "zh-TW") -> Dict:
-        """获取通用内容分析结果"""
-        if not text and not image_url:
+    async def get_content_analysis(self, text: str=None, image_url: str=None, language: str = "zh-TW", 
+                                   image_bytes: bytes = None, image_mime_type: str = "image/jpeg") -> Dict:
+        """获取通用内容分析结果（提供 image_bytes 时不再下载 image_url）"""
+        if not text and not image_url and image_bytes is None:
             raise ValueError("text 或 image_url 必須提供其中一個")
         
         if language == "zh-TW":
@@ -79,85 +256,159 @@ class ContentService(ABC):
                 }
                 Please ensure the response is in valid JSON format."""
         
-        if image_url:
-            llm_result = await self.llm_service.analyze_image(image_url, prompt, json_response=True)
-        else:
-            llm_result = await self.llm_service.analyze_text(text, prompt, json_response=True)
+        async def _analyze():
+            if image_url or image_bytes is not None:
+                return await self.llm_service.analyze_image(image_url, prompt, json_response=True, 
+                                                            image_bytes=image_bytes, mime_type=image_mime_type)
+            return await self.llm_service.analyze_text(text, prompt, json_response=True)
         
-        title = llm_result.get("title", '')
+        llm_result = await StagePipeline.run_stage(Stage("analysis", _analyze, resource="llm"))
         summary = llm_result.get("summary", '')
-        keywords = llm_result.get("keywords", [])
-        
-        if summary:
-            summary_vector = await self.llm_service.get_embedding(summary)
-        else:
-            summary_vector = []
         
         return {
-            "title": title,
+            "title": llm_result.get("title", ''),
             "summary": summary,
-            "summary_vector": summary_vector,
-            "keywords": keywords
+            "summary_vector": await self.get_embedding(summary) if summary else [],
+            "keywords": llm_result.get("keywords", [])
         }
+    
+    async def get_embedding(self, text: str) -> List[float]:
+        """获取文本向量（受 embedding 并发上限约束）
+        
+        由调度器或批处理处理的内容在等待向量化时让出处理名额，使其他内容的分析继续进行，
+        并按处理名额的 batch_window 与其他内容的向量化合并为一次请求
+        """
+        slot = ProcessingSlot.current.get()
+        window = None
+        if slot is not None:
+            slot.yield_slot()
+            window = slot.batch_window
+        
+        async def _embed(text):
+            return await self.llm_service.get_embedding(text, window=window)
+        
+        return await StagePipeline.run_stage(Stage("embedding", _embed, resource="embedding"), text=text)
 
-    async def process_batch_content(self, max_concurrency: int = 5) -> List[ObjectId]:
+    async def process_batch_content(self, max_concurrency: int = 5, lease_seconds: int = None, progress_interval: float = 30,
+                                    page_size: int = 100) -> List[ObjectId]:
         """批量处理未处理的内容
         
+        按创建时间分页读取待处理内容的ID（每页 page_size 个），同时最多处理 max_concurrency 个，内存占用与积压数量无关；
+        每个内容处理前以租约领取，可与 worker 或其他批处理同时运行而不重复处理。
+        等待向量化的内容不占用处理名额，其向量化在 backfill_embedding_window 秒内合并为批量请求
+        
         Args:
             max_concurrency: 最大并发处理数量
+            lease_seconds: 处理租约的时长
+            progress_interval: 输出处理进度的间隔秒数
+            page_size: 每次查询待处理ID的数量
         """
+        lease_seconds = lease_seconds or int(os.getenv("PROCESSING_LEASE_SECONDS", 300))
+        owner = f"batch-{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        processed_ids = []
+        in_flight = set()
+        slots = ProcessingSlots(max_concurrency, self.max_embedding_waiting)
+        stats = {"done": 0, "failed": 0, "skipped": 0}
+        
+        async def _claim_and_process(content_id, slot):
+            ProcessingSlot.current.set(slot)
+            try:
+                content = await self.claim_content(content_id, owner, lease_seconds)
+                if content is None:
+                    # 已被其他进程领取或已处理
+                    return "skipped"
+                return await self.process_claimed_content(content, owner, lease_seconds)
+            finally:
+                slot.release()
+        
+        def _collect(done_tasks):
+            for task in done_tasks:
+                # 被取消的任务调用 exception() 会抛出 CancelledError
+                if task.cancelled():
+                    stats["failed"] += 1
+                    continue
+                result = task.exception() or task.result()
+                if isinstance(result, Exception):
+                    logger.error(f"处理{self.content_type}时出错: {result}")
+                    stats["failed"] += 1
+                elif result == "skipped":
+                    stats["skipped"] += 1
+                elif result:
+                    processed_ids.append(result)
+                    stats["done"] += 1
+                else:
+                    stats["failed"] += 1
+        
         try:
-            logger.info(f"开始处理{self.content_type}内容")
-            unprocessed_contents = await self.find_unprocessed_content()
-            logger.info(f"未处理的{self.content_type}数量: {len(unprocessed_contents)}")
-            
-            if not unprocessed_contents:
-                logger.info(f"没有未处理的{self.content_type}")
+            total = await self.content_dao.count_unprocessed_documents()
+            logger.info(f"开始处理{self.content_type}内容，未处理数量: {total}")
+            if not total:
                 return []
             
-            processed_ids = []
-            # 使用信号量控制并发数量
-            semaphore = asyncio.Semaphore(max_concurrency)
-            
-            async def process_with_semaphore(content):
-                async with semaphore:
-                    return await self._process_single_content(content)
+            started_at = last_report = time.monotonic()
+            last_document = None
+            while True:
+                page = await self.content_dao.find_unprocessed_ids(limit=page_size, after=last_document)
+                if not page:
+                    break
+                last_document = page[-1]
+                for document in page:
+                    # 固定的处理窗口：名额用完时等待任一内容完成或进入向量化
+                    slot = await slots.acquire(batch_window=self.backfill_embedding_window)
+                    done = {task for task in in_flight if task.done()}
+                    in_flight -= done
+                    _collect(done)
+                    in_flight.add(asyncio.create_task(_claim_and_process(document["_id"], slot)))
+                    
+                    if time.monotonic() - last_report >= progress_interval:
+                        last_report = time.monotonic()
+                        finished = stats["done"] + stats["failed"] + stats["skipped"]
+                        rate = finished / (last_report - started_at)
+                        logger.info(f"{self.content_type}处理进度: {finished}/{total} "
+                                    f"(成功 {stats['done']}, 失败 {stats['failed']}, 跳过 {stats['skipped']}, {rate:.2f}/秒)")
             
-            # 创建所有任务
-            tasks = [process_with_semaphore(content) for content in unprocessed_contents]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
+            if in_flight:
+                done, in_flight = await asyncio.wait(in_flight)
+                _collect(done)
             
-            # 过滤有效的结果
-            processed_ids = [result for result in results 
-                             if result and not isinstance(result, Exception)]
-            
-            logger.info(f"已处理{self.content_type}: {len(processed_ids)}/{len(unprocessed_contents)}")
+            logger.info(f"已处理{self.content_type}: {stats['done']}/{total} (失败 {stats['failed']}, 跳过 {stats['skipped']})")
+            logger.info(f"各阶段耗时: {StagePipeline.get_stats()}")
             return processed_ids
             
         except Exception as e:
-            logger.error(f"批量处理{self.content_type}时出错: {e}")
-            return []
+            # 等待已开始的处理完成后抛出，不以部分结果当作全部完成
+            logger.error(f"批量处理{self.content_type}时出错，已处理 {stats['done']} 个: {e}")
+            if in_flight:
+                done, _ = await asyncio.wait(in_flight)
+                _collect(done)
+            raise
     
-    async def _process_single_content(self, content: Dict) -> Union[ObjectId, None]:
-        """处理单个内容项"""
-        try:
-            content_id = content["_id"]
-            logger.info(f"开始处理{self.content_type} ID: {content_id}")
-            
-            description = await self.get_content_description(content)
-            await self.update_content_description(content_id, description)
-            
+    async def _run_content_pipeline(self, content: Dict) -> ObjectId:
+        """生成描述并为各授权用户匹配标签后，以一次写入保存描述与处理状态；出错时抛出异常
+        
+        描述与标签的写入都经 DAO 的写入缓衝，与并发处理的其他内容合并为每个集合一次 bulk_write
+        """
+        content_id = content["_id"]
+        logger.info(f"开始处理{self.content_type} ID: {content_id}")
+        
+        async def _label(description):
             # 在內存中更新 content 對象
             content["description"] = description.model_dump()
             logger.info(f"内容{content_id} 描述: {content['description']}")
             await self.update_content_labels(content)
-            await self.update_is_processed(content_id, True)
-            logger.info(f"已完成{self.content_type}处理 ID: {content_id}")
-            return content_id
         
-        except Exception as e:
-            logger.error(f"处理{self.content_type} {content.get('_id', '未知')} 时出错: {e}")
-            return None
+        async def _save_result(description, labels):
+            # 标签写入完成后才标记为已处理，失败重试时不会留下已处理但没有标签的内容
+            await self.save_processing_result(content, description)
+        
+        pipeline = StagePipeline([
+            Stage("description", lambda: self.get_content_description(content)),
+            Stage("labels", _label, inputs=["description"]),
+            Stage("save_result", _save_result, inputs=["description", "labels"]),
+        ])
+        await pipeline.run()
+        logger.info(f"已完成{self.content_type}处理 ID: {content_id}")
+        return content_id
     
     async def update_content_labels(self, content: Dict) -> List[ObjectId]:
         """获取内容标签"""
@@ -181,14 +432,17 @@ class ContentService(ABC):
         authorized_users = content["authorized_users"]
         content_type = self.content_type
         
-        # 對於每個授權用戶，匹配其標籤
-        for user_id in authorized_users:
+        # 對於每個授權用戶，匹配其標籤（各用戶互不依賴，並行執行）
+        async def _update_user_labels(user_id):
             logger.info(f"内容{content_id} 类型: {content_type} 授权用户: {user_id}")
             labels = await self.label_application_service.match_user_labels(user_id, representative_content, content_vector)
             label_ids = [label["_id"] for label in labels]
             label_names = [label["name"] for label in labels]
             logger.info(f"用户{user_id} 内容{content_id} 标签: {label_names}")
             await self.user_content_meta_service.update_content_labels(user_id, content_id, content_type, label_ids)
+        
+        stage = Stage("user_labels", _update_user_labels)
+        await asyncio.gather(*(StagePipeline.run_stage(stage, user_id=user_id) for user_id in authorized_users))
     
     async def full_text_search(self, query_text: str, user_id: ObjectId, limit: int) -> List[Dict]:
         """全文搜索"""
@@ -1,5 +1,7 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, AsyncIterator, Optional
+import asyncio
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 import os
 
 from app.utils.logging_utils import logger
@@ -15,11 +17,12 @@ from app.service.content_service import ContentService
 from app.service.user_service import UserContentMetaService
 from app.service.text_service import TextService
 from app.infrastructure.models.text_models import TextModel
-from app.infrastructure.db.r2 import download_to_temp
 
 class FileService(ContentService):
     """文件服务，处理文件上传、存储和分析"""
     
+    processing_fields = ["file_url", "file_type", "child_texts", "text_extraction"]
+
     def __init__(self):
         super().__init__()
         self.content_type = "file"
@@ -27,18 +30,42 @@ class FileService(ContentService):
         self.text_dao = TextDAO()
         self.text_service = TextService()
         self.user_content_meta_service = UserContentMetaService()
+        # 同时创建的页面文本数量，每完成一批写入一次检查点
+        self.page_batch_size = int(os.getenv("FILE_PAGE_BATCH_SIZE", 10))
+    
+    async def create_content(self, file_name: str, file_stream: AsyncIterator[bytes], file_type: str, uploader_id: ObjectId, 
+                             authorized_users: list[ObjectId], upload_metadata: Dict[str, Any], storage_name: str = None, content_type: str = None):
+        """上传文件的通用方法（以串流方式直接写入R2）
+        
+        Args:
+            file_name: 原始文件名，作为文件标题
+            file_stream: 文件内容的异步迭代器
+            storage_name: R2中使用的文件名，默认与 file_name 相同
+        """
+        # 步骤1: 上传文件到R2（内容定址，同时计算内容哈希）
+        upload_result = await self.r2_storage.upload_stream(file_stream, uploader_id, storage_name or file_name, content_type, 
+                                                            content_addressed=True)
+        return await self.create_uploaded_content(upload_result, file_name, file_type, uploader_id, authorized_users, upload_metadata)
     
-    async def create_content(self, file_name: str, file_path: str, file_type: str, uploader_id: ObjectId, 
-                             authorized_users: list[ObjectId], upload_metadata: Dict[str, Any]):
-        """上传文件的通用方法"""
+    async def create_uploaded_content(self, upload_result: Dict[str, Any], file_name: str, file_type: str, uploader_id: ObjectId, 
+                                      authorized_users: list[ObjectId], upload_metadata: Dict[str, Any]):
+        """为已上传到R2的文件创建文件记录与User Content Metadata
+        
+        Args:
+            upload_result: 上传结果（url、object_key、file_size、content_hash、created），浏览器直传的文件没有 content_hash，
+                以 upload_key 识别重复完成的同一上传
+        """
         file_id = None
-        object_key = None
         
         try:
-            # 步骤1: 上传文件到R2
-            upload_result = await self.r2_storage.upload(file_path, uploader_id)
             file_url = upload_result["url"]
-            object_key = upload_result["object_key"]
+            
+            # 相同内容（或同一直传上传）已存在时直接复用，只追加授权用户
+            existing_file = await self._find_existing_upload(upload_result)
+            if existing_file:
+                await self._discard_duplicate_object(upload_result, existing_file)
+                file_ids = await self.share_existing_contents([existing_file], authorized_users)
+                return file_ids[0]
             
             # 步骤2: 创建文件记录
             file_data = FileModel(
@@ -47,11 +74,21 @@ class FileService(ContentService):
                     file_url=file_url,
                     authorized_users=authorized_users,
                     uploader=uploader_id,
-                    file_size=os.path.getsize(file_path),
+                    file_size=upload_result["file_size"],
+                    content_hash=upload_result.get("content_hash"),
+                    upload_key=upload_result.get("upload_key"),
                     metadata=MetadataModel(**upload_metadata),
                     description=FileDescriptionModel()
                 )
-            file_id = await self.content_dao.insert_one(file_data)
+            try:
+                file_id = await self.content_dao.insert_one(file_data)
+            except DuplicateKeyError:
+                # 并发上传了相同内容，复用先写入的记录
+                existing_file = await self._find_existing_upload(upload_result)
+                if existing_file is None:
+                    raise
+                file_ids = await self.share_existing_contents([existing_file], authorized_users)
+                return file_ids[0]
             
             # 步骤3: 创建User Content Metadata
             await self.user_content_meta_service.create_content_meta(
@@ -71,46 +108,110 @@ class FileService(ContentService):
                 except Exception as cleanup_error:
                     logger.error(f"清理文件记录时出错: {cleanup_error}")
             
-            # 删除R2存储的文件
-            if object_key:
+            # 删除本次新建的R2文件（内容定址的文件可能被其他记录引用，已存在的不删除）
+            if upload_result.get("created"):
                 try:
-                    logger.error(f"删除R2文件: {object_key}, 错误: {e}")
-                    await self.r2_storage.delete(object_key)
+                    logger.error(f"删除R2文件: {upload_result['object_key']}, 错误: {e}")
+                    await self.r2_storage.delete(upload_result["object_key"])
                 except Exception as cleanup_error:
                     logger.error(f"清理R2文件时出错: {cleanup_error}")
+            raise
+    
+    async def _find_existing_upload(self, upload_result: Dict[str, Any]) -> Optional[Dict]:
+        """查找内容哈希相同或同一直传上传已创建的文件记录"""
+        existing_files = await self.find_contents_by_hash([upload_result.get("content_hash")])
+        if existing_files:
+            return existing_files[upload_result["content_hash"]]
+        existing_files = await self.find_contents_by_upload_keys([upload_result.get("upload_key")])
+        return existing_files.get(upload_result.get("upload_key"))
     
-    async def _process_file_text(self, file_url: str, file_type: str, uploader_id: ObjectId, authorized_users: list[ObjectId], upload_metadata: Dict[str, Any],
-                              file_id: ObjectId):
-        """处理文件文本提取，根据文件类型调用不同的处理函数"""
-        text_ids = []
-        url_ids = []
+    async def share_existing_contents(self, contents: List[Dict], authorized_users: list[ObjectId]) -> List[ObjectId]:
+        """复用已存在的文件时，一并为已提取的页面文本追加授权用户"""
+        file_ids = await super().share_existing_contents(contents, authorized_users)
+        child_texts = await self.text_dao.find({"parent_file": {"$in": file_ids}})
+        if child_texts:
+            await self.text_service.share_existing_contents(child_texts, authorized_users)
+        return file_ids
+    
+    async def ensure_processing_indexes(self):
+        """建立处理索引，并在清理重复的页面文本后建立 (parent_file, file_page_num) 唯一索引"""
+        await super().ensure_processing_indexes()
+        removed = await self.remove_duplicate_page_texts()
+        if removed:
+            logger.warning(f"已清理 {removed} 个重复的文件页面文本")
+        await self.text_dao.ensure_page_index()
+        await self.text_service.url_service.content_dao.ensure_page_index()
+    
+    async def remove_duplicate_page_texts(self) -> int:
+        """删除同一文件同一页码的重复页面文本（连同其URL与User Content Metadata），返回删除的数量
+        
+        每组保留文件 child_texts 中引用的页面（多个时取最新），都未被引用时保留最新的页面
+        """
+        groups = await self.text_dao.find_duplicate_page_texts()
+        if not groups:
+            return 0
         
-        # 根据文件类型选择不同的处理方法
+        file_ids = list({group["_id"]["parent_file"] for group in groups})
+        files = await self.content_dao.find({"_id": {"$in": file_ids}}, projection={"child_texts": 1})
+        referenced_ids = {text_id for file in files for text_id in file.get("child_texts") or []}
+        
+        removed = 0
+        for group in groups:
+            pages = group["pages"]
+            kept = next((page for page in reversed(pages) if page["_id"] in referenced_ids), pages[-1])
+            duplicates = [page for page in pages if page["_id"] != kept["_id"]]
+            await self.text_service.delete_texts(duplicates)
+            await self.content_dao.remove_child_texts(group["_id"]["parent_file"], [page["_id"] for page in duplicates])
+            removed += len(duplicates)
+        return removed
+    
+    async def _get_file_pages(self, file_url: str, file_type: str, start_page: int = 1) -> List[str]:
+        """根据文件类型提取从 start_page 开始的各页文本，不支持的类型返回 None"""
         if file_type.lower() == "pdf":
-            file_texts = await self._get_pdf_content(file_url)
+            return await self._get_pdf_content(file_url, start_page)
         elif file_type.lower() in ["docx", "doc"]:
-            file_texts = await self._get_word_content(file_url)
+            return (await self._get_word_content(file_url))[start_page - 1:]
         elif file_type.lower() in ["txt", "md"]:
-            file_texts = await self._get_text_content(file_url)
-        else:
-            # 不支持的文件类型
-            logger.warning(f"不支持的文件类型: {file_type}")
+            return (await self._get_text_content(file_url))[start_page - 1:]
+        logger.warning(f"不支持的文件类型: {file_type}")
+        return None
+    
+    async def _process_file_text(self, content: Dict, upload_metadata: Dict[str, Any]) -> List[str]:
+        """提取文件各页文本并创建文本记录，返回本次提取的页面文本
+        
+        页面以 (parent_file, file_page_num) 为键 upsert，每完成一批页面就将其文本ID与已完成的页数写入文件记录（检查点）；
+        处理中断后从检查点之后的页面继续，检查点之后已写入的页面沿用原有记录，不会重复创建
+        """
+        file_id = content["_id"]
+        completed_pages = (content.get("text_extraction") or {}).get("completed_pages", 0)
+        if completed_pages:
+            logger.info(f"文件 {file_id} 从第 {completed_pages + 1} 页继续提取文本")
+        
+        file_texts = await self._get_file_pages(content["file_url"], content.get("file_type", ""), start_page=completed_pages + 1)
+        if file_texts is None:
+            # 不支持的文件类型，不再重复尝试提取
+            await self.content_dao.checkpoint_text_extraction(file_id, [], completed_pages, completed_pages)
+            return []
+        
+        total_pages = completed_pages + len(file_texts)
+        if not file_texts:
+            await self.content_dao.checkpoint_text_extraction(file_id, [], completed_pages, total_pages)
             return []
         
-        # 创建文本模型
-        for i in range(len(file_texts)):
-            result = await self.text_service.create_content(
-                text=file_texts[i],
-                authorized_users=authorized_users,
-                uploader_id=uploader_id,
-                upload_metadata=upload_metadata,
-                parent_file=file_id,
-                file_page_num=i+1
+        for batch_start in range(0, len(file_texts), self.page_batch_size):
+            batch = file_texts[batch_start:batch_start + self.page_batch_size]
+            first_page = completed_pages + batch_start + 1
+            # 纯URL的页面没有文本记录
+            text_ids = await self.text_service.upsert_page_texts(
+                file_id,
+                {first_page + i: page_text for i, page_text in enumerate(batch)},
+                uploader_id=content.get("uploader"),
+                authorized_users=content.get("authorized_users", []),
+                upload_metadata=upload_metadata
             )
-            text_ids.append(result["text_id"])
-            url_ids.extend(result["url_ids"])
-            
-        return text_ids, file_texts
+            await self.content_dao.checkpoint_text_extraction(file_id, text_ids, first_page + len(batch) - 1, total_pages)
+        
+        return file_texts
     
     async def get_file_child_texts(self, file_id: ObjectId) -> List[str]:
         """获取文件中的文本内容"""
@@ -120,21 +221,22 @@ class FileService(ContentService):
         """获取文件描述"""
         file_id = content["_id"]
         file_url = content.get("file_url")
-        file_type = content.get("file_type", "")
-        uploader_id = content.get("uploader")
-        authorized_users = content.get("authorized_users", [])
         
         upload_metadata = {
             "upload_source": content.get("metadata", {}).get("upload_source", ""),
             "line_group_id": content.get("metadata", {}).get("line_group_id", "")
         }
         
-        # 確認文件是否已處理，若無則處理
-        text_ids = content.get("child_texts", [])
-        if not text_ids and file_url:
-            # 處理文本提取並關聯到文件
-            text_ids, file_texts = await self._process_file_text(file_url, file_type, uploader_id, authorized_users, upload_metadata, file_id)
-            await self.content_dao.update_child_texts(file_id, text_ids)
+        # 確認文件文本是否已提取完成（舊資料只有 child_texts），若未完成則從檢查點繼續
+        text_extraction = content.get("text_extraction") or {}
+        is_extracted = text_extraction.get("is_completed") or (content.get("child_texts") and not text_extraction)
+        file_texts = []
+        if not is_extracted and file_url:
+            file_texts = await self._process_file_text(content, upload_metadata)
+        
+        # 本次只提取了部分頁面（或之前已提取）時，從文本記錄讀取全部頁面
+        if is_extracted or text_extraction.get("completed_pages"):
+            file_texts = await self.get_file_child_texts(file_id)
         
         file_text = '\n'.join(file_texts)[:10000]  # 限制不超过10000字，避免Token超限
 
@@ -147,18 +249,11 @@ class FileService(ContentService):
             keywords=analysis_result["keywords"],
         )
     
-    async def _get_pdf_content(self, file_url: str) -> List[str]:
-        """从URL提取PDF内容"""
-        # 从URL下载临时文件
-        temp_file_path = await download_to_temp(file_url)
-        try:
-            # 提取PDF内容
-            pages_texts = extract_pdf_content(temp_file_path)
-            return pages_texts
-        finally:
-            # 清理临时文件
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
+    async def _get_pdf_content(self, file_url: str, start_page: int = 1) -> List[str]:
+        """从URL提取PDF内容（小文件直接在内存中解析，超大文件才暂存到磁盘），只提取 start_page 及之后的页面"""
+        async with self.r2_storage.open_stream(file_url) as pdf_object:
+            return await asyncio.to_thread(extract_pdf_content, pdf_path=pdf_object.path, pdf_stream=pdf_object.data,
+                                           start_page=start_page)
     
     async def _get_word_content(self, file_url: str) -> List[str]:
         """从URL提取Word文档内容"""
@@ -168,14 +263,7 @@ class FileService(ContentService):
     
     async def _get_text_content(self, file_url: str) -> List[str]:
         """从URL提取纯文本内容"""
-        # 从URL下载临时文件
-        temp_file_path = await download_to_temp(file_url)
-        try:
-            with open(temp_file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            # 将文本内容作为单页返回
-            return [content]
-        finally:
-            # 清理临时文件
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
\ No newline at end of file
+        async with self.r2_storage.open_stream(file_url) as text_object:
+            content = text_object.read().decode("utf-8")
+        # 将文本内容作为单页返回
+        return [content]
@@ -1,106 +1,317 @@
 import os
+import asyncio
+import numpy as np
 from bson import ObjectId
+from cachetools import TTLCache
+from pymongo.errors import BulkWriteError
 from app.infrastructure.external.GoogleDocumentAI_service import GoogleDocumentAIService
 from app.utils.logging_utils import logger
 from app.infrastructure.daos.image_daos import ImageDAO
 from app.infrastructure.models.image_models import ImageDescriptionModel, ImageModel
 from app.infrastructure.models.base_models import MetadataModel
-from typing import Dict, Any
+from app.utils.image_utils import compute_dhash, create_image_variants, strip_image_metadata
+from app.utils.format_utils import detect_file_type
+from app.utils.math_utils import hamming_distances
+from app.utils.pipeline_utils import Stage, StagePipeline
+from typing import Dict, Any, AsyncIterator, List, Optional
 
 from app.service.content_service import ContentService
 from app.service.user_service import UserContentMetaService
 
+class PerceptualHashIndex:
+    """按用户缓存已处理图像的感知哈希（int64 数组），以向量化的汉明距离查找近似重复图像"""
+    _cache = TTLCache(maxsize=int(os.getenv("IMAGE_HASH_INDEX_SIZE", 1000)), ttl=int(os.getenv("IMAGE_HASH_INDEX_TTL", 600)))
+    
+    def __init__(self, max_distance: int = None):
+        self.image_dao = ImageDAO()
+        self.max_distance = max_distance if max_distance is not None else int(os.getenv("IMAGE_NEAR_DUPLICATE_DISTANCE", 6))
+    
+    async def _get_user_index(self, user_id: ObjectId):
+        index = self._cache.get(user_id)
+        if index is None:
+            images = await self.image_dao.find_processed_perceptual_hashes(user_id)
+            index = ([image["_id"] for image in images], 
+                     np.array([image["perceptual_hash"] for image in images], dtype=np.int64))
+            self._cache[user_id] = index
+        return index
+    
+    async def find_nearest(self, perceptual_hash: int, user_ids: list[ObjectId], exclude_id: ObjectId = None):
+        """在指定用户可见的已处理图像中查找最接近的图像，距离超过阈值时返回 None"""
+        best_id, best_distance = None, self.max_distance + 1
+        for user_id in user_ids:
+            image_ids, hashes = await self._get_user_index(user_id)
+            if not image_ids:
+                continue
+            distances = hamming_distances(perceptual_hash, hashes)
+            for i in np.argsort(distances, kind="stable")[:2]:  # 最多跳过自身一次
+                if image_ids[i] != exclude_id and distances[i] < best_distance:
+                    best_id, best_distance = image_ids[i], int(distances[i])
+                    break
+        return (best_id, best_distance) if best_id is not None else None
+    
+    @classmethod
+    def add(cls, image_id: ObjectId, perceptual_hash: int, user_ids: list[ObjectId]):
+        """图像处理完成后加入已缓存的用户索引"""
+        for user_id in user_ids:
+            index = cls._cache.get(user_id)
+            if index is not None and image_id not in index[0]:
+                cls._cache[user_id] = (index[0] + [image_id], np.append(index[1], np.int64(perceptual_hash)))
+
 class ImageService(ContentService):
     """图像服务，处理图像上传、存储和分析"""
     
+    processing_fields = ["file_url", "model_input_url", "thumbnail_url", "perceptual_hash", "upload_key"]
+
     def __init__(self):
         super().__init__()
         self.content_type = "image"
         self.content_dao = ImageDAO()
         self.user_content_meta_service = UserContentMetaService()
         self.google_document_service = GoogleDocumentAIService()
+        self.perceptual_hash_index = PerceptualHashIndex()
+        self.model_input_max_edge = int(os.getenv("IMAGE_MODEL_MAX_EDGE", 1568))
+        self.thumbnail_edge = int(os.getenv("IMAGE_THUMBNAIL_EDGE", 400))
+    
+    async def create_content(self, file_stream: AsyncIterator[bytes], file_name: str, uploader_id: ObjectId, authorized_users: list[ObjectId], 
+                             upload_metadata: Dict[str, Any] = None, content_type: str = None) -> Dict[str, Any]:
+        """上传图像（以串流方式直接写入R2）"""
+        upload_result = await self.upload_object(file_stream, file_name, uploader_id, content_type)
+        image_ids = await self.create_contents([upload_result], uploader_id, authorized_users, upload_metadata)
+        return {
+            "image_id": image_ids[0],
+            "file_url": upload_result["url"],
+            "thumbnail_url": upload_result.get("thumbnail_url", ''),
+            "object_key": upload_result["object_key"]
+        }
+    
+    async def upload_object(self, file_stream: AsyncIterator[bytes], file_name: str, uploader_id: ObjectId, content_type: str = None) -> Dict[str, Any]:
+        """上传图像文件到R2存储，返回上传结果（url、object_key、file_size、file_name、perceptual_hash、派生图像的URL）
+        
+        原图的公开URL会返回给客户端，上传前先去除EXIF（GPS位置等），内容哈希以去除后的内容计算
+        """
+        image_bytes = bytearray()
+        async for chunk in file_stream:
+            image_bytes.extend(chunk)
+        image_bytes = await self._strip_metadata(bytes(image_bytes))
+        
+        async def _chunks():
+            yield image_bytes
+        
+        upload_result = await self.r2_storage.upload_stream(_chunks(), uploader_id, file_name, content_type, content_addressed=True)
+        upload_result["file_name"] = file_name
+        perceptual_hash, variants = await self._create_variants(image_bytes)
+        upload_result["perceptual_hash"] = perceptual_hash
+        upload_result.update(await self._upload_variants(variants, uploader_id, file_name))
+        return upload_result
+    
+    async def _strip_metadata(self, image_bytes: bytes) -> bytes:
+        """在线程池中去除原图的EXIF，原图不含EXIF或无法处理时返回原内容"""
+        try:
+            stripped = await asyncio.to_thread(strip_image_metadata, image_bytes)
+        except Exception as e:
+            logger.warning(f"去除图像EXIF失败，保留原图: {e}")
+            return image_bytes
+        return stripped or image_bytes
+    
+    async def _create_variants(self, image_bytes: bytes):
+        """在线程池中计算感知哈希并生成派生图像，失败的部分返回 None / 空字典"""
+        try:
+            perceptual_hash = await asyncio.to_thread(compute_dhash, image_bytes)
+        except Exception as e:
+            logger.warning(f"计算图像感知哈希失败: {e}")
+            perceptual_hash = None
+        try:
+            variants = await asyncio.to_thread(create_image_variants, image_bytes, self.model_input_max_edge, self.thumbnail_edge)
+        except Exception as e:
+            logger.warning(f"生成派生图像失败，沿用原图: {e}")
+            variants = {}
+        return perceptual_hash, variants
+    
+    async def _upload_variants(self, variants: Dict[str, bytes], uploader_id: ObjectId, file_name: str) -> Dict[str, Any]:
+        """上传去除EXIF、限制尺寸的模型输入版本与WebP缩略图，失败时沿用原图"""
+        result = {"model_input_url": '', "thumbnail_url": '', "derived_objects": []}
+        base_name = os.path.splitext(file_name)[0]
+        for variant, url_field in (("model_input", "model_input_url"), ("thumbnail", "thumbnail_url")):
+            data = variants.get(variant)
+            if not data:
+                continue
+            async def _chunks(data=data):
+                yield data
+            try:
+                variant_result = await self.r2_storage.upload_stream(_chunks(), uploader_id, f"{base_name}_{variant}.webp", "image/webp", content_addressed=True)
+            except Exception as e:
+                logger.warning(f"上传派生图像 {variant} 失败，沿用原图: {e}")
+                continue
+            result[url_field] = variant_result["url"]
+            result["derived_objects"].append(variant_result)
+        return result
     
-    async def create_content(self, file_path: str, uploader_id: ObjectId, authorized_users: list[ObjectId], upload_metadata: Dict[str, Any] = None) -> Dict[str, Any]:
-        """上传图像"""
-        upload_result = None
-        image_id = None
+    async def create_contents(self, upload_results: List[Dict[str, Any]], uploader_id: ObjectId, authorized_users: list[ObjectId], 
+                              upload_metadata: Dict[str, Any] = None) -> List[ObjectId]:
+        """为已上传到R2的图像批量创建图像记录与User Content Metadata（各一次 insert_many）
+        
+        内容哈希相同的图像已存在时直接复用，只追加授权用户；返回的ID与 upload_results 一一对应
+        （浏览器直传的图像没有内容哈希，以 object_key 区分：不参与去重，重复完成同一上传时返回已创建的记录）
+        """
+        def _dedup_key(upload_result):
+            return upload_result.get("content_hash") or upload_result["object_key"]
         
+        image_ids = []
         try:
-            # 步骤1: 上传文件到R2存储
-            upload_result = await self.r2_storage.upload(file_path, uploader_id)
-            file_url = upload_result["url"]
-            object_key = upload_result["object_key"]
+            # 步骤1: 查找内容相同的已存在图像
+            content_hashes = list({upload_result.get("content_hash") for upload_result in upload_results})
+            existing_images = await self.find_contents_by_hash(content_hashes)
+            existing_images.update(await self.find_contents_by_upload_keys([upload_result.get("upload_key") for upload_result in upload_results]))
+            
+            # 同一批中的重复图像只创建一次
+            new_results = {}
+            for upload_result in upload_results:
+                dedup_key = _dedup_key(upload_result)
+                if dedup_key in existing_images:
+                    await self._discard_duplicate_object(upload_result, existing_images[dedup_key])
+                elif dedup_key not in new_results:
+                    new_results[dedup_key] = upload_result
             
-            # 步骤2: 创建图像记录
-            image_data = ImageModel(
-                file_url=file_url, 
-                authorized_users=authorized_users,
-                uploader=uploader_id,
-                file_size=os.path.getsize(file_path),
-                file_type=os.path.splitext(file_path)[1].lstrip('.'),
-                metadata=MetadataModel(**upload_metadata),
-                description=ImageDescriptionModel(),
-            )
-            image_id = await self.content_dao.insert_one(image_data)
+            # 步骤2: 批量创建图像记录
+            id_by_hash = {}
+            if new_results:
+                new_ids = [ObjectId() for _ in new_results]
+                id_by_hash = dict(zip(new_results.keys(), new_ids))
+                image_models = [
+                    ImageModel(
+                        file_url=upload_result["url"], 
+                        authorized_users=authorized_users,
+                        uploader=uploader_id,
+                        file_size=upload_result["file_size"],
+                        file_type=os.path.splitext(upload_result["file_name"])[1].lstrip('.'),
+                        content_hash=upload_result.get("content_hash"),
+                        upload_key=upload_result.get("upload_key"),
+                        perceptual_hash=upload_result.get("perceptual_hash"),
+                        model_input_url=upload_result.get("model_input_url", ''),
+                        thumbnail_url=upload_result.get("thumbnail_url", ''),
+                        metadata=MetadataModel(**(upload_metadata or {})),
+                        description=ImageDescriptionModel(),
+                    )
+                    for upload_result in new_results.values()
+                ]
+                try:
+                    image_ids = await self.content_dao.insert_many(image_models, document_ids=new_ids, ordered=False)
+                except BulkWriteError as e:
+                    # 并发上传了相同内容：唯一索引冲突的图像改为复用先写入的记录
+                    write_errors = e.details.get("writeErrors", [])
+                    if any(error.get("code") != 11000 for error in write_errors):
+                        raise
+                    duplicated_hashes = [list(new_results.keys())[error["index"]] for error in write_errors]
+                    for content_hash in duplicated_hashes:
+                        id_by_hash.pop(content_hash)
+                    image_ids = list(id_by_hash.values())
+                    existing_images.update(await self.find_contents_by_hash(duplicated_hashes))
+                    existing_images.update(await self.find_contents_by_upload_keys(duplicated_hashes))
+                
+                # 步骤3: 创建User Content Metadata
+                if image_ids:
+                    await self.user_content_meta_service.create_content_meta(
+                        content_type="image",
+                        content_ids=image_ids,
+                        user_ids=authorized_users
+                    )
             
-            # 步骤3: 创建User Content Metadata
-            await self.user_content_meta_service.create_content_meta(
-                content_type="image",
-                content_ids=[image_id],
-                user_ids=authorized_users
-            )
+            # 步骤4: 已存在的图像只追加授权用户
+            reused_images = {dedup_key: image for dedup_key, image in existing_images.items() if dedup_key not in id_by_hash}
+            if reused_images:
+                await self.share_existing_contents(list(reused_images.values()), authorized_users)
+                id_by_hash.update({dedup_key: image["_id"] for dedup_key, image in reused_images.items()})
             
-            return {
-                "image_id": image_id,
-                "file_url": file_url,
-                "object_key": object_key
-            }
+            return [id_by_hash[_dedup_key(upload_result)] for upload_result in upload_results]
             
         except Exception as e:
             # 统一的资源清理逻辑
-            await self._cleanup_resources(upload_result, image_id, e)
+            await self._cleanup_resources(upload_results, image_ids, e)
             raise e
     
-    async def _cleanup_resources(self, upload_result, image_id, error):
+    async def _cleanup_resources(self, upload_results, image_ids, error):
         """清理上传过程中创建的资源"""
         # 记录错误
         logger.error(f"图像上传过程中出错: {error}")
         
         # 清理已上传的R2文件
-        if upload_result and "object_key" in upload_result:
-            object_key = upload_result["object_key"]
-            logger.info(f"清理R2文件: {object_key}")
-            try:
-                await self.r2_storage.delete(object_key)
-            except Exception as delete_error:
-                logger.error(f"清理R2文件时出错: {delete_error}")
+        for upload_result in upload_results or []:
+            if not upload_result:
+                continue
+            # 内容定址的文件可能被其他记录引用，只清理本次新建的（包括派生图像）
+            for uploaded in [upload_result] + upload_result.get("derived_objects", []):
+                if "object_key" in uploaded and uploaded.get("created", True):
+                    object_key = uploaded["object_key"]
+                    logger.info(f"清理R2文件: {object_key}")
+                    try:
+                        await self.r2_storage.delete(object_key)
+                    except Exception as delete_error:
+                        logger.error(f"清理R2文件时出错: {delete_error}")
         
         # 清理已创建的图像记录
-        if image_id:
-            logger.info(f"清理图像记录: {image_id}")
+        if image_ids:
+            logger.info(f"清理图像记录: {image_ids}")
             try:
-                await self.content_dao.delete_one(image_id)
+                await self.content_dao.delete_many(image_ids)
             except Exception as delete_error:
                 logger.error(f"清理图像记录时出错: {delete_error}")
     
+    async def _discard_duplicate_object(self, upload_result: Dict[str, Any], existing_content: Dict):
+        """同时删除已存在记录未引用的派生图像"""
+        await super()._discard_duplicate_object(upload_result, existing_content)
+        referenced_urls = {existing_content.get("model_input_url"), existing_content.get("thumbnail_url")}
+        for derived in upload_result.get("derived_objects", []):
+            if derived.get("created") and derived["url"] not in referenced_urls:
+                await self.r2_storage.delete(derived["object_key"])
+    
     async def get_content_description(self, content: Dict, language: str = "zh-TW") -> ImageDescriptionModel:
-        async def _get_image_ocr_text(image_url: str):
+        async def _get_image_ocr_text(image_url: str, image_bytes: bytes, mime_type: str):
             """获取图像的OCR文本"""
             try:    
-                document = await self.google_document_service.process_document_from_url(image_url)
+                if image_bytes is not None:
+                    document = await self.google_document_service.process_document_from_bytes(image_bytes, mime_type)
+                else:
+                    document = await self.google_document_service.process_document_from_url(image_url)
                 return self.google_document_service.extract_document_text(document)
             except Exception as e:
                 logger.error(f"获取OCR文本时出错: {e}")
                 return None
         
         """获取图像描述"""
-        image_url = content["file_url"]
+        # OCR与视觉模型使用去除EXIF、限制尺寸后的版本，旧记录没有时使用原图
+        image_url = content.get("model_input_url") or content["file_url"]
+        
+        # 近似重复的图像直接沿用已处理图像的描述，不再调用OCR与视觉模型
+        near_duplicate_description = await self._get_near_duplicate_description(content)
+        if near_duplicate_description:
+            return near_duplicate_description
+        
+        async def _load_image():
+            # 图像只读取一次（优先使用本地缓存），OCR与图像分析共用
+            image_bytes, mime_type = await self._fetch_image_bytes(image_url)
+            # 浏览器直传的图像未经服务器读取，在此补生成派生图像
+            if image_bytes is not None and not content.get("thumbnail_url"):
+                model_input_bytes, model_input_url = await self._backfill_derived_fields(content, image_bytes)
+                if model_input_bytes:
+                    return model_input_bytes, "image/webp", model_input_url
+            return image_bytes, mime_type, image_url
+        
+        async def _ocr(image):
+            image_bytes, mime_type, url = image
+            return await _get_image_ocr_text(url, image_bytes, mime_type)
         
-        # 获取OCR文本
-        ocr_text = await _get_image_ocr_text(image_url)
+        async def _analysis(image):
+            image_bytes, mime_type, url = image
+            return await self.get_content_analysis(image_url=url, language=language, 
+                                                   image_bytes=image_bytes, image_mime_type=mime_type)
         
-        # 获取图像分析结果
-        analysis_result = await self.get_content_analysis(image_url=image_url, language=language)
+        # OCR与图像分析互不依赖，并行执行
+        results = await StagePipeline([
+            Stage("image", _load_image, resource="r2"),
+            Stage("ocr", _ocr, inputs=["image"], resource="ocr"),
+            Stage("image_analysis", _analysis, inputs=["image"]),
+        ]).run()
+        ocr_text, analysis_result = results["ocr"], results["image_analysis"]
         
         return ImageDescriptionModel(
             auto_title=analysis_result.get("title", ''),
@@ -110,4 +321,78 @@ class ImageService(ContentService):
             keywords=analysis_result.get("keywords", [])
         )
     
-    
\ No newline at end of file
+    async def _backfill_derived_fields(self, content: Dict, image_bytes: bytes):
+        """为没有派生图像的记录补生成感知哈希、模型输入版本与缩略图，返回 (模型输入版本内容, URL)
+        
+        原图含EXIF时（浏览器直传的图像未经服务器读取）另存去除EXIF的版本替换 file_url，并删除直传的原物件
+        """
+        try:
+            file_name = os.path.basename(content["file_url"])
+            file_url = await self._replace_original(content, image_bytes)
+            perceptual_hash, variants = await self._create_variants(image_bytes)
+            uploaded = await self._upload_variants(variants, content["uploader"], file_name)
+            await self.content_dao.update_derived_fields(content["_id"], perceptual_hash, uploaded["model_input_url"], uploaded["thumbnail_url"],
+                                                         file_url=file_url)
+            content["perceptual_hash"] = perceptual_hash
+            if uploaded["model_input_url"]:
+                return variants["model_input"], uploaded["model_input_url"]
+        except Exception as e:
+            logger.warning(f"补生成派生图像失败: {e}")
+        return None, None
+    
+    async def _replace_original(self, content: Dict, image_bytes: bytes) -> Optional[str]:
+        """原图含EXIF时上传去除EXIF的版本，返回新的原图URL；原图不含EXIF时返回 None"""
+        stripped = await self._strip_metadata(image_bytes)
+        if stripped is image_bytes:
+            return None
+        
+        async def _chunks():
+            yield stripped
+        
+        old_url = content["file_url"]
+        _, mime_type = detect_file_type(stripped[:16])
+        upload_result = await self.r2_storage.upload_stream(_chunks(), content["uploader"], os.path.basename(old_url), mime_type, content_addressed=True)
+        content["file_url"] = upload_result["url"]
+        # 直传的原物件只属于这条记录；内容定址的物件可能被其他记录共用，保留不删除
+        old_key = self.r2_storage.object_key_from_url(old_url)
+        if content.get("upload_key") == old_key:
+            try:
+                await self.r2_storage.delete(old_key)
+            except Exception as e:
+                logger.warning(f"删除含EXIF的直传原图 {old_key} 失败: {e}")
+        return upload_result["url"]
+    
+    async def _fetch_image_bytes(self, image_url: str):
+        """从R2（或本地缓存）读取图像内容，失败时返回 (None, None)，由各阶段改为按URL下载"""
+        try:
+            image_bytes = bytes(await self.r2_storage.fetch_bytes(image_url))
+            _, mime_type = detect_file_type(image_bytes[:16])
+            return image_bytes, mime_type or "image/jpeg"
+        except Exception as e:
+            logger.warning(f"读取图像内容失败，改为按URL下载: {e}")
+            return None, None
+    
+    async def _get_near_duplicate_description(self, content: Dict) -> ImageDescriptionModel:
+        """查找授权用户已有的近似重复图像，返回其描述；没有时返回 None"""
+        perceptual_hash = content.get("perceptual_hash")
+        if perceptual_hash is None:
+            return None
+        try:
+            match = await self.perceptual_hash_index.find_nearest(perceptual_hash, content.get("authorized_users", []), exclude_id=content["_id"])
+            if match is None:
+                return None
+            image_id, distance = match
+            images = await self.content_dao.find({"_id": image_id, "metadata.is_processed": True}, projection={"description": 1})
+            if not images:
+                return None
+            logger.info(f"图像 {content['_id']} 与已处理图像 {image_id} 近似重复（距离 {distance}），沿用其描述")
+            return ImageDescriptionModel(**images[0]["description"])
+        except Exception as e:
+            logger.error(f"查找近似重复图像时出错: {e}")
+            return None
+    
+    async def save_processing_result(self, content: Dict, description: Any):
+        """保存处理结果，处理完成的图像加入感知哈希索引"""
+        await super().save_processing_result(content, description)
+        if content.get("perceptual_hash") is not None:
+            PerceptualHashIndex.add(content["_id"], content["perceptual_hash"], content.get("authorized_users", []))
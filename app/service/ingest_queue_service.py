@@ -0,0 +1,202 @@
+import os
+import uuid
+import socket
+import asyncio
+from typing import Dict, Any, List, Tuple, Callable, Awaitable
+
+from app.infrastructure.daos.ingest_job_daos import IngestJobDAO
+from app.infrastructure.models.ingest_job_models import IngestJobModel
+from app.utils.logging_utils import logger
+
+class IngestQueueService:
+    """持久化的上传任务队列
+
+    任务先写入 IngestJobs 集合，再由固定数量的异步 worker 拉取执行：
+    - 入队只需一次数据库写入，与积压深度无关
+    - worker 数量固定，积压留在数据库中，不会一次性创建大量协程
+    - 任务以租约方式领取，进程中断后未完成的任务会在租约过期后被重新领取
+    - 处理函数可返回 asyncio.Future（如等待合并写入的批次），worker 立即领取下一个任务，
+      Future 完成后再标记任务完成，失败时照常重试
+    """
+
+    def __init__(self, num_workers: int = None, lease_seconds: int = None, max_attempts: int = 3, poll_interval: float = 5.0):
+        self.job_dao = IngestJobDAO()
+        self.num_workers = num_workers or int(os.getenv("INGEST_WORKERS", 8))
+        self.lease_seconds = lease_seconds or int(os.getenv("INGEST_LEASE_SECONDS", 300))
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._handlers: Dict[str, Callable[..., Awaitable[Any]]] = {}
+        self._single_use_fields: Dict[str, Tuple[str, ...]] = {}
+        self._workers: List[asyncio.Task] = []
+        self._deferred = set()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        # 进程内计数
+        self._in_flight = 0
+        self._completed_count = 0
+        self._failed_count = 0
+
+    def register_handler(self, job_type: str, handler: Callable[..., Awaitable[Any]], single_use_fields: Tuple[str, ...] = ()):
+        """注册任务处理函数，处理函数以 payload 作为关键字参数调用
+        
+        single_use_fields: 只能使用一次的 payload 字段（如 LINE 的 reply token），重试时以 None 传入
+        """
+        self._handlers[job_type] = handler
+        self._single_use_fields[job_type] = tuple(single_use_fields)
+
+    async def enqueue(self, job_type: str, payload: Dict[str, Any]):
+        """加入单个任务"""
+        job_ids = await self.enqueue_many([(job_type, payload)])
+        return job_ids[0]
+
+    async def enqueue_many(self, jobs: List[Tuple[str, Dict[str, Any]]]):
+        """批量加入任务，只进行一次数据库写入"""
+        if not jobs:
+            return []
+        job_models = [IngestJobModel(job_type=job_type, payload=payload) for job_type, payload in jobs]
+        job_ids = await self.job_dao.insert_many(job_models)
+        self._wakeup.set()
+        return job_ids
+
+    async def start(self):
+        """启动 worker，并接手进程中断前未完成的任务"""
+        if self._workers:
+            return
+        self._stopping = False
+        await self.job_dao.ensure_indexes()
+        recovered = await self.job_dao.count_expired_leases()
+        if recovered:
+            logger.info(f"发现 {recovered} 个中断的上传任务，将重新处理")
+
+        self._workers = [asyncio.create_task(self._worker_loop(i)) for i in range(self.num_workers)]
+        # 启动时立即检查积压的任务
+        self._wakeup.set()
+        logger.info(f"上传任务队列已启动，worker 数量: {self.num_workers}, owner: {self.owner}")
+
+    async def stop(self):
+        """停止所有 worker，未完成的任务放回待处理队列，由其他进程立即接手"""
+        self._stopping = True
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # 等待已接手的任务结果（批次已在停止前写入）
+        if self._deferred:
+            await asyncio.gather(*self._deferred, return_exceptions=True)
+        try:
+            released = await self.job_dao.release_jobs(self.owner)
+            if released:
+                logger.info(f"已将 {released} 个未完成的上传任务放回队列")
+        except Exception as e:
+            # 租约过期后仍会被重新领取
+            logger.warning(f"释放未完成的上传任务时出错: {e}")
+        logger.info("上传任务队列已停止")
+
+    async def get_metrics(self) -> Dict[str, Any]:
+        """获取队列深度等指标"""
+        status_counts = await self.job_dao.count_by_status()
+        return {
+            "pending": status_counts.get("pending", 0),
+            "running": status_counts.get("running", 0),
+            "failed": status_counts.get("failed", 0),
+            "workers": len(self._workers),
+            "in_flight": self._in_flight,
+            "completed_by_this_process": self._completed_count,
+            "failed_by_this_process": self._failed_count,
+        }
+
+    async def _worker_loop(self, worker_index: int):
+        while not self._stopping:
+            try:
+                job = await self.job_dao.claim_next_job(self.owner, self.lease_seconds)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"领取上传任务时出错: {e}")
+                job = None
+
+            if job is None:
+                # 没有任务时等待新任务通知，或定期轮询（其他进程写入的任务）
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run_job(job)
+
+    async def _run_job(self, job: Dict[str, Any]):
+        job_id = job["_id"]
+        job_type = job["job_type"]
+        handler = self._handlers.get(job_type)
+        if handler is None:
+            logger.error(f"未注册的任务类型: {job_type}")
+            await self.job_dao.mark_failed(job_id, self.owner, f"Unknown job type: {job_type}", retry=False)
+            return
+
+        self._in_flight += 1
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        deferred = False
+        payload = dict(job.get("payload", {}))
+        if job.get("attempts", 1) > 1:
+            # 重试时上一次尝试可能已使用过
+            for field in self._single_use_fields.get(job_type, ()):
+                if field in payload:
+                    payload[field] = None
+        try:
+            result = await handler(**payload)
+            if isinstance(result, asyncio.Future):
+                # 结果稍后才确定，不占用 worker
+                deferred = True
+                task = asyncio.create_task(self._finish_deferred(job, result, heartbeat))
+                self._deferred.add(task)
+                task.add_done_callback(self._deferred.discard)
+                return
+            await self._finish_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._finish_job(job, e)
+        finally:
+            if not deferred:
+                heartbeat.cancel()
+                self._in_flight -= 1
+
+    async def _finish_deferred(self, job: Dict[str, Any], result: asyncio.Future, heartbeat: asyncio.Task):
+        try:
+            await result
+            await self._finish_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self._finish_job(job, e)
+        finally:
+            heartbeat.cancel()
+            self._in_flight -= 1
+
+    async def _finish_job(self, job: Dict[str, Any], error: Exception = None):
+        """标记任务完成，出错时未超过尝试次数的任务放回待处理队列"""
+        job_id = job["_id"]
+        if error is None:
+            await self.job_dao.mark_completed(job_id, self.owner)
+            self._completed_count += 1
+            return
+        retry = job.get("attempts", 1) < self.max_attempts
+        logger.error(f"处理上传任务 {job_id} ({job['job_type']}) 时出错: {error}，{'稍后重试' if retry else '不再重试'}")
+        await self.job_dao.mark_failed(job_id, self.owner, str(error), retry=retry)
+        self._failed_count += 1
+
+    async def _heartbeat(self, job_id):
+        """定期续约，避免长时间任务被其他 worker 重复领取"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.job_dao.extend_lease(job_id, self.owner, self.lease_seconds)
+            except Exception as e:
+                logger.warning(f"续约上传任务 {job_id} 时出错: {e}")
+
+# 进程内共享的队列实例
+ingest_queue = IngestQueueService()
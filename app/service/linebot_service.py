@@ -1,51 +1,141 @@
 import os
-import tempfile
+import asyncio
+from contextlib import asynccontextmanager
+from typing import List, Tuple, Any
+from cachetools import TTLCache
 
-from linebot import LineBotApi
-from linebot.models import TextSendMessage
-
-from app.service.user_service import UserManagementService, UserAuthService
+from app.infrastructure.external.line_messaging_service import LineMessagingService
+from app.infrastructure.daos.line_webhook_event_daos import LineWebhookEventDAO
+from app.service.user_service import LineUserResolver
 from app.service.application_service import UserContentUploadService
 from app.utils.logging_utils import logger
+from app.utils.format_utils import detect_file_type
+from app.utils.batch_utils import MicroBatcher
+
+line_messaging_service = LineMessagingService()
+line_user_resolver = LineUserResolver()
+
+class LineEventDeduplicator:
+    """LINE Webhook 重送去重
+
+    LINE 在逾時等情況下會重送同一事件，以 webhookEventId（無則用訊息ID）作為冪等鍵：
+    - 進程內的近期事件集合，直接過濾同一進程收到的重送
+    - 帶唯一索引與 TTL 的 LineWebhookEvents 集合，跨進程判斷是否已處理過
+    在事件寫入任務隊列前檢查，重複事件不會觸發任何下載、上傳與後續的模型分析。
+    """
+    def __init__(self):
+        self.event_dao = LineWebhookEventDAO()
+        self._recent_keys = TTLCache(maxsize=int(os.getenv("LINE_EVENT_DEDUP_CACHE_SIZE", 10000)), 
+                                     ttl=int(os.getenv("LINE_EVENT_DEDUP_CACHE_TTL", 3600)))
+        self.duplicate_count = 0
+
+    async def ensure_indexes(self):
+        await self.event_dao.ensure_indexes(ttl_seconds=int(os.getenv("LINE_EVENT_DEDUP_TTL", 3 * 24 * 3600)))
+
+    @staticmethod
+    def get_event_key(event) -> str:
+        """取得事件的冪等鍵，重送的事件 webhookEventId 與訊息ID皆不變"""
+        webhook_event_id = getattr(event, "webhook_event_id", None)
+        if webhook_event_id:
+            return f"event:{webhook_event_id}"
+        message = getattr(event, "message", None)
+        if message is not None and getattr(message, "id", None):
+            return f"message:{message.id}"
+        return None
+
+    async def filter_new(self, keyed_items: List[Tuple[str, Any]]) -> List[Tuple[str, Any]]:
+        """過濾掉已處理過的事件，返回首次出現的 (event_key, item)；沒有冪等鍵的項目一律保留"""
+        candidates = []
+        seen = set()
+        for event_key, item in keyed_items:
+            if event_key and (event_key in self._recent_keys or event_key in seen):
+                self.duplicate_count += 1
+                continue
+            seen.add(event_key)
+            candidates.append((event_key, item))
+
+        event_keys = [event_key for event_key, _ in candidates if event_key]
+        claimed_keys = set(await self.event_dao.claim_events(event_keys))
+        for event_key in event_keys:
+            self._recent_keys[event_key] = True
+
+        new_items = [(event_key, item) for event_key, item in candidates if not event_key or event_key in claimed_keys]
+        duplicates = len(candidates) - len(new_items)
+        if duplicates:
+            self.duplicate_count += duplicates
+            logger.info(f"略過 {duplicates} 個重送的 LINE 事件")
+        return new_items
+
+    async def release(self, event_keys: List[str]):
+        """撤銷事件的登記（入隊失敗時使用，讓 LINE 重送的事件可以再次處理）"""
+        event_keys = [event_key for event_key in event_keys if event_key]
+        for event_key in event_keys:
+            self._recent_keys.pop(event_key, None)
+        if event_keys:
+            await self.event_dao.release_events(event_keys)
 
-line_bot_api = LineBotApi(os.getenv("LINE_CHANNEL_ACCESS_TOKEN"))
+line_event_deduplicator = LineEventDeduplicator()
 
 # 處理圖片訊息
 async def handle_image_message(message_id, line_id, reply_token, line_group_id):
-    image_path = None
+    """上傳圖片後交給批次處理，返回等待批次寫入結果的 Future（任務隊列的 worker 不需等待批次時間窗）"""
     try:
         # 檢查用戶狀態
         user_status = await check_and_register_user(line_id)
         user_id = user_status["user_data"]["_id"]
         
-        content_type = line_bot_api.get_message_content(message_id).content_type
-        if "jpeg" in content_type or "jpg" in content_type:
-            file_ext = ".jpg"
-        elif "png" in content_type:
-            file_ext = ".png"
-        else:
-            raise ValueError(f"不支持的圖片類型: {content_type}")
-        
-        # 使用臨時文件保存圖片
-        try:
-            image_path = await download_line_content(message_id, file_ext)
-                
-            user_content_upload_service = UserContentUploadService()
-            await user_content_upload_service.upload_image(image_path, user_id, "linebot", line_group_id)
-            # 構建基本回覆
-            reply_text = f"✅ 已收到圖表！"
-        except Exception as e:
-            logger.warning(f"圖片上傳失敗: {e}")
-            reply_text = "❌ 圖片上傳失敗，請稍後再試。"
+        # 只請求一次LINE內容，依文件頭判斷類型後直接串流上傳至R2
+        async with open_line_content(message_id) as (file_ext, mime_type, chunks):
+            if file_ext not in ("jpg", "png"):
+                raise ValueError(f"不支持的圖片類型: {mime_type}")
+            
+            try:
+                user_content_upload_service = UserContentUploadService()
+                upload_result = await user_content_upload_service.upload_image_object(file_stream=chunks, 
+                                                                                      file_name=f"{message_id}.{file_ext}", 
+                                                                                      user_id=user_id, 
+                                                                                      content_type=mime_type)
+            except Exception as e:
+                logger.warning(f"圖片上傳失敗: {e}")
+                await reply_to_user(reply_token, "❌ 圖片上傳失敗，請稍後再試。")
+                return
         
-        # 回覆用戶
-        await reply_to_user(reply_token, reply_text)
+        # 同一用戶在同一群組短時間內連續上傳的圖片合併為一批，統一寫入資料庫並回覆一次；
+        # 批次寫入失敗時 Future 以該錯誤結束，由任務隊列重試
+        return asyncio.ensure_future(line_image_batcher.submit(
+            {"upload_result": upload_result, "user_id": user_id, "reply_token": reply_token}, 
+            key=(line_id, line_group_id)))
     except Exception as e:
         logger.warning(f"處理圖片訊息時發生錯誤: {e}")
         await reply_to_user(reply_token, "❌ 伺服器發生錯誤，請稍後再試。")
-    finally:
-        # 確保在任何情況下都刪除臨時文件
-        await cleanup_temp_file(image_path)
+
+async def _flush_line_images(key, items):
+    """批次建立圖片記錄，並以第一則訊息的 reply token 回覆彙總結果；失敗時各項目以該錯誤結束，由任務隊列重試"""
+    line_id, line_group_id = key
+    # 重試的項目沒有 reply token
+    reply_token = next((item["reply_token"] for item in items if item["reply_token"]), None)
+    error = None
+    try:
+        user_content_upload_service = UserContentUploadService()
+        await user_content_upload_service.create_images(upload_results=[item["upload_result"] for item in items], 
+                                                        user_id=items[0]["user_id"], 
+                                                        upload_source="linebot", 
+                                                        line_group_id=line_group_id)
+        reply_text = "✅ 已收到圖表！" if len(items) == 1 else f"✅ 已收到 {len(items)} 張圖表"
+    except Exception as e:
+        logger.warning(f"批次建立圖片記錄失敗 ({line_id}, {len(items)} 張): {e}")
+        error = e
+        reply_text = "⚠️ 圖片暫時無法儲存，系統將自動重試。"
+    
+    try:
+        await reply_to_user(reply_token, reply_text)
+    except Exception as e:
+        logger.warning(f"回覆圖片上傳結果失敗: {e}")
+    return [error] * len(items)
+
+line_image_batcher = MicroBatcher(_flush_line_images, 
+                                  window=float(os.getenv("LINE_IMAGE_BATCH_WINDOW", 2.0)), 
+                                  max_batch_size=int(os.getenv("LINE_IMAGE_BATCH_SIZE", 30)))
 
 # 處理文字訊息
 async def handle_text_message(text, line_id, reply_token, line_group_id):
@@ -82,7 +172,6 @@ async def handle_file_message(message_id, line_id, reply_token, file_name, line_
         reply_token: 回复令牌
         file_name: 文件名称
     """
-    file_path = None
     try:
         user_status = await check_and_register_user(line_id)
         user_id = user_status["user_data"]["_id"]
@@ -95,17 +184,23 @@ async def handle_file_message(message_id, line_id, reply_token, file_name, line_
             await reply_to_user(reply_token, f"❌ 暂不支持处理{file_ext}类型的文件。目前仅支持PDF文件。")
             return
         
-        # 下载文件内容
-        file_path = await download_line_content(message_id, file_ext)
+        # 串流下载文件内容并直接上传至R2
+        async with open_line_content(message_id) as (detected_ext, mime_type, chunks):
+            # 以文件头确认内容确实为PDF
+            if detected_ext != file_ext:
+                await reply_to_user(reply_token, "❌ 文件内容与扩展名不符，目前仅支持PDF文件。")
+                return
             
-        user_content_upload_service = UserContentUploadService()
-        logger.info(f"linebot-service: {line_group_id}")
-        await user_content_upload_service.upload_file(file_type=file_ext, 
-                                                        file_name=file_name, 
-                                                        file_path=file_path, 
-                                                        user_id=user_id, 
-                                                        upload_source="linebot", 
-                                                        line_group_id=line_group_id)
+            user_content_upload_service = UserContentUploadService()
+            logger.info(f"linebot-service: {line_group_id}")
+            await user_content_upload_service.upload_file(file_type=file_ext, 
+                                                          file_name=file_name, 
+                                                          file_stream=chunks, 
+                                                          user_id=user_id, 
+                                                          upload_source="linebot", 
+                                                          line_group_id=line_group_id,
+                                                          storage_name=f"{message_id}.{file_ext}",
+                                                          content_type=mime_type)
         
         # 回复用户
         reply_text = f"✅ 確認接收{file_ext}文件！"
@@ -115,65 +210,47 @@ async def handle_file_message(message_id, line_id, reply_token, file_name, line_
         logger.warning(f"處理文件訊息時發生錯誤: {e}")
         # 发生错误时通知用户
         await reply_to_user(reply_token, f"❌ 處理文件時發生錯誤，請稍後再試。")
-    finally:
-        # 清理临时文件
-        await cleanup_temp_file(file_path)
 
 async def check_and_register_user(line_id):
-    """檢查用戶是否存在，不存在則創建，並返回用戶狀態"""
-    user_management_service = UserManagementService()
-    
-    # 先檢查用戶是否存在
-    user_data = await user_management_service.get_user(by="line_id", value=line_id)
-    
-    # 如果用戶已存在，直接返回
-    if user_data:
-        return {"is_new_user": False, "user_data": user_data}
-    
-    # 用戶不存在，進行註冊
-    logger.info(f"用戶 {line_id} 不存在，進行註冊。")
-    user_auth_service = UserAuthService()
-    user_data = await user_auth_service.register_user_from_line(line_id)
-    
-    return {"is_new_user": True, "user_data": user_data}
+    """檢查用戶是否存在，不存在則創建，並返回用戶狀態（經由進程內緩存解析）"""
+    return await line_user_resolver.resolve(line_id)
 
-async def download_line_content(message_id, file_ext):
-    """下載Line消息內容並返回臨時文件路徑
+@asynccontextmanager
+async def open_line_content(message_id, chunk_size: int = 64 * 1024):
+    """開啟Line消息內容的下載串流，並以文件頭判斷文件類型
     
     Args:
         message_id: Line消息ID
-        file_ext: 文件擴展名，如 '.jpg', '.pdf'
+        chunk_size: 每次讀取的大小
         
-    Returns:
-        str: 臨時文件路徑
+    Yields:
+        tuple: (文件擴展名, MIME類型, 內容的異步迭代器)，無法識別時擴展名與MIME類型為 None
     """
-    with tempfile.NamedTemporaryFile(suffix=file_ext, delete=False) as temp_file:
-        file_path = temp_file.name
+    async with line_messaging_service.open_message_content(message_id) as response:
+        header = await _read_header(response.content)
+        file_ext, mime_type = detect_file_type(header)
         
-        # 下載內容
-        message_content = line_bot_api.get_message_content(message_id)
-        with open(file_path, 'wb') as fd:
-            for chunk in message_content.iter_content():
-                fd.write(chunk)
-                
-        return file_path
-
-async def cleanup_temp_file(file_path):
-    """清理臨時文件
-    
-    Args:
-        file_path: 臨時文件路徑
-    """
-    if file_path and os.path.exists(file_path):
-        try:
-            os.unlink(file_path)
-            logger.debug(f"已刪除臨時文件: {file_path}")
-        except Exception as e:
-            logger.warning(f"刪除臨時文件失敗: {e}")
+        async def chunks():
+            if header:
+                yield header
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
+        
+        yield file_ext, mime_type, chunks()
+
+async def _read_header(stream, header_size: int = 16) -> bytes:
+    """從串流讀取文件頭"""
+    header = b""
+    while len(header) < header_size:
+        chunk = await stream.read(header_size - len(header))
+        if not chunk:
+            break
+        header += chunk
+    return header
 
 async def reply_to_user(reply_token, message):
-    """向用戶發送回覆訊息"""
-    line_bot_api.reply_message(
-        reply_token,
-        TextSendMessage(text=message)
-    )
\ No newline at end of file
+    """向用戶發送回覆訊息（重試的任務沒有 reply token，不回覆）"""
+    if not reply_token:
+        logger.info(f"沒有可用的 reply token，略過回覆: {message}")
+        return
+    await line_messaging_service.reply_text(reply_token, message)
\ No newline at end of file
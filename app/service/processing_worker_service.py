@@ -0,0 +1,282 @@
+import os
+import time
+import uuid
+import socket
+import asyncio
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Any, List
+from pymongo.errors import OperationFailure
+
+from app.service.content_service import ContentService
+from app.service.text_service import TextService
+from app.service.url_services import UrlService
+from app.service.image_service import ImageService
+from app.service.file_service import FileService
+from app.infrastructure.daos.processing_checkpoint_daos import ProcessingCheckpointDAO
+from app.infrastructure.daos.user_daos import UserContentMetaDAO
+from app.infrastructure.external.cloudflare_ai_service import CloudflareAIService
+from app.utils.pipeline_utils import StagePipeline, ProcessingSlot, ProcessingSlots
+from app.utils.logging_utils import logger
+
+# 优先级从高到低：最近上传的内容优先于积压内容
+PRIORITY_CLASSES = ["fresh", "backfill"]
+# resume token 已失效（超出 oplog 范围等），需从当前位置重新监听
+RESUME_TOKEN_INVALID_CODES = {260, 280, 286}
+
+class ContentProcessingWorker:
+    """持续运行的内容处理调度器
+
+    从文本、URL、图像、文件四个集合统一领取未处理的内容，全局最多同时处理 max_in_flight 个：
+    - 优先级：最近 fresh_seconds 秒内上传的内容优先于积压内容
+    - 同一优先级内按内容类型的权重公平分配处理名额（stride 调度），积压多的类型不会占满所有名额
+    - 所有类型的分析与向量化共用 CloudflareAIService 的全局并发上限
+    - 内容进入向量化后让出名额：积压内容的向量化在 backfill_embedding_window 秒内合并为批量请求，
+      等待合并的内容最多 max_waiting 个；fresh 内容使用默认的短窗口，不增加上传到可搜索的延迟
+
+    新内容通过各集合的 Change Stream 即时送入处理（上传后数秒内即可被搜索），resume token 定期写入检查点，
+    重启后从中断处继续；另以 sweep_interval 定期扫描，补上监听中断期间遗漏的内容。
+    MongoDB 不支持 Change Stream（非副本集）时退回按 poll_interval 轮询。
+
+    内容以租约方式领取（find_one_and_update 原子地写入 owner 与到期时间），
+    任意数量的进程或节点可同时运行，同一内容不会被重复分析：
+    - 处理期间定期续约（心跳），长时间的处理不会被其他进程抢走
+    - 进程中断后租约到期，内容自动被其他进程重新领取
+    - 处理失败的内容按指数退避重试，超过尝试次数后进入死信，不再消耗模型调用
+    """
+
+    def __init__(self, services: List[ContentService] = None, max_in_flight: int = None, lease_seconds: int = None,
+                 poll_interval: float = None, fresh_seconds: int = None, weights: Dict[str, float] = None,
+                 use_change_streams: bool = None, sweep_interval: float = None, max_waiting: int = None):
+        self.services = services or [TextService(), UrlService(), ImageService(), FileService()]
+        self.max_in_flight = max_in_flight or int(os.getenv("PROCESSING_WORKERS", 5))
+        self.max_waiting = max_waiting if max_waiting is not None else int(os.getenv("PROCESSING_MAX_EMBEDDING_WAITING", 64))
+        self.lease_seconds = lease_seconds or int(os.getenv("PROCESSING_LEASE_SECONDS", 300))
+        self.poll_interval = poll_interval or float(os.getenv("PROCESSING_POLL_INTERVAL", 10))
+        self.fresh_seconds = fresh_seconds or int(os.getenv("PROCESSING_FRESH_SECONDS", 60))
+        self.weights = weights or self._parse_weights(os.getenv("PROCESSING_WEIGHTS", "text=1,url=1,image=2,file=2"))
+        if use_change_streams is None:
+            use_change_streams = os.getenv("PROCESSING_CHANGE_STREAMS", "true").lower() == "true"
+        self.use_change_streams = use_change_streams
+        self.sweep_interval = sweep_interval or float(os.getenv("PROCESSING_SWEEP_INTERVAL", 300))
+        self.checkpoint_interval = float(os.getenv("PROCESSING_CHECKPOINT_INTERVAL", 5))
+        self.checkpoint_dao = ProcessingCheckpointDAO()
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        self._dispatcher: asyncio.Task = None
+        self._tasks = set()
+        self._slots = ProcessingSlots(self.max_in_flight, self.max_waiting)
+        self._stopping = False
+        # stride 调度：每个类型的虚拟时间，每领取一个内容增加 1/权重，优先领取虚拟时间最小的类型
+        self._passes = {service.content_type: 0.0 for service in self.services}
+        self._virtual_time = 0.0
+        # 没有可领取内容的 (优先级, 类型) 在此时间之前不再查询
+        self._idle_until: Dict[tuple, float] = {}
+        # Change Stream 收到的新内容 ID，领取 fresh 内容时优先按 ID 领取
+        self._pending = {service.content_type: deque() for service in self.services}
+        self._watching = {service.content_type: False for service in self.services}
+        self._watchers: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        # 进程内计数
+        self._processed_count = 0
+        self._failed_count = 0
+        self._dispatched = {priority: {service.content_type: 0 for service in self.services} for priority in PRIORITY_CLASSES}
+
+    @staticmethod
+    def _parse_weights(spec: str) -> Dict[str, float]:
+        """解析 "text=1,image=2" 格式的权重配置"""
+        weights = {}
+        for item in spec.split(","):
+            if "=" in item:
+                content_type, weight = item.split("=", 1)
+                weights[content_type.strip()] = float(weight)
+        return weights
+
+    async def start(self):
+        """建立索引并启动调度"""
+        if self._dispatcher:
+            return
+        self._stopping = False
+        for service in self.services:
+            try:
+                await service.ensure_processing_indexes()
+            except Exception as e:
+                # 下次启动时再次尝试建立
+                logger.error(f"建立{service.content_type}的处理索引时出错，继续启动: {e}")
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+        if self.use_change_streams:
+            self._watchers = [asyncio.create_task(self._watch_loop(service)) for service in self.services]
+        logger.info(f"内容处理调度器已启动，最大并发: {self.max_in_flight}, 权重: {self.weights}, owner: {self.owner}")
+
+    async def stop(self):
+        """停止调度与处理中的任务，未完成的内容将在租约过期后由其他进程接手"""
+        self._stopping = True
+        tasks = [self._dispatcher, *self._watchers, *self._tasks] if self._dispatcher else list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+        self._watchers = []
+        self._tasks.clear()
+        # 未开始执行即被取消的任务不会归还名额
+        self._slots = ProcessingSlots(self.max_in_flight, self.max_waiting)
+        # 写入缓衝中已提交的处理结果
+        for dao in [*(service.content_dao for service in self.services), UserContentMetaDAO()]:
+            try:
+                await dao.flush_writes()
+            except Exception as e:
+                logger.warning(f"写入缓衝中的处理结果时出错: {e}")
+        logger.info("内容处理调度器已停止")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "owner": self.owner,
+            "in_flight": self._slots.active,
+            "waiting_for_batch": self._slots.waiting,
+            "max_in_flight": self.max_in_flight,
+            "processed_by_this_process": self._processed_count,
+            "failed_by_this_process": self._failed_count,
+            "dispatched": self._dispatched,
+            "change_streams": dict(self._watching),
+            "pending_from_change_streams": {content_type: len(ids) for content_type, ids in self._pending.items()},
+            "ai_gateway": CloudflareAIService.get_stats(),
+            "stages": StagePipeline.get_stats(),
+        }
+
+    def _idle_interval(self, content_type: str) -> float:
+        """没有可领取内容后再次查询的间隔：有 Change Stream 通知新内容时只需定期扫描遗漏"""
+        return self.sweep_interval if self._watching[content_type] else self.poll_interval
+
+    async def _wait_for_work(self, timeout: float = None):
+        """等待任一处理完成、Change Stream 通知新内容或超时"""
+        wakeup = asyncio.create_task(self._wakeup.wait())
+        try:
+            await asyncio.wait([wakeup, *self._tasks], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            wakeup.cancel()
+        self._wakeup.clear()
+
+    async def _dispatch_loop(self):
+        while not self._stopping:
+            # 名额用完时等待任一内容完成或进入向量化
+            slot = await self._slots.acquire()
+            try:
+                claimed = await self._claim_next()
+            except BaseException:
+                slot.release()
+                raise
+            if claimed is None:
+                slot.release()
+                # 没有可领取的内容：等待任一处理完成、新内容通知或下一次定期查询
+                now = time.monotonic()
+                next_check = min(self._idle_until.values(), default=now)
+                await self._wait_for_work(timeout=max(next_check - now, 0.01))
+                continue
+
+            service, content, priority = claimed
+            if priority == "backfill":
+                slot.batch_window = service.backfill_embedding_window
+            task = asyncio.create_task(self._process(service, content, slot))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _claim_next(self):
+        """按优先级与类型权重领取下一个内容，返回 (service, content, priority)；没有可领取的内容时返回 None"""
+        now = time.monotonic()
+        fresh_after = datetime.now(timezone.utc) - timedelta(seconds=self.fresh_seconds)
+        for priority in PRIORITY_CLASSES:
+            # 同一优先级内，虚拟时间最小的类型优先
+            for service in sorted(self.services, key=lambda service: self._passes[service.content_type]):
+                content_type = service.content_type
+                content = None
+                if priority == "fresh":
+                    content = await self._claim_pending(service)
+                if content is None:
+                    if self._idle_until.get((priority, content_type), 0) > now:
+                        continue
+                    try:
+                        content = await service.claim_next_content(self.owner, self.lease_seconds,
+                                                                   created_after=fresh_after if priority == "fresh" else None)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.error(f"领取{content_type}内容时出错: {e}")
+                        content = None
+                if content is None:
+                    self._idle_until[(priority, content_type)] = now + self._idle_interval(content_type)
+                    continue
+
+                # 一段时间没有内容的类型从当前虚拟时间开始计算，避免累积的名额一次性占满
+                self._virtual_time = max(self._passes[content_type], self._virtual_time)
+                self._passes[content_type] = self._virtual_time + 1 / self.weights.get(content_type, 1)
+                self._dispatched[priority][content_type] += 1
+                return service, content, priority
+        return None
+
+    async def _claim_pending(self, service: ContentService):
+        """按 ID 领取 Change Stream 通知的新内容（可能已被其他进程领取），没有可领取的内容时返回 None"""
+        pending = self._pending[service.content_type]
+        while pending:
+            content_id = pending.popleft()
+            try:
+                content = await service.claim_content(content_id, self.owner, self.lease_seconds)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 留给定期扫描处理
+                logger.error(f"领取{service.content_type} {content_id} 时出错: {e}")
+                continue
+            if content is not None:
+                return content
+        return None
+
+    async def _watch_loop(self, service: ContentService):
+        """监听集合的新插入内容并唤醒调度，定期将 resume token 写入检查点；中断时自动重新连接"""
+        content_type = service.content_type
+        checkpoint_name = f"change_stream:{service.content_dao.collection_name}"
+        while not self._stopping:
+            resume_token = saved_token = None
+            try:
+                resume_token = await self.checkpoint_dao.get_resume_token(checkpoint_name)
+                saved_token, last_saved = resume_token, time.monotonic()
+                self._watching[content_type] = True
+                async for content_id, resume_token in service.content_dao.watch_inserted_ids(resume_after=resume_token):
+                    self._pending[content_type].append(content_id)
+                    self._wakeup.set()
+                    if time.monotonic() - last_saved >= self.checkpoint_interval:
+                        await self.checkpoint_dao.save_resume_token(checkpoint_name, resume_token)
+                        saved_token, last_saved = resume_token, time.monotonic()
+            except asyncio.CancelledError:
+                if resume_token is not None and resume_token != saved_token:
+                    try:
+                        await self.checkpoint_dao.save_resume_token(checkpoint_name, resume_token)
+                    except Exception as e:
+                        logger.warning(f"保存{content_type}监听检查点时出错: {e}")
+                raise
+            except OperationFailure as e:
+                self._watching[content_type] = False
+                self._idle_until.pop(("fresh", content_type), None)
+                if e.code in RESUME_TOKEN_INVALID_CODES:
+                    # 检查点之后的变动已无法取得，由定期扫描补上
+                    logger.warning(f"{content_type}监听检查点已失效，从当前位置重新监听: {e}")
+                    await self.checkpoint_dao.clear_resume_token(checkpoint_name)
+                    continue
+                # 单机版 MongoDB 不支持 Change Stream，仅依赖轮询
+                logger.warning(f"无法监听{content_type}新内容，改为每 {self.poll_interval} 秒轮询: {e}")
+                return
+            except Exception as e:
+                self._watching[content_type] = False
+                self._idle_until.pop(("fresh", content_type), None)
+                logger.warning(f"监听{content_type}新内容中断，{self.poll_interval}秒后重试: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _process(self, service: ContentService, content: Dict, slot: ProcessingSlot):
+        ProcessingSlot.current.set(slot)
+        try:
+            result = await service.process_claimed_content(content, self.owner, self.lease_seconds)
+        finally:
+            slot.release()
+        if result:
+            self._processed_count += 1
+        else:
+            self._failed_count += 1
@@ -1,5 +1,6 @@
+import asyncio
 from bson import ObjectId
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 from app.infrastructure.models.text_models import TextModel, TextDescriptionModel
 from app.infrastructure.models.base_models import MetadataModel
@@ -17,6 +18,8 @@ from app.service.user_service import UserContentMetaService
 class TextService(ContentService):
     """文本服务，处理文本的创建、存储和分析"""
     
+    processing_fields = ["content"]
+
     def __init__(self):
         super().__init__()
         self.content_type = "text"
@@ -38,64 +41,125 @@ class TextService(ContentService):
         
         # 提取文本中的URL
         urls = extract_urls_from_text(text)
-        text_id = None
-        url_ids = []
-        
-        try:
-            # 检查是否为纯URL
-            is_pure_url = check_is_pure_url(text)
-            # 如果不是纯URL，则创建文本记录
-            if not is_pure_url:
-                text_model = TextModel(
-                    content=text, 
-                    authorized_users=authorized_users,
-                    uploader=uploader_id,
-                    metadata=MetadataModel(**upload_metadata),
-                    parent_file=parent_file,
-                    file_page_num=file_page_num
-                )
-                text_id = await self.content_dao.insert_one(text_model)
-                
-
-                # 创建User Content Metadata
-                await self.user_content_meta_service.create_content_meta(
-                    content_type="text",
-                    content_ids=[text_id],
-                    user_ids=authorized_users
-                )
-            
-            # 创建URL
-            if urls:
-                url_ids = await self.url_service.create_content(
-                    urls=urls,
-                    uploader_id=uploader_id,
-                    authorized_users=authorized_users,
-                    parent_text_id=text_id,
-                    upload_metadata=upload_metadata,
-                )
-                
-                # 创建 User URL Metadata
-                if url_ids:
-                    await self.user_content_meta_service.create_content_meta(
-                        content_type="url",
-                        content_ids=url_ids,
-                        user_ids=authorized_users
-                    )
-                    
-            # 只有在创建了文本记录和URL的情况下才更新子URL
-            if text_id and url_ids:
-                await self.content_dao.update_child_urls(text_id, url_ids)
-            
-            return {"text_id": text_id, "url_ids": url_ids}
-        
-        except Exception as e:
-            # 全局异常处理，确保所有资源都被清理
-            if url_ids:
-                await self.url_service.delete_content(url_ids)
-            if text_id:
-                await self.content_dao.delete_one(text_id)
-            logger.error(f"创建内容过程中发生未处理的异常: {e}")
-            raise e
+        
+        # 预先生成ID，使文本的 child_urls 与 URL 的 parent_text 可以在同一次插入中写入，
+        # 各项写入互不依赖，可以并发执行
+        is_pure_url = check_is_pure_url(text)
+        text_id = None if is_pure_url else ObjectId()
+        url_ids = [ObjectId() for _ in urls]
+        
+        writes = []
+        # 如果不是纯URL，则创建文本记录
+        if text_id:
+            text_model = TextModel(
+                content=text, 
+                authorized_users=authorized_users,
+                uploader=uploader_id,
+                metadata=MetadataModel(**upload_metadata),
+                parent_file=parent_file,
+                file_page_num=file_page_num,
+                child_urls=url_ids
+            )
+            writes.append(self.content_dao.insert_one(text_model, document_id=text_id))
+        
+        # 创建URL
+        if url_ids:
+            writes.append(self.url_service.create_content(
+                urls=urls,
+                uploader_id=uploader_id,
+                authorized_users=authorized_users,
+                parent_text_id=text_id,
+                upload_metadata=upload_metadata,
+                url_ids=url_ids,
+            ))
+        
+        # 文本与URL的 User Content Metadata 合并为一次写入
+        content_ids_by_type = {}
+        if text_id:
+            content_ids_by_type["text"] = [text_id]
+        if url_ids:
+            content_ids_by_type["url"] = url_ids
+        writes.append(self.user_content_meta_service.create_content_metas(content_ids_by_type, authorized_users))
+        
+        results = await asyncio.gather(*writes, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            # 部分写入失败，清理所有可能已写入的资源（按预先生成的ID删除，未写入的不受影响）
+            logger.error(f"创建内容过程中发生未处理的异常: {errors[0]}")
+            await self._cleanup_resources(text_id, url_ids)
+            raise errors[0]
+        
+        return {"text_id": text_id, "url_ids": url_ids}
+    
+    async def share_existing_contents(self, contents: List[Dict], authorized_users: list[ObjectId]) -> List[ObjectId]:
+        """复用已存在的文本时，一并为其中的URL追加授权用户"""
+        text_ids = await super().share_existing_contents(contents, authorized_users)
+        child_urls = await self.url_service.content_dao.find({"parent_text": {"$in": text_ids}})
+        if child_urls:
+            await self.url_service.share_existing_contents(child_urls, authorized_users)
+        return text_ids
+    
+    async def _cleanup_resources(self, text_id: ObjectId, url_ids: list[ObjectId]):
+        """清理创建过程中写入的文本、URL与User Content Metadata"""
+        content_ids = ([text_id] if text_id else []) + url_ids
+        cleanups = [self.user_content_meta_service.delete_content_meta(content_ids)]
+        if url_ids:
+            cleanups.append(self.url_service.delete_contents(url_ids))
+        if text_id:
+            cleanups.append(self.content_dao.delete_one(text_id))
+        for result in await asyncio.gather(*cleanups, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"清理文本资源时出错: {result}")
+    
+    async def upsert_page_texts(self, file_id: ObjectId, pages: Dict[int, str], uploader_id: ObjectId, authorized_users: list[ObjectId],
+                                upload_metadata: Dict[str, Any]) -> List[ObjectId]:
+        """写入文件页面的文本、URL与User Content Metadata，返回按页码排列的文本ID（只有URL的页面没有文本）
+        
+        页面文本以 (parent_file, file_page_num) 为键 upsert，URL沿用页面文本记录的 child_urls；
+        所有写入都不会重复创建，处理中断后重试或多个进程同时处理同一文件时结果相同
+        
+        Args:
+            pages: 页码到页面文本的映射
+        """
+        text_pages = {page_num: text for page_num, text in pages.items() if not check_is_pure_url(text)}
+        url_pages = {page_num: text for page_num, text in pages.items() if page_num not in text_pages}
+        
+        # 新页面的 child_urls 使用预先生成的ID；页面已存在时保留原有的记录
+        await self.content_dao.upsert_many(
+            [{"parent_file": file_id, "file_page_num": page_num} for page_num in text_pages],
+            [TextModel(content=text, authorized_users=authorized_users, uploader=uploader_id, metadata=MetadataModel(**upload_metadata),
+                       parent_file=file_id, file_page_num=page_num, child_urls=[ObjectId() for _ in extract_urls_from_text(text)])
+             for page_num, text in text_pages.items()]
+        )
+        stored_pages = {page["file_page_num"]: page for page in await self.content_dao.find_page_texts(file_id, list(text_pages))}
+        
+        url_keys, url_models = [], []
+        for page_num, text in text_pages.items():
+            page = stored_pages[page_num]
+            for url, url_id in zip(extract_urls_from_text(text), page.get("child_urls") or []):
+                url_keys.append({"_id": url_id})
+                url_models.append(self.url_service.build_url_model(url, uploader_id, authorized_users, upload_metadata, parent_text=page["_id"]))
+        for page_num, text in url_pages.items():
+            for url in extract_urls_from_text(text):
+                url_keys.append({"parent_file": file_id, "file_page_num": page_num, "url": url})
+                url_models.append(self.url_service.build_url_model(url, uploader_id, authorized_users, upload_metadata,
+                                                                    parent_file=file_id, file_page_num=page_num))
+        await self.url_service.upsert_contents(url_keys, url_models)
+        
+        text_ids = [stored_pages[page_num]["_id"] for page_num in sorted(text_pages)]
+        url_ids = [url_id for page in stored_pages.values() for url_id in page.get("child_urls") or []]
+        if url_pages:
+            page_urls = await self.url_service.content_dao.find({"parent_file": file_id, "file_page_num": {"$in": list(url_pages)}},
+                                                                projection={"_id": 1})
+            url_ids.extend(url["_id"] for url in page_urls)
+        await self.user_content_meta_service.upsert_content_metas({"text": text_ids, "url": url_ids}, authorized_users)
+        return text_ids
+    
+    async def delete_texts(self, texts: List[Dict]) -> int:
+        """删除文本及其URL与User Content Metadata（texts 需包含 _id 与 child_urls）"""
+        for text in texts:
+            await self._cleanup_resources(text["_id"], text.get("child_urls") or [])
+        return len(texts)
     
     async def get_content_description(self, content: Dict, language: str = "zh-TW") -> TextDescriptionModel:
         """获取文本描述"""
@@ -122,7 +186,7 @@ class TextService(ContentService):
             
         else:
             # 文本过短，直接使用文本内容向量化
-            summary_vector = await self.llm_service.get_embedding(text)
+            summary_vector = await self.get_embedding(text)
         
         return TextDescriptionModel(
             auto_title=auto_title,
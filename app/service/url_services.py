@@ -11,6 +11,8 @@ from app.infrastructure.external.cloudflare_ai_service import CloudflareAIServic
 class UrlService(ContentService):
     """URL服务，处理URL的创建、存储和分析"""
     
+    processing_fields = ["url"]
+
     def __init__(self):
         super().__init__()
         self.content_type = "url"
@@ -18,20 +20,26 @@ class UrlService(ContentService):
         self.llm_service = CloudflareAIService()
     
     async def create_content(self, urls: list[str], uploader_id: ObjectId, authorized_users: list[ObjectId], parent_text_id: ObjectId = None,
-                            upload_metadata: Dict[str, Any] = None) -> ObjectId:
-        """创建URL内容，UserContentMeta在Text Service中實現"""
-        url_models = []
-        for url in urls:
-            url_model = UrlModel(
-                url=url, 
-                authorized_users=authorized_users,
-                uploader=uploader_id,
-                metadata=MetadataModel(**upload_metadata),  
-                description=UrlDescriptionModel(),
-                parent_text=parent_text_id
-            )
-            url_models.append(url_model)
-        return await self.content_dao.insert_many(url_models)
+                            upload_metadata: Dict[str, Any] = None, url_ids: list[ObjectId] = None) -> ObjectId:
+        """创建URL内容，UserContentMeta在Text Service中實現；url_ids 可传入预先生成的ID"""
+        url_models = [self.build_url_model(url, uploader_id, authorized_users, upload_metadata, parent_text=parent_text_id)
+                      for url in urls]
+        return await self.content_dao.insert_many(url_models, document_ids=url_ids)
+    
+    async def upsert_contents(self, keys: list[Dict], url_models: list[UrlModel]):
+        """按 keys 中的条件写入URL内容，已存在的不重复创建（文件页面中的URL，可安全重试）"""
+        await self.content_dao.upsert_many(keys, url_models)
+    
+    def build_url_model(self, url: str, uploader_id: ObjectId, authorized_users: list[ObjectId], upload_metadata: Dict[str, Any],
+                         **links) -> UrlModel:
+        return UrlModel(
+            url=url, 
+            authorized_users=authorized_users,
+            uploader=uploader_id,
+            metadata=MetadataModel(**upload_metadata),  
+            description=UrlDescriptionModel(),
+            **links
+        )
     
     async def get_content_description(self, content: Dict) -> Dict:
         """获取URL描述信息"""
@@ -52,7 +60,7 @@ class UrlService(ContentService):
                 # 如果没有标题和描述，使用URL本身
                 text_to_embed = content["url"]
                 
-            summary_vector = await self.llm_service.get_embedding(text_to_embed)
+            summary_vector = await self.get_embedding(text_to_embed)
             
             return UrlDescriptionModel(
                 auto_title=title,
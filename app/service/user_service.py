@@ -5,6 +5,10 @@ from app.exceptions.user_exceptions import UserAlreadyExistsError, InvalidCreden
 from app.infrastructure.models.user_models import UserContentMetadataModel
 from app.utils.logging_utils import logger
 from bson import ObjectId
+from cachetools import TTLCache
+from pymongo.errors import OperationFailure, DuplicateKeyError
+import asyncio
+import os
 
 class UserManagementService:
     """用户管理服务，处理用户相关的核心业务逻辑"""    
@@ -17,13 +21,43 @@ class UserManagementService:
             raise TypeError(f"Invalid search field: {by}")
         return await self.user_dao.find_user(**{by: value})
     
+    async def ensure_user_indexes(self):
+        """建立用户集合的索引；已有重复 line_id 的用户时需先手动合并，此时仅记录错误"""
+        try:
+            await self.user_dao.ensure_line_id_index()
+        except OperationFailure as e:
+            logger.error(f"建立 line_id 唯一索引失败，请先合并重复的 LINE 用户: {e}")
+    
     async def get_users_by_line_group_id(self, line_group_id: str):
         """根据Line Group ID获取用户"""
         return await self.user_dao.find_users_by_line_group_id(line_group_id, only_id = True)
+    
+    async def add_user_to_line_group(self, user_id: ObjectId, line_group_id: str):
+        """将用户加入Line群组"""
+        return await self.user_dao.add_line_group_id(user_id, line_group_id)
+    
+    async def remove_user_from_line_group(self, user_id: ObjectId, line_group_id: str):
+        """将用户移出Line群组"""
+        return await self.user_dao.remove_line_group_id(user_id, line_group_id)
+    
+    async def watch_line_group_membership(self, retry_interval: float = 30):
+        """持续监听群组成员变动以使缓存失效，连接中断时自动重试"""
+        while True:
+            try:
+                await self.user_dao.watch_line_group_changes()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                # 单机版 MongoDB 不支持 Change Stream，仅依赖 TTL 与 DAO 写入时的失效
+                logger.warning(f"无法监听群组成员变动，将仅依赖缓存TTL: {e}")
+                return
+            except Exception as e:
+                logger.warning(f"监听群组成员变动中断，{retry_interval}秒后重试: {e}")
+            await asyncio.sleep(retry_interval)
 
     async def create_user(self, user: dict):
         """从网站注册创建用户"""
-        await self.user_dao.create_user(user)
+        return await self.user_dao.create_user(user)
 
     async def is_user_exists(self, by: str, value: str):
         """检查用户是否存在"""
@@ -94,14 +128,105 @@ class UserAuthService:
             "external_ids": {"line_id": line_id},
         }
         try:
-            await self.user_management_service.create_user(user_data)
+            user_id = await self.user_management_service.create_user(user_data)
             return {
+                "_id": user_id,
                 "username": username,
                 "password": plain_password,
+                "external_ids": user_data["external_ids"],
             }
+        except DuplicateKeyError:
+            # 检查之后其他请求或进程已完成注册（line_id 唯一索引）
+            raise UserAlreadyExistsError(f"User with Line Id {line_id} already exists")
         except Exception as e:
             raise UserCreationError(f"Failed to create user: {str(e)}")
 
+class LineUserResolver:
+    """LINE 用户解析服务：line_id → 用户文档
+    
+    - 进程内 LRU/TTL 缓存，命中时不访问数据库
+    - 负缓存：短时间内记住不存在的 line_id，避免重复查询
+    - 单飞：同一 line_id 的并发请求共享同一次查询/注册
+    """
+    _cache = TTLCache(maxsize=int(os.getenv("LINE_USER_CACHE_SIZE", 10000)), ttl=int(os.getenv("LINE_USER_CACHE_TTL", 600)))
+    _negative_cache = TTLCache(maxsize=int(os.getenv("LINE_USER_CACHE_SIZE", 10000)), ttl=int(os.getenv("LINE_USER_NEGATIVE_CACHE_TTL", 30)))
+    _in_flight: dict = {}
+    _stats = {"hits": 0, "negative_hits": 0, "misses": 0, "coalesced": 0, "registrations": 0}
+    
+    def __init__(self, user_management_service=None, user_auth_service=None):
+        self.user_management_service = user_management_service or UserManagementService()
+        self.user_auth_service = user_auth_service or UserAuthService(user_management_service=self.user_management_service)
+    
+    @classmethod
+    def get_stats(cls):
+        """获取缓存命中统计"""
+        return {**cls._stats, "size": len(cls._cache), "negative_size": len(cls._negative_cache)}
+    
+    @classmethod
+    def invalidate(cls, line_id: str):
+        """使指定 line_id 的缓存失效"""
+        cls._cache.pop(line_id, None)
+        cls._negative_cache.pop(line_id, None)
+    
+    async def get_user(self, line_id: str):
+        """根据 line_id 获取用户，不存在时返回 None（不注册）"""
+        user_data = self._cache.get(line_id)
+        if user_data is not None:
+            self._stats["hits"] += 1
+            return user_data
+        if line_id in self._negative_cache:
+            self._stats["negative_hits"] += 1
+            return None
+        
+        self._stats["misses"] += 1
+        user_data = await self.user_management_service.get_user(by="line_id", value=line_id)
+        if user_data:
+            self._cache[line_id] = user_data
+        else:
+            self._negative_cache[line_id] = True
+        return user_data
+    
+    async def resolve(self, line_id: str):
+        """获取用户，不存在则注册，返回 {"is_new_user": bool, "user_data": dict}"""
+        user_data = self._cache.get(line_id)
+        if user_data is not None:
+            self._stats["hits"] += 1
+            return {"is_new_user": False, "user_data": user_data}
+        
+        # 同一 line_id 已有进行中的查询/注册，等待其结果
+        task = self._in_flight.get(line_id)
+        if task is not None:
+            self._stats["coalesced"] += 1
+            return await asyncio.shield(task)
+        
+        task = asyncio.ensure_future(self._lookup_or_register(line_id))
+        self._in_flight[line_id] = task
+        try:
+            return await asyncio.shield(task)
+        finally:
+            if self._in_flight.get(line_id) is task:
+                del self._in_flight[line_id]
+    
+    async def _lookup_or_register(self, line_id: str):
+        user_data = await self.get_user(line_id)
+        if user_data:
+            return {"is_new_user": False, "user_data": user_data}
+        
+        logger.info(f"用户 {line_id} 不存在，进行注册。")
+        try:
+            await self.user_auth_service.register_user_from_line(line_id)
+            self._stats["registrations"] += 1
+            is_new_user = True
+        except UserAlreadyExistsError:
+            # 负缓存期间其他进程已完成注册
+            is_new_user = False
+        # 注册返回的是明文密码，缓存与返回的都是数据库中的用户文档，与查询路径一致
+        user_data = await self.user_management_service.get_user(by="line_id", value=line_id)
+        
+        self._negative_cache.pop(line_id, None)
+        self._cache[line_id] = user_data
+        return {"is_new_user": is_new_user, "user_data": user_data}
+
 class UserContentMetaService:
     def __init__(self):
         self.user_content_meta_dao = UserContentMetaDAO()
@@ -127,17 +252,36 @@ class UserContentMetaService:
         Returns:
             插入的元数据记录
         """
-        meta_records = []
+        return await self.create_content_metas({content_type: content_ids}, user_ids)
+    
+    async def create_content_metas(self, content_ids_by_type: dict[str, list], user_ids: list[str]):
+        """
+        一次写入多种内容类型的用户内容元数据
         
+        Args:
+            content_ids_by_type: 内容类型到内容ID列表的映射，如 {"text": [...], "url": [...]}
+            user_ids: 用户ID列表
+        """
+        meta_records = self._build_content_metas(content_ids_by_type, user_ids)
+        if not meta_records:
+            return []
+        return await self.user_content_meta_dao.insert_many(meta_records)
+    
+    async def upsert_content_metas(self, content_ids_by_type: dict[str, list], user_ids: list[str]):
+        """与 create_content_metas 相同，但已存在的元数据不重复写入（可安全重试）"""
+        meta_records = self._build_content_metas(content_ids_by_type, user_ids)
+        if meta_records:
+            await self.user_content_meta_dao.upsert_many(meta_records)
+    
+    def _build_content_metas(self, content_ids_by_type: dict[str, list], user_ids: list[str]) -> list[UserContentMetadataModel]:
         # 为每个用户创建每个内容的元数据记录（笛卡尔积）
-        for user_id in user_ids:
-            for content_id in content_ids:
-                meta_records.append(
-                    UserContentMetadataModel(
-                        user_id=user_id,
-                        content_id=content_id,
-                        content_type=content_type
-                    )
-                )
-        
-        return await self.user_content_meta_dao.insert_many(meta_records)
\ No newline at end of file
+        return [
+            UserContentMetadataModel(user_id=user_id, content_id=content_id, content_type=content_type)
+            for content_type, content_ids in content_ids_by_type.items()
+            for user_id in user_ids
+            for content_id in content_ids
+        ]
+    
+    async def delete_content_meta(self, content_ids: list[ObjectId]):
+        """删除指定内容的所有用户内容元数据"""
+        return await self.user_content_meta_dao.delete_by_content_ids(content_ids)
\ No newline at end of file
@@ -0,0 +1,107 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+class _PendingBatch:
+    def __init__(self):
+        self.items: List[Any] = []
+        self.futures: List[asyncio.Future] = []
+        self.weight = 0
+        self.deadline = 0.0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+class MicroBatcher:
+    """
+    微批处理器：将短时间窗口内提交的项目按 key 合并为一批，统一调用 flush_func 处理
+
+    - 窗口到期、数量达到 max_batch_size 或权重达到 max_batch_weight 时立即处理
+    - submit 可为单个项目指定较短或较长的窗口，批次在其中最早的期限到达时处理
+    - flush_func(key, items) 需返回与 items 等长的结果列表，结果为 Exception 时只让对应项目失败
+    - flush_func 抛出异常时，整批项目都以该异常失败
+    """
+
+    def __init__(self, flush_func: Callable[[Hashable, List[Any]], Awaitable[List[Any]]], window: float = 0.5,
+                 max_batch_size: int = 50, max_batch_weight: int = None, weight_func: Callable[[Any], int] = None):
+        self.flush_func = flush_func
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.max_batch_weight = max_batch_weight
+        self.weight_func = weight_func
+        self._pending: Dict[Hashable, _PendingBatch] = {}
+        self._flush_tasks = set()
+
+    async def submit(self, item: Any, key: Hashable = None, window: float = None) -> Any:
+        """提交一个项目，等待其所在批次处理完成后返回该项目的结果
+
+        Args:
+            window: 该项目最多等待合并的秒数，默认为批处理器的 window
+        """
+        loop = asyncio.get_running_loop()
+        weight = self.weight_func(item) if self.weight_func else 1
+        deadline = loop.time() + (self.window if window is None else window)
+
+        batch = self._pending.get(key)
+        # 加入后会超过权重上限，先处理现有批次
+        if batch and self.max_batch_weight and batch.items and batch.weight + weight > self.max_batch_weight:
+            self._flush(key)
+            batch = None
+
+        if batch is None:
+            batch = _PendingBatch()
+            self._pending[key] = batch
+        if batch.timer is None or deadline < batch.deadline:
+            # 新项目的期限更早时提前处理整个批次
+            if batch.timer:
+                batch.timer.cancel()
+            batch.deadline = deadline
+            batch.timer = loop.call_at(deadline, self._flush, key, batch)
+
+        future = loop.create_future()
+        batch.items.append(item)
+        batch.futures.append(future)
+        batch.weight += weight
+
+        if len(batch.items) >= self.max_batch_size or (self.max_batch_weight and batch.weight >= self.max_batch_weight):
+            self._flush(key)
+
+        return await future
+
+    async def flush_all(self):
+        """立即处理所有等待中的批次，并等待处理完成"""
+        for key in list(self._pending.keys()):
+            self._flush(key)
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    def _flush(self, key: Hashable, batch: _PendingBatch = None):
+        current = self._pending.get(key)
+        # 计时器触发时批次可能已因数量上限被处理
+        if current is None or (batch is not None and current is not batch):
+            return
+        del self._pending[key]
+        if current.timer:
+            current.timer.cancel()
+
+        task = asyncio.create_task(self._run_flush(key, current))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _run_flush(self, key: Hashable, batch: _PendingBatch):
+        try:
+            results = await self.flush_func(key, batch.items)
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if len(results) != len(batch.futures):
+            error = RuntimeError(f"flush_func 返回 {len(results)} 个结果，预期 {len(batch.futures)} 个")
+            results = [error] * len(batch.futures)
+
+        for future, result in zip(batch.futures, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -80,27 +80,32 @@ def remove_scattered_numbers(text: str) -> str:
     
     return '\n'.join(filtered_lines)
 
-def extract_pdf_content(pdf_path: str, output_dir: str = None):
+def extract_pdf_content(pdf_path: str = None, output_dir: str = None, pdf_stream=None, start_page: int = 1):
     """
     從PDF提取文字，每頁作為一個元素
     
     Args:
         pdf_path: PDF文件路徑
         output_dir: 輸出目錄路徑（可選，不再用於保存圖片）
+        pdf_stream: PDF內容（bytes / bytearray / memoryview），提供時直接從記憶體讀取，不需臨時文件
+        start_page: 從第幾頁開始提取（從 1 開始），用於從中斷處繼續
     
     Returns:
-        list: 文字頁面列表，每頁為一個元素
+        list: 文字頁面列表（從 start_page 開始），每頁為一個元素
     """
     # 創建輸出目錄（如果提供）
     if output_dir and not os.path.exists(output_dir):
         os.makedirs(output_dir)
         
-    doc = fitz.open(pdf_path)
+    if pdf_stream is not None:
+        doc = fitz.open(stream=pdf_stream, filetype="pdf")
+    else:
+        doc = fitz.open(pdf_path)
     pages_text = []
     
     # 提取文字，每頁作為一個元素
-    for page in doc:
-        text = page.get_text("text")
+    for page_index in range(max(start_page - 1, 0), doc.page_count):
+        text = doc[page_index].get_text("text")
         cleaned_text = clean_text(text)
         # 清除零碎數字和單字
         cleaned_text = remove_scattered_numbers(cleaned_text)
@@ -109,6 +114,33 @@ def extract_pdf_content(pdf_path: str, output_dir: str = None):
     doc.close()
     return pages_text
 
+# 常见文件格式的文件头（魔数）
+FILE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpg", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png", "image/png"),
+    (b"GIF87a", "gif", "image/gif"),
+    (b"GIF89a", "gif", "image/gif"),
+    (b"%PDF-", "pdf", "application/pdf"),
+]
+
+def detect_file_type(header: bytes):
+    """
+    根据文件头判断文件类型
+    
+    参数:
+        header (bytes): 文件开头的字节（至少16字节）
+    
+    返回:
+        tuple: (扩展名, MIME类型)，无法识别时返回 (None, None)
+    """
+    for signature, file_ext, mime_type in FILE_SIGNATURES:
+        if header.startswith(signature):
+            return file_ext, mime_type
+    # WebP: RIFF....WEBP
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    return None, None
+
 def count_words(text):
     """
     计算文本中的单词数，中文一个字算1，英文一个单词算1
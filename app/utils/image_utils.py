@@ -0,0 +1,107 @@
+import io
+from typing import Optional
+from PIL import Image, ImageOps
+
+# EXIF 中的方向标签
+ORIENTATION_TAG = 0x0112
+
+def compute_dhash(image_bytes: bytes, hash_size: int = 8) -> int:
+    """
+    计算图像的差异哈希（dHash），对缩放、重新压缩和轻微裁切不敏感
+    
+    Args:
+        image_bytes: 图像内容
+        hash_size: 哈希边长，默认8（共64位）
+    
+    Returns:
+        int: 有符号64位整数（可直接存入MongoDB）
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        image.draft("L", (hash_size * 8, hash_size * 8))  # JPEG 解码时直接缩小，减少解码开销
+        grayscale = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+        pixels = grayscale.tobytes()
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+
+    # 转为有符号64位整数
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+def strip_image_metadata(image_bytes: bytes, quality: int = 95) -> Optional[bytes]:
+    """
+    去除原图的EXIF（GPS位置、设备信息等），按EXIF方向转正后以原格式重新编码
+    
+    未转向的 JPEG 沿用原图的量化表与色度抽样，重新编码的画质损失极小
+    
+    Args:
+        image_bytes: 原始图像内容
+        quality: 需要转向的 JPEG 或有损格式的压缩质量
+    
+    Returns:
+        bytes: 去除EXIF后的图像内容；原图不含EXIF时返回 None（直接使用原图）
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        if not (image.info.get("exif") or image.getexif()):
+            return None
+        image_format = image.format
+        if image_format not in ("JPEG", "PNG", "WEBP", "TIFF", "GIF") or getattr(image, "n_frames", 1) > 1:
+            raise ValueError(f"不支持去除 {image_format} 图像的EXIF")
+        
+        save_kwargs = {}
+        rotated = image.getexif().get(ORIENTATION_TAG, 1) != 1
+        output = ImageOps.exif_transpose(image) if rotated else image
+        if image_format == "JPEG":
+            if rotated:
+                save_kwargs = {"quality": quality}
+            else:
+                save_kwargs = {"quality": "keep", "subsampling": "keep", "qtables": "keep"}
+        elif image_format == "WEBP":
+            save_kwargs = {"quality": quality}
+        if "icc_profile" in image.info:
+            save_kwargs["icc_profile"] = image.info["icc_profile"]
+        
+        buffer = io.BytesIO()
+        output.save(buffer, format=image_format, **save_kwargs)  # 不传 exif 参数，输出不含EXIF
+        return buffer.getvalue()
+
+def _encode_webp(image: Image.Image, quality: int) -> bytes:
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=quality, method=4)  # 不传 exif 参数，输出不含EXIF
+    return buffer.getvalue()
+
+def create_image_variants(image_bytes: bytes, max_edge: int = 1568, thumbnail_edge: int = 400, quality: int = 85) -> dict:
+    """
+    生成图像的派生版本：按EXIF方向转正并去除EXIF，再生成供模型使用的版本与列表缩略图（WebP）
+    
+    Args:
+        image_bytes: 原始图像内容
+        max_edge: 模型输入版本的最长边上限
+        thumbnail_edge: 缩略图的最长边上限
+        quality: WebP 压缩质量
+    
+    Returns:
+        dict: model_input（原图不超过上限且不含EXIF时为 None，直接使用原图）与 thumbnail，均为 WebP 内容
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        has_exif = bool(image.info.get("exif")) or bool(image.getexif())
+        if getattr(image, "n_frames", 1) > 1:
+            image.seek(0)  # 动图只取第一帧
+        image = ImageOps.exif_transpose(image)
+        image.load()
+
+    model_input = None
+    if has_exif or max(image.size) > max_edge:
+        resized = image.copy()
+        resized.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        model_input = _encode_webp(resized, quality)
+
+    image.thumbnail((thumbnail_edge, thumbnail_edge), Image.Resampling.LANCZOS)
+    return {"model_input": model_input, "thumbnail": _encode_webp(image, quality)}
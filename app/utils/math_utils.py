@@ -7,4 +7,9 @@ def euclidean_distance(vector1:list, vector2:list):
     return np.linalg.norm(np.array(vector1) - np.array(vector2))
 
 def manhattan_distance(vector1:list, vector2:list):
-    return np.sum(np.abs(np.array(vector1) - np.array(vector2)))
\ No newline at end of file
+    return np.sum(np.abs(np.array(vector1) - np.array(vector2)))
+
+def hamming_distances(value: int, values: np.ndarray) -> np.ndarray:
+    """计算一个64位整数与一组64位整数（int64 数组）之间的汉明距离"""
+    query = np.array([value], dtype=np.int64).view(np.uint64)
+    return np.bitwise_count(values.view(np.uint64) ^ query)
@@ -0,0 +1,209 @@
+import os
+import time
+import asyncio
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+class Stage:
+    """处理流程中的一个阶段
+
+    Args:
+        name: 阶段名称，同时是其结果在流程中的名称
+        func: 异步函数，以 inputs 中各名称对应的结果作为关键字参数调用
+        inputs: 依赖的阶段名称或流程的初始输入名称
+        resource: 占用的资源类型（ocr、llm、embedding、mongo、r2 等），同类阶段共享并发上限；None 表示不限制
+    """
+    def __init__(self, name: str, func: Callable[..., Awaitable[Any]], inputs: List[str] = None, resource: Optional[str] = None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs or []
+        self.resource = resource
+
+class StagePipeline:
+    """
+    以有向无环图描述的处理流程：每个阶段在其输入都完成后立即开始，互不依赖的阶段并行执行
+
+    - 每种资源有独立的并发上限（进程内共享），默认取环境变量 PIPELINE_LIMIT_<RESOURCE>
+    - 记录每个阶段的耗时，可通过 get_stats 查看
+    - 任一阶段失败时取消其余阶段，并抛出该异常
+    """
+    # embedding 的并发调用会在 CloudflareAIService 中合并为批量请求，上限较高以便合并
+    _default_limits = {"ocr": 4, "llm": 8, "embedding": 64, "mongo": 32, "r2": 16}
+    _semaphores: Dict[str, asyncio.Semaphore] = {}
+    _latencies: Dict[str, deque] = {}
+    _counts: Dict[str, Dict[str, int]] = {}
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError("阶段名称重复")
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        visiting, visited = set(), set()
+        def _visit(name):
+            if name in visited or name not in self.stages:
+                return
+            if name in visiting:
+                raise ValueError(f"处理流程存在循环依赖: {name}")
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                _visit(input_name)
+            visiting.discard(name)
+            visited.add(name)
+        for name in self.stages:
+            _visit(name)
+
+    @classmethod
+    def _get_semaphore(cls, resource: str) -> asyncio.Semaphore:
+        semaphore = cls._semaphores.get(resource)
+        if semaphore is None:
+            limit = int(os.getenv(f"PIPELINE_LIMIT_{resource.upper()}", cls._default_limits.get(resource, 8)))
+            semaphore = cls._semaphores[resource] = asyncio.Semaphore(limit)
+        return semaphore
+
+    @classmethod
+    def _record(cls, stage_name: str, elapsed: float, failed: bool):
+        cls._latencies.setdefault(stage_name, deque(maxlen=1000)).append(elapsed)
+        counts = cls._counts.setdefault(stage_name, {"completed": 0, "failed": 0})
+        counts["failed" if failed else "completed"] += 1
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, Dict[str, Any]]:
+        """各阶段的执行次数与最近耗时（秒）的统计"""
+        stats = {}
+        for stage_name, latencies in cls._latencies.items():
+            ordered = sorted(latencies)
+            stats[stage_name] = {
+                **cls._counts.get(stage_name, {}),
+                "avg": round(sum(ordered) / len(ordered), 3),
+                "p50": round(ordered[len(ordered) // 2], 3),
+                "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+                "max": round(ordered[-1], 3),
+            }
+        return stats
+
+    async def run(self, **initial_inputs) -> Dict[str, Any]:
+        """执行流程，返回所有阶段的结果（以阶段名称为键，包含初始输入）"""
+        results: Dict[str, asyncio.Future] = {}
+        loop = asyncio.get_running_loop()
+        for name, value in initial_inputs.items():
+            results[name] = loop.create_future()
+            results[name].set_result(value)
+        missing = {input_name for stage in self.stages.values() for input_name in stage.inputs} - set(self.stages) - set(initial_inputs)
+        if missing:
+            raise ValueError(f"缺少处理流程的输入: {missing}")
+
+        tasks = {}
+        for name in self.stages:
+            results[name] = loop.create_future()
+        for name, stage in self.stages.items():
+            tasks[name] = asyncio.create_task(self._run_stage(stage, results))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            for future in results.values():
+                if future.done() and not future.cancelled():
+                    future.exception()  # 标记异常已读取，避免未读取的警告
+            raise
+        return {name: future.result() for name, future in results.items()}
+
+    @classmethod
+    async def run_stage(cls, stage: Stage, **kwargs) -> Any:
+        """在资源并发上限内执行单个阶段并记录耗时（也可在流程之外单独使用）"""
+        async def _execute():
+            started_at = time.monotonic()
+            try:
+                value = await stage.func(**kwargs)
+            except BaseException:
+                cls._record(stage.name, time.monotonic() - started_at, failed=True)
+                raise
+            cls._record(stage.name, time.monotonic() - started_at, failed=False)
+            return value
+
+        if stage.resource:
+            async with cls._get_semaphore(stage.resource):
+                return await _execute()
+        return await _execute()
+
+    async def _run_stage(self, stage: Stage, results: Dict[str, asyncio.Future]):
+        try:
+            kwargs = {}
+            for input_name in stage.inputs:
+                # 使用 shield，本阶段被取消时不影响依赖阶段的结果 Future
+                kwargs[input_name] = await asyncio.shield(results[input_name])
+            value = await self.run_stage(stage, **kwargs)
+        except BaseException as e:
+            if not results[stage.name].done():
+                if isinstance(e, asyncio.CancelledError):
+                    results[stage.name].cancel()
+                else:
+                    results[stage.name].set_exception(e)
+            raise
+        results[stage.name].set_result(value)
+
+class ProcessingSlots:
+    """
+    处理名额：同时最多 limit 个内容占用名额处理
+
+    内容等待跨内容合并的批量请求（如向量化）时可让出名额，让调度器继续领取下一个内容，
+    合并的批次因此不受 limit 限制；另以 max_waiting 限制已让出名额、尚未完成的内容数量
+    """
+    def __init__(self, limit: int, max_waiting: int = 0):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = 0
+        self._active = asyncio.Semaphore(limit)
+        self._total = asyncio.Semaphore(limit + max_waiting)
+
+    async def acquire(self, batch_window: float = None) -> "ProcessingSlot":
+        """等待并取得一个名额"""
+        await self._total.acquire()
+        try:
+            await self._active.acquire()
+        except BaseException:
+            self._total.release()
+            raise
+        self.active += 1
+        return ProcessingSlot(self, batch_window)
+
+class ProcessingSlot:
+    """单个内容的处理名额，处理期间通过 ProcessingSlot.current 取得
+
+    Args:
+        batch_window: 该内容的批量请求最多等待合并的秒数，None 表示使用请求方的默认值
+    """
+    current: ContextVar = ContextVar("processing_slot", default=None)
+
+    def __init__(self, slots: ProcessingSlots, batch_window: float = None):
+        self._slots = slots
+        self.batch_window = batch_window
+        self._yielded = False
+        self._released = False
+
+    def yield_slot(self):
+        """让出名额，之后的阶段不再占用名额（可重复调用）"""
+        if self._yielded or self._released:
+            return
+        self._yielded = True
+        self._slots.active -= 1
+        self._slots.waiting += 1
+        self._slots._active.release()
+
+    def release(self):
+        """处理结束，归还名额（可重复调用）"""
+        if self._released:
+            return
+        if self._yielded:
+            self._slots.waiting -= 1
+        else:
+            self._slots.active -= 1
+            self._slots._active.release()
+        self._released = True
+        self._slots._total.release()
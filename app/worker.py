@@ -0,0 +1,30 @@
+"""内容处理 worker 的入口：python -m app.worker
+
+可在多个进程或节点上同时运行，以租约方式分摊未处理的内容
+"""
+import signal
+import asyncio
+from app.infrastructure.db.mongodb import MongodbClient
+from app.infrastructure.db.r2 import R2Storage
+from app.service.processing_worker_service import ContentProcessingWorker
+from app.utils.logging_utils import logger
+
+async def main():
+    await MongodbClient.connect_client()
+    worker = ContentProcessingWorker()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await worker.start()
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info(f"正在停止内容处理 worker: {worker.get_metrics()}")
+        await worker.stop()
+        await MongodbClient.close_client()
+        R2Storage.close_client()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+"""
+LINE Webhook 基準測試：50 個媒體 Webhook 同時處理時，同一事件循環上 API 的 p99 延遲
+
+比較舊的同步 LineBotApi（get_message_content、iter_content、reply_message 直接在協程中呼叫）
+與 linebot_service 使用的 LineMessagingService（open_line_content、reply_to_user）。
+
+- 模擬的 LINE API 在獨立執行緒中執行：下載內容分段送出（模擬較慢的 LINE CDN），回覆訊息有固定延遲
+- 事件循環上同時提供一個輕量的 API 端點，另一個執行緒持續請求並記錄延遲
+
+    python -m benchmarks.line_webhook_benchmark --webhooks 50 --content-size 1000000
+"""
+import os
+import time
+import asyncio
+import argparse
+import logging
+import threading
+
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "benchmark")
+
+import requests
+from aiohttp import web
+from linebot import LineBotApi
+from linebot.models import TextSendMessage
+
+from app.infrastructure.external.line_messaging_service import LineMessagingService
+from app.service.linebot_service import open_line_content, reply_to_user
+
+def _start_fake_line_api(content_size: int, chunks: int, chunk_delay: float, reply_delay: float) -> str:
+    """在獨立執行緒中啟動模擬的 LINE API，返回其 base URL"""
+    ready = threading.Event()
+    address = {}
+
+    async def message_content(request):
+        response = web.StreamResponse(headers={"Content-Type": "image/jpeg"})
+        await response.prepare(request)
+        chunk = b"\xff\xd8\xff" + b"x" * (content_size // chunks - 3)
+        for _ in range(chunks):
+            await asyncio.sleep(chunk_delay)
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    async def reply(request):
+        await request.read()
+        await asyncio.sleep(reply_delay)
+        return web.json_response({})
+
+    async def serve():
+        app = web.Application()
+        app.router.add_get("/v2/bot/message/{message_id}/content", message_content)
+        app.router.add_post("/v2/bot/message/reply", reply)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        address["port"] = site._server.sockets[0].getsockname()[1]
+        ready.set()
+        await asyncio.Event().wait()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    ready.wait()
+    return f"http://127.0.0.1:{address['port']}"
+
+async def _start_probe_api() -> str:
+    """在目前的事件循環上啟動輕量的 API 端點，返回其 URL"""
+    async def probe(request):
+        return web.json_response({"ok": True})
+
+    app = web.Application()
+    app.router.add_get("/probe", probe)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/probe"
+
+class _ProbeClient(threading.Thread):
+    """持續請求 API 端點並記錄延遲（在獨立執行緒中，不受被測事件循環影響）"""
+    def __init__(self, url: str, interval: float = 0.01):
+        super().__init__(daemon=True)
+        self.url = url
+        self.interval = interval
+        self.latencies = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        session = requests.Session()
+        while not self._stop_event.is_set():
+            started_at = time.perf_counter()
+            # 不設超時：事件循環被阻塞時，延遲即為阻塞的時間
+            session.get(self.url)
+            self.latencies.append(time.perf_counter() - started_at)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+async def _measure(name: str, handler, webhooks: int, probe_url: str):
+    probe_client = _ProbeClient(probe_url)
+    probe_client.start()
+    await asyncio.sleep(0.2)
+    started_at = time.perf_counter()
+    await asyncio.gather(*(handler(i) for i in range(webhooks)))
+    elapsed = time.perf_counter() - started_at
+    # 在執行緒中等待，探測請求仍需由事件循環回應
+    await asyncio.to_thread(probe_client.stop)
+
+    latencies = sorted(probe_client.latencies)
+    p50 = latencies[int(len(latencies) * 0.5)]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name:<22} webhooks done in {elapsed:6.2f}s  API latency p50 {p50 * 1000:7.1f}ms  "
+          f"p99 {p99 * 1000:7.1f}ms  max {latencies[-1] * 1000:7.1f}ms  ({len(latencies)} probes)")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--webhooks", type=int, default=50, help="同時處理的媒體 Webhook 數量")
+    parser.add_argument("--content-size", type=int, default=1_000_000, help="每則訊息內容的位元組數")
+    parser.add_argument("--content-seconds", type=float, default=1.0, help="下載一則訊息內容的耗時")
+    parser.add_argument("--reply-seconds", type=float, default=0.05, help="回覆訊息的耗時")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    chunks = 20
+    base_url = _start_fake_line_api(args.content_size, chunks, args.content_seconds / chunks, args.reply_seconds)
+    probe_url = await _start_probe_api()
+    token = os.environ["LINE_CHANNEL_ACCESS_TOKEN"]
+
+    async def sync_line_bot_api(i):
+        line_bot_api = LineBotApi(token, endpoint=base_url, data_endpoint=base_url)
+        message_content = line_bot_api.get_message_content(str(i))
+        size = sum(len(chunk) for chunk in message_content.iter_content())
+        line_bot_api.reply_message(f"token-{i}", TextSendMessage(text=f"received {size} bytes"))
+
+    LineMessagingService.api_base_url = LineMessagingService.data_api_base_url = base_url
+
+    async def async_line_messaging(i):
+        async with open_line_content(str(i)) as (file_ext, mime_type, content_chunks):
+            size = 0
+            async for chunk in content_chunks:
+                size += len(chunk)
+        await reply_to_user(f"token-{i}", f"received {size} bytes")
+
+    await _measure("sync LineBotApi", sync_line_bot_api, args.webhooks, probe_url)
+    await _measure("LineMessagingService", async_line_messaging, args.webhooks, probe_url)
+    await LineMessagingService.close_session()
+
+if __name__ == "__main__":
+    asyncio.run(main())
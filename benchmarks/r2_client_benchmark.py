@@ -0,0 +1,87 @@
+"""
+R2 客戶端基準測試：比較「每次呼叫建立 boto3 客戶端並在事件循環中同步呼叫」與共用連線池的 R2Storage
+
+同時送出 N 個 put + delete，輸出總耗時、吞吐量與事件循環延遲（p50/p99/最大值）。
+需要一個 S3 相容的端點，例如本機的 moto 伺服器：
+
+    moto_server -p 5055
+    R2_ENDPOINT=http://127.0.0.1:5055 python -m benchmarks.r2_client_benchmark --requests 200 --size 200000
+
+未設定的 R2_ACCESS_KEY、R2_SECRET_KEY、R2_BUCKET 使用測試值，bucket 不存在時自動建立。
+"""
+import os
+import time
+import asyncio
+import argparse
+import logging
+
+os.environ.setdefault("R2_ENDPOINT", "http://127.0.0.1:5055")
+os.environ.setdefault("R2_ACCESS_KEY", "benchmark")
+os.environ.setdefault("R2_SECRET_KEY", "benchmark")
+os.environ.setdefault("R2_BUCKET", "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import boto3
+from app.infrastructure.db.r2 import R2Storage
+
+def _create_client():
+    return boto3.client("s3", aws_access_key_id=os.environ["R2_ACCESS_KEY"], aws_secret_access_key=os.environ["R2_SECRET_KEY"],
+                        endpoint_url=os.environ["R2_ENDPOINT"])
+
+async def _measure(name: str, operation, requests: int):
+    """並發執行 operation，同時以 5ms 的計時器量測事件循環延遲"""
+    lags = []
+    async def _ticker():
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append(time.perf_counter() - started_at - 0.005)
+
+    ticker = asyncio.create_task(_ticker())
+    started_at = time.perf_counter()
+    await asyncio.gather(*(operation(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started_at
+    ticker.cancel()
+
+    lags.sort()
+    if lags:
+        p50, p99, worst = (lags[int(len(lags) * 0.5)], lags[min(len(lags) - 1, int(len(lags) * 0.99))], lags[-1])
+        lag_text = f"loop lag p50 {p50 * 1000:.1f}ms / p99 {p99 * 1000:.1f}ms / max {worst * 1000:.0f}ms"
+    else:
+        # 計時器在整個測試期間都沒有機會執行
+        lag_text = f"loop blocked for the whole run ({elapsed * 1000:.0f}ms)"
+    print(f"{name:<16} {elapsed:6.2f}s  {requests / elapsed:6.0f} ops/s  {lag_text}")
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="並發的 put + delete 數量")
+    parser.add_argument("--size", type=int, default=200_000, help="每個物件的位元組數")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    bucket = os.environ["R2_BUCKET"]
+    body = b"x" * args.size
+    setup_client = _create_client()
+    if bucket not in [item["Name"] for item in setup_client.list_buckets().get("Buckets", [])]:
+        setup_client.create_bucket(Bucket=bucket)
+
+    async def per_call_client(i):
+        client = _create_client()
+        client.put_object(Bucket=bucket, Key=f"benchmark/per-call/{i}", Body=body)
+        client.delete_object(Bucket=bucket, Key=f"benchmark/per-call/{i}")
+
+    async def _chunks():
+        yield body
+
+    async def pooled_client(i):
+        r2_storage = R2Storage()
+        result = await r2_storage.upload_stream(_chunks(), "benchmark", f"{i}.bin")
+        await r2_storage.delete(result["object_key"])
+
+    await _measure("per-call client", per_call_client, args.requests)
+    R2Storage.get_client()
+    await _measure("pooled R2Storage", pooled_client, args.requests)
+    R2Storage.close_client()
+
+if __name__ == "__main__":
+    asyncio.run(main())